@@ -27,7 +27,11 @@ import sys
 import tempfile
 import time
 
-import pandas as pd
+from misc_utils import (lazy_import, dump_file, _pretty_print_json, _write_json, _load_dict_sorted, _json_loads,
+                        _json_loadf, slurp_file, open_or_gzopen, available_cpu_count, execute,
+                        FixedSchemaTsvReader)
+
+pd = lazy_import('pandas')
 
 # * Utils
 
@@ -37,121 +41,6 @@ logging.basicConfig(level=logging.DEBUG,
 
 MAX_INT32 = (2 ** 31)-1
 
-def dump_file(fname, value):
-    """store string in file"""
-    with open(fname, 'w')  as out:
-        out.write(str(value))
-
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
-
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
-
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
-
-
-def slurp_file(fname, maxSizeMb=50):
-    """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
-    than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
-    with open_or_gzopen(fname) as f:
-        return f.read()
-
-def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
-
-    # if this is a gzip file
-    if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
-    else:
-        return open(fname, *open_opts, **kwargs)
-
-def available_cpu_count():
-    """
-    Return the number of available virtual or physical CPUs on this system.
-    The number of available CPUs can be smaller than the total number of CPUs
-    when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
-
-    Adapted from http://stackoverflow.com/a/1006301/715090
-    """
-
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-
-def execute(action, **kw):
-    succeeded = False
-    try:
-        _log.debug('Running command: %s', action)
-        subprocess.check_call(action, shell=True, **kw)
-        succeeded = True
-    finally:
-        _log.debug('Returned from running command: succeeded=%s, command=%s', succeeded, action)
-
 def chk(cond, msg='condition failed'):
     if not cond:
         raise RuntimeError(f'Error: {msg}') 
@@ -420,9 +309,11 @@ def collate_stats_and_metadata_for_all_sel_sims(args):
     
     pd.set_option('io.hdf.default_format','table')
     with pd.HDFStore(inps['experimentId']+'.all_component_stats.h5', mode='w', complevel=9, fletcher32=True) as store:
-        for hapset_compstats_tsv, hapset_replica_info_json in zip(inps['sel_normed_and_collated'], inps['replica_infos']):
+        # all hapsets' tsvs have the same columns, so only the first one needs type inference
+        compstats_reader = FixedSchemaTsvReader()
+        for hapset_compstats, hapset_replica_info_json in zip(compstats_reader.iter_read(inps['sel_normed_and_collated']),
+                                                              inps['replica_infos']):
             hapset_replica_info = _json_loadf(hapset_replica_info_json)['replicaInfo']
-            hapset_compstats = pd.read_table(hapset_compstats_tsv, low_memory=False)
             hapset_id = hapset_compstats['hapset_id'].iat[0]
             hapset_compstats = hapset_compstats.set_index(['hapset_id', 'pos'], verify_integrity=True)
             #hapset_dfs.append(hapset_compstats)
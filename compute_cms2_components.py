@@ -10,6 +10,7 @@ import copy
 import functools
 import glob
 import gzip
+import hashlib
 import io
 import itertools
 import json
@@ -26,9 +27,15 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import misc_utils
+from misc_utils import (lazy_import, dump_file, _pretty_print_json, _write_json, _load_dict_sorted, _json_loads,
+                        _json_loadf, slurp_file, open_or_gzopen, available_cpu_count, chk,
+                        get_resource_budget)
+
+np = lazy_import('numpy')
 
 # * Utils
 
@@ -38,74 +45,6 @@ logging.basicConfig(level=logging.DEBUG,
 
 MAX_INT32 = (2 ** 31)-1
 
-def dump_file(fname, value):
-    """store string in file"""
-    with open(fname, 'w')  as out:
-        out.write(str(value))
-
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
-
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
-
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
-
-
-def slurp_file(fname, maxSizeMb=50):
-    """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
-    than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
-    with open_or_gzopen(fname) as f:
-        return f.read()
-
-def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
-
-    # if this is a gzip file
-    if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
-    else:
-        return open(fname, *open_opts, **kwargs)
-
 def find_one_file(glob_pattern):
     """If exactly one file matches `glob_pattern`, returns the path to that file, else fails."""
     matching_files = list(glob.glob(glob_pattern))
@@ -113,57 +52,292 @@ def find_one_file(glob_pattern):
         return os.path.realpath(matching_files[0])
     raise RuntimeError(f'find_one_file({glob_pattern}): {len(matching_files)} matches - {matching_files}')
 
-def available_cpu_count():
+# * Profiling of external commands
+
+# fields added to the profile records of commands run from the current thread; see profile_context()
+_profile_context = threading.local()
+
+@contextlib.contextmanager
+def profile_context(**fields):
+    """Within this context, add the given fields to the profile records of commands run by execute() in this thread"""
+    saved_fields = getattr(_profile_context, 'fields', {})
+    _profile_context.fields = dict(saved_fields, **fields)
+    try:
+        yield
+    finally:
+        _profile_context.fields = saved_fields
+
+class CommandProfiler(object):
+    """Records the resource usage of each external command run by execute(), as one json record per line
+    of `profile_jsonl`."""
+
+    def __init__(self, profile_jsonl):
+        self.profile_jsonl = profile_jsonl
+        self.lock = threading.Lock()
+
+    def run(self, action, **kw):
+        """Run a shell command, recording its wall time, cpu time, peak memory and i/o.
+
+        The usage is taken from the rusage of the command's shell as returned by wait4(), which includes the
+        usage of all processes that the shell waited for, and is unaffected by other commands running concurrently.
+
+        Returns:
+          the command's return code, negated signal number if it was killed by a signal
+        """
+        beg_time = time.time()
+        proc = subprocess.Popen(action, shell=True, **kw)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        profile_record = dict(getattr(_profile_context, 'fields', {}),
+                              command=action, cwd=kw.get('cwd') or os.getcwd(), returncode=proc.returncode,
+                              beg_time=beg_time, wall_time_s=time.time() - beg_time,
+                              user_cpu_s=rusage.ru_utime, sys_cpu_s=rusage.ru_stime,
+                              max_rss_kb=rusage.ru_maxrss,
+                              # block counts are in 512-byte units, and count only actual storage i/o
+                              read_bytes=rusage.ru_inblock * 512, write_bytes=rusage.ru_oublock * 512)
+        with self.lock, open(self.profile_jsonl, 'a') as out:
+            out.write(json.dumps(profile_record) + '\n')
+        return proc.returncode
+# end: class CommandProfiler(object)
+
+# set from --profile-jsonl
+_command_profiler = None
+
+# * Choosing selscan thread counts
+
+SELSCAN_COMPONENTS = ('ihs', 'ihh12', 'nsl', 'xpehh')
+
+# selscan flags used for each component, in addition to the component flag itself
+SELSCAN_COMPONENT_FLAGS = {'ihs': ('--ihs-detail',)}
+
+def selscan_cmd(*, tped, out, component, threads, tped_ref=None):
+    """The selscan command used to compute `component`; tune_selscan_threads.py benchmarks this same command"""
+    tped_ref_opt = f' --tped-ref {tped_ref}' if component == 'xpehh' else ''
+    return ' '.join([f'selscan --tped {tped} --out {out} --threads {threads}{tped_ref_opt} --{component}',
+                     *SELSCAN_COMPONENT_FLAGS.get(component, ())])
+
+def get_selscan_n_haps(pop_sample_sizes, sel_pop, alt_pop=None):
+    """Number of haplotypes that selscan processes for the given sel pop (and alt pop, for two-pop components)"""
+    return sum(int(pop_sample_sizes[str(pop)]) for pop in (sel_pop, alt_pop) if pop is not None)
+
+class SelscanThreadsTable(object):
+    """Observed selscan runtimes for several components, hapset sizes and thread counts, used to choose the number of
+    threads for each selscan invocation and the number of invocations to run concurrently.
+
+    The table is a tsv file written by tune_selscan_threads.py, with columns
+    component, n_variants, n_haps, threads, wall_time_s.  A hapset is matched to the benchmarked hapset
+    closest to it in size (n_variants * n_haps, on a log scale).
     """
-    Return the number of available virtual or physical CPUs on this system.
-    The number of available CPUs can be smaller than the total number of CPUs
-    when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
 
-    Adapted from http://stackoverflow.com/a/1006301/715090
+    def __init__(self, rows):
+        # component -> benchmarked hapset size -> threads -> wall time
+        self.runtimes = collections.defaultdict(lambda: collections.defaultdict(dict))
+        for row in rows:
+            hapset_size = int(row['n_variants']) * int(row['n_haps'])
+            self.runtimes[row['component']][hapset_size][int(row['threads'])] = float(row['wall_time_s'])
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as table_file:
+            return cls(csv.DictReader(table_file, delimiter='\t'))
+
+    def _closest_runtimes(self, component, hapset_size):
+        """Map from thread count to wall time, for the benchmarked hapset closest in size to `hapset_size`"""
+        hapset_sizes = self.runtimes.get(component)
+        if not hapset_sizes:
+            return {}
+        closest_size = min(hapset_sizes, key=lambda size: abs(math.log(max(size, 1)) - math.log(max(hapset_size, 1))))
+        return hapset_sizes[closest_size]
+
+    def predict(self, component, hapset_size, max_threads):
+        """Return (threads, wall_time) for the fastest benchmarked thread count not above max_threads,
+        or (max_threads, None) if the component was not benchmarked.  If only thread counts above max_threads were
+        benchmarked, the wall time at max_threads is extrapolated from the smallest of them, assuming perfect scaling."""
+        runtimes = self._closest_runtimes(component, hapset_size)
+        if not runtimes:
+            return max_threads, None
+        usable_runtimes = {threads: wall_time for threads, wall_time in runtimes.items() if threads <= max_threads}
+        if not usable_runtimes:
+            min_threads = min(runtimes)
+            return max_threads, runtimes[min_threads] * min_threads / max_threads
+        threads = min(usable_runtimes, key=lambda threads: (usable_runtimes[threads], threads))
+        return threads, usable_runtimes[threads]
+
+    def choose_parallelism(self, jobs, n_cpus):
+        """Choose how to split n_cpus among jobs, each a (hapset_size, components) pair, to minimize their predicted
+        total wall time when all jobs get the same number of threads.
+
+        Returns:
+          tuple (n_parallel_jobs, threads_per_job), or None if no job component was benchmarked.
+        """
+        best = None
+        for threads_per_job in range(1, n_cpus+1):
+            n_parallel_jobs = min(len(jobs), n_cpus // threads_per_job)
+            wall_times = [[self.predict(component, hapset_size, threads_per_job)[1] for component in components]
+                          for hapset_size, components in jobs]
+            if all(wall_time is None for job_wall_times in wall_times for wall_time in job_wall_times):
+                return None
+            # components missing from the table are charged the time of the slowest benchmarked component of the same
+            # job (or, failing that, of any job), rather than no time, so that they do not skew the makespan
+            slowest_wall_time = max(wall_time for job_wall_times in wall_times for wall_time in job_wall_times
+                                    if wall_time is not None)
+            for job_wall_times in wall_times:
+                slowest_job_wall_time = max((wall_time for wall_time in job_wall_times if wall_time is not None),
+                                            default=slowest_wall_time)
+                job_wall_times[:] = [slowest_job_wall_time if wall_time is None else wall_time
+                                     for wall_time in job_wall_times]
+            # each job runs its components one after another; the makespan is at least the longest job's wall time
+            job_wall_times = [sum(job_wall_times) for job_wall_times in wall_times]
+            makespan = max(max(job_wall_times), sum(job_wall_times) / n_parallel_jobs)
+            if best is None or makespan < best[0]:
+                best = (makespan, n_parallel_jobs, threads_per_job)
+        _log.info(f'SelscanThreadsTable.choose_parallelism: {len(jobs)=} {n_cpus=} predicted_makespan={best[0]}')
+        return best[1:]
+# end: class SelscanThreadsTable(object)
+
+# * Caching selscan outputs
+
+def _file_sha256(fname, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _cached_file_sha256(fname, mtime_ns, size):
+    return _file_sha256(fname)
+
+def file_sha256(fname):
+    """Return the sha256 of a file's contents, computing it only once per version of the file"""
+    fname = os.path.realpath(fname)
+    st = os.stat(fname)
+    return _cached_file_sha256(fname, st.st_mtime_ns, st.st_size)
+
+class SelscanOutputCache(object):
+    """Content-addressed cache of selscan outputs, in a local directory.
+
+    An entry is keyed by the contents of the input tped(s), the selscan executable, the component and its flags,
+    so an entry is reused regardless of the names of the hapset, the block it is in or the other parameters of the run.
+    Each entry is a directory holding the selscan output files for one run.  When the cache exceeds `max_bytes`,
+    the least recently used entries are evicted.  The cache's total size is scanned once, then kept up to date
+    as entries are stored, so the cache is rescanned only when it needs evicting.  Entries are restored and evicted
+    under a lock, so an entry is never evicted while being restored.
     """
 
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+        self.total_bytes = sum(entry_bytes for _, entry_bytes, _ in self._scan_entries())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _selscan_sha256():
+        selscan_path = shutil.which('selscan')
+        chk(selscan_path, 'selscan not found')
+        return file_sha256(selscan_path)
+
+    def key(self, tpeds, component, flags):
+        """Return the cache key for running selscan on the given tpeds with the given component and flags"""
+        key_info = dict(tpeds=[file_sha256(tped) for tped in tpeds], selscan=self._selscan_sha256(),
+                        component=component, flags=sorted(flags))
+        return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, out_prefix):
+        """If the cache has an entry for `key`, copy its files to `out_prefix` + suffix and return True"""
+        entry_dir = self._entry_dir(key)
+        with self.lock:
+            try:
+                for suffix in os.listdir(entry_dir):
+                    shutil.copyfile(os.path.join(entry_dir, suffix), out_prefix + suffix)
+                os.utime(entry_dir)  # mark as recently used
+                hit = True
+            except FileNotFoundError:
+                # not in the cache, or evicted by another process while being restored
+                hit = False
+            if hit:
+                self.n_hits += 1
+            else:
+                self.n_misses += 1
+            _log.info(f'selscan output cache {"hit" if hit else "miss"} for {out_prefix}: {key=} '
+                      f'{self.n_hits=} {self.n_misses=}')
+        return hit
+
+    def store(self, key, out_prefix, suffixes):
+        """Add to the cache the files `out_prefix` + suffix, for those suffixes for which the file exists"""
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_entry_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix=f'tmp.{key}.')
+        entry_bytes = 0
+        for suffix in suffixes:
+            if os.path.isfile(out_prefix + suffix):
+                shutil.copyfile(out_prefix + suffix, os.path.join(tmp_entry_dir, suffix))
+                entry_bytes += os.path.getsize(out_prefix + suffix)
+        try:
+            os.rename(tmp_entry_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+            return
+        with self.lock:
+            self.total_bytes += entry_bytes
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _scan_entries(self):
+        """Return a list of (mtime, bytes, dir) for the cache entries"""
+        entries = []
+        for entry_dir in glob.glob(os.path.join(self.cache_dir, '*', '*')):
+            if os.path.basename(entry_dir).startswith('tmp.'):
+                continue
+            try:
+                entry_bytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(entry_dir, '*')))
+                entries.append((os.path.getmtime(entry_dir), entry_bytes, entry_dir))
+            except FileNotFoundError:
+                pass  # evicted by another process
+        return entries
+
+    def _evict(self):
+        """Evict least recently used entries until the cache fits in max_bytes; called with the lock held"""
+        entries = self._scan_entries()
+        self.total_bytes = sum(entry_bytes for _, entry_bytes, _ in entries)
+        for _, entry_bytes, entry_dir in sorted(entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            _log.info(f'selscan output cache: evicting {entry_dir} of {entry_bytes} bytes')
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self.total_bytes -= entry_bytes
+
+    def log_stats(self):
+        _log.info(f'selscan output cache {self.cache_dir}: {self.n_hits} hits, {self.n_misses} misses')
+# end: class SelscanOutputCache(object)
+
+# set from --selscan-cache-dir
+_selscan_output_cache = None
 
 def execute(action, **kw):
     succeeded = False
     try:
         _log.debug('Running command: %s', action)
-        subprocess.check_call(action, shell=True, **kw)
+        if _command_profiler is None:
+            subprocess.check_call(action, shell=True, **kw)
+        else:
+            returncode = _command_profiler.run(action, **kw)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, action)
         succeeded = True
     finally:
         _log.debug('Returned from running command: succeeded=%s, command=%s', succeeded, action)
 
-def chk(cond, msg):
-    if not cond:
-        raise RuntimeError(f'chk failed: {msg}')
-
 def calc_delihh(readfilename, writefilename):
     """given a selscan iHS file, parses it and writes delihh file"""
     with open_or_gzopen(readfilename) as readfile, open(writefilename, 'w') as writefile:
@@ -184,16 +358,84 @@ def calc_delihh(readfilename, writefilename):
             writefile.write('\t'.join([locus, phys, freq_1, ihh_1, ihh_0, str(unstand_delIHH)]) + '\n')
 # end: def calc_delihh(readfilename, writefilename):
 
-def calc_derFreq(in_tped, out_derFreq_tsv):
-    """Calculate the derived allele frequency for each SNP in one population"""
-    with open(in_tped) as tped, open(out_derFreq_tsv, 'w') as out:
-        out.write('\t'.join(['chrom', 'snpId', 'pos', 'derFreq']) + '\n')
+TpedData = collections.namedtuple('TpedData', ['chroms', 'snp_ids', 'gen_pos', 'phys_pos', 'alleles'])
+
+def read_tped(in_tped, n_haps=None):
+    """Read a tped into a TpedData, whose `alleles` is an int8 matrix with a row per SNP and a column per haplotype,
+    holding 1 for the ancestral and 0 for the derived allele.  The other fields are lists of the tped's strings.
+    Alleles may be separated by any whitespace.  If `n_haps` is given, every SNP must have that many haplotypes."""
+    chroms, snp_ids, gen_pos, phys_pos, allele_rows = [], [], [], [], []
+    with open(in_tped) as tped:
         for line in tped:
             chrom, snpId, genPos_cm, physPos_bp, alleles = line.strip().split(maxsplit=4)
-            n = [alleles.count(i) for i in ('0', '1')]
-            derFreq = n[0] / (n[0] + n[1])
+            chroms.append(chrom)
+            snp_ids.append(snpId)
+            gen_pos.append(genPos_cm)
+            phys_pos.append(physPos_bp)
+            allele_rows.append(alleles.encode('ascii').translate(None, b' \t\r\n\v\f'))
+    if n_haps is None:
+        n_haps = len(allele_rows[0]) if allele_rows else 0
+    bad_rows = [row_num for row_num, allele_row in enumerate(allele_rows) if len(allele_row) != n_haps]
+    chk(not bad_rows, f'{in_tped}: {len(bad_rows)} SNPs, first at SNP {bad_rows[:1]}, do not have {n_haps} haplotypes')
+    alleles = (np.frombuffer(b''.join(allele_rows), dtype=np.uint8).reshape(len(allele_rows), n_haps)
+               - ord('0')).astype(np.int8)
+    chk(np.all((alleles == 0) | (alleles == 1)), f'bad allele in {in_tped}')
+    return TpedData(chroms=chroms, snp_ids=snp_ids, gen_pos=gen_pos, phys_pos=phys_pos, alleles=alleles)
+
+def derived_allele_freqs(alleles):
+    """Derived allele frequency of each SNP, from a matrix of alleles as returned by read_tped()"""
+    return np.count_nonzero(alleles == 0, axis=1) / alleles.shape[1]
+
+def calc_derFreq(in_tped, out_derFreq_tsv, tped_data=None):
+    """Calculate the derived allele frequency for each SNP in one population"""
+    tped_data = tped_data or read_tped(in_tped)
+    derFreqs = derived_allele_freqs(tped_data.alleles)
+    with open(out_derFreq_tsv, 'w') as out:
+        out.write('\t'.join(['chrom', 'snpId', 'pos', 'derFreq']) + '\n')
+        for chrom, snpId, physPos_bp, derFreq in zip(tped_data.chroms, tped_data.snp_ids, tped_data.phys_pos,
+                                                     derFreqs.tolist()):
             out.write('\t'.join([chrom, snpId, physPos_bp, f'{derFreq:.2f}']) + '\n')
 
+def calc_fst_and_delDAF(sel_pop_alleles, alt_pop_alleles, fst_estimator='hudson'):
+    """Compute per-SNP Fst and delDAF between two pops, from allele matrices as returned by read_tped().
+
+    Fst is computed with Hudson's estimator as given by Bhatia et al. 2013 (`hudson`), or with the Weir & Cockerham 1984
+    estimator for haploid samples (`wc`).  delDAF is the sel pop's derived allele frequency minus the alt pop's.
+
+    Returns:
+      tuple (fst, delDAF) of float arrays; Fst is nan at SNPs monomorphic across both pops.
+    """
+    n1, n2 = sel_pop_alleles.shape[1], alt_pop_alleles.shape[1]
+    p1, p2 = derived_allele_freqs(sel_pop_alleles), derived_allele_freqs(alt_pop_alleles)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if fst_estimator == 'hudson':
+            num = (p1 - p2)**2 - p1*(1-p1)/(n1-1) - p2*(1-p2)/(n2-1)
+            den = p1*(1-p2) + p2*(1-p1)
+        elif fst_estimator == 'wc':
+            n_tot = n1 + n2
+            n_bar = n_tot / 2
+            n_c = (n_tot - (n1*n1 + n2*n2) / n_tot)
+            p_bar = (n1*p1 + n2*p2) / n_tot
+            s2 = (n1*(p1-p_bar)**2 + n2*(p2-p_bar)**2) / n_bar
+            h_bar = 0.0  # haploid samples have no heterozygotes
+            a = (n_bar / n_c) * (s2 - (p_bar*(1-p_bar) - s2/2 - h_bar/4) / (n_bar-1))
+            b = (n_bar / (n_bar-1)) * (p_bar*(1-p_bar) - s2/2 - (2*n_bar-1)/(4*n_bar) * h_bar)
+            c = h_bar / 2
+            num, den = a, a + b + c
+        else:
+            raise ValueError(f'unknown Fst estimator: {fst_estimator}')
+        fst = np.where(den != 0, num / den, np.nan)
+    return fst, p1 - p2
+
+def write_fst_and_delDAF(sel_pop_tped_data, alt_pop_tped_data, out_fst_and_delDAF_tsv, fst_estimator='hudson'):
+    """Write the per-SNP Fst and delDAF between two pops, as a tsv with columns physPos, Fst, delDAF"""
+    chk(sel_pop_tped_data.phys_pos == alt_pop_tped_data.phys_pos, 'tpeds of the two pops must have the same SNPs')
+    fst, delDAF = calc_fst_and_delDAF(sel_pop_tped_data.alleles, alt_pop_tped_data.alleles, fst_estimator=fst_estimator)
+    with open(out_fst_and_delDAF_tsv, 'w') as out:
+        out.write('\t'.join(['physPos', 'Fst', 'delDAF']) + '\n')
+        for physPos_bp, snp_fst, snp_delDAF in zip(sel_pop_tped_data.phys_pos, fst.tolist(), delDAF.tolist()):
+            out.write(f'{physPos_bp}\t{snp_fst:.6f}\t{snp_delDAF:.6f}\n')
+
 
 
 def hapset_to_vcf(hapset_manifest_json_fname, out_vcf_basename, sel_pop):
@@ -243,17 +485,89 @@ def hapset_to_vcf(hapset_manifest_json_fname, out_vcf_basename, sel_pop):
     misc_utils.execute(f'bcftools index {out_vcf_basename}.vcf.gz')
 # end: def hapset_to_vcf(hapset_manifest_json_fname, out_vcf_basename, sel_pop)
 
-def compute_isafe_scores(hapset_manifest_json_fname, sel_pop, isafe_extra_flags):
+# iSAFE is designed for regions of up to about 5Mbp; longer regions are split into overlapping windows of this size
+ISAFE_DEFAULT_WINDOW_BP = 5000000
+ISAFE_DEFAULT_WINDOW_OVERLAP_BP = 1000000
+# rough peak memory of one iSAFE run on a default-size window, used to limit how many windows run at once
+ISAFE_WINDOW_MEM_BYTES = 2 * 1024 ** 3
+
+def get_isafe_windows(region_beg, region_end, window_bp, window_overlap_bp):
+    """Split a region into windows of window_bp overlapping by at least window_overlap_bp, the last window
+    ending at region_end.  Returns a list of (beg, end) pairs; a region no longer than window_bp is one window."""
+    chk(0 <= window_overlap_bp < window_bp, f'bad iSAFE windows: {window_bp=} {window_overlap_bp=}')
+    if region_end - region_beg <= window_bp:
+        return [(region_beg, region_end)]
+    step_bp = window_bp - window_overlap_bp
+    n_windows = 1 + math.ceil((region_end - region_beg - window_bp) / step_bp)
+    window_begs = [min(region_beg + i * step_bp, region_end - window_bp) for i in range(n_windows)]
+    return [(window_beg, window_beg + window_bp) for window_beg in window_begs]
+
+def stitch_isafe_windows(window_isafe_outs, windows, out_isafe_fname):
+    """Combine iSAFE outputs for overlapping windows into one iSAFE output, taking the score of each SNP
+    from the window in which the SNP is most central"""
+    header = None
+    pos2row = {}  # pos -> (distance from window center, output line)
+    for window_isafe_out, (window_beg, window_end) in zip(window_isafe_outs, windows):
+        window_center = (window_beg + window_end) / 2
+        with open(window_isafe_out) as window_isafe:
+            window_header = window_isafe.readline()
+            chk(header is None or window_header == header, f'iSAFE output header mismatch: {window_isafe_out}')
+            header = window_header
+            pos_col = window_header.rstrip('\n').split('\t').index('POS')
+            for line in window_isafe:
+                pos = int(line.split('\t')[pos_col])
+                dist = abs(pos - window_center)
+                if pos not in pos2row or dist < pos2row[pos][0]:
+                    pos2row[pos] = (dist, line)
+    with open(out_isafe_fname, 'w') as out_isafe:
+        out_isafe.write(header)
+        for pos in sorted(pos2row):
+            out_isafe.write(pos2row[pos][1])
+
+def compute_isafe_scores(hapset_manifest_json_fname, sel_pop, isafe_extra_flags,
+                         window_bp=ISAFE_DEFAULT_WINDOW_BP, window_overlap_bp=ISAFE_DEFAULT_WINDOW_OVERLAP_BP):
+    """Compute iSAFE scores for a hapset.  Long regions are split into overlapping windows, which are run in parallel
+    against the same indexed vcf, and the window scores are stitched together into one output."""
     hapset_manifest = misc_utils.json_loadf(hapset_manifest_json_fname)
     out_vcf_basename = f'{hapset_manifest_json_fname[:-5]}.{sel_pop}'
     hapset_to_vcf(hapset_manifest_json_fname, out_vcf_basename, sel_pop)
-    misc_utils.execute(f'isafe --format vcf '
-                       f'--input {out_vcf_basename}.vcf.gz '
-                       f'--vcf-cont {out_vcf_basename}.vcf.gz '
-                       f'--sample-case {out_vcf_basename}.case.txt '
-                       f'--sample-cont {out_vcf_basename}.cont.txt '
-                       f'--region 1:{hapset_manifest["region_beg"]}-{hapset_manifest["region_end"]} '
-                       f'--output {out_vcf_basename} {isafe_extra_flags}')
+    isafe_cmd_base = (f'isafe --format vcf '
+                      f'--input {out_vcf_basename}.vcf.gz '
+                      f'--vcf-cont {out_vcf_basename}.vcf.gz '
+                      f'--sample-case {out_vcf_basename}.case.txt '
+                      f'--sample-cont {out_vcf_basename}.cont.txt ')
+    windows = get_isafe_windows(hapset_manifest["region_beg"], hapset_manifest["region_end"],
+                                window_bp=window_bp, window_overlap_bp=window_overlap_bp)
+    if len(windows) == 1:
+        execute(f'{isafe_cmd_base} '
+                f'--region 1:{hapset_manifest["region_beg"]}-{hapset_manifest["region_end"]} '
+                f'--output {out_vcf_basename} {isafe_extra_flags}')
+        return
+
+    _log.info(f'Running iSAFE on {len(windows)} windows: {windows=}')
+    # window outputs go in a separate dir, so that they are not mistaken for the hapset's iSAFE output
+    windows_dir = f'{out_vcf_basename}.isafe_windows'
+    execute(f'mkdir -p {windows_dir}')
+    window_out_basenames = [os.path.join(windows_dir, f'window{window_num:03}') for window_num in range(len(windows))]
+    profile_fields = getattr(_profile_context, 'fields', {})
+    def execute_window(cmd, window_num):
+        with profile_context(**profile_fields, isafe_window_num=window_num):
+            execute(cmd)
+    resource_budget = get_resource_budget()
+    max_workers = min(len(windows), resource_budget.n_cpus,
+                      max(1, (resource_budget.mem_bytes or ISAFE_WINDOW_MEM_BYTES) // ISAFE_WINDOW_MEM_BYTES))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window_futures = [executor.submit(execute_window,
+                                          f'{isafe_cmd_base} --region 1:{window_beg}-{window_end} '
+                                          f'--output {window_out_basename} {isafe_extra_flags}', window_num)
+                          for window_num, ((window_beg, window_end), window_out_basename)
+                          in enumerate(zip(windows, window_out_basenames))]
+        for window_future in window_futures:
+            window_future.result()
+    stitch_isafe_windows(window_isafe_outs=[f'{window_out_basename}.iSAFE.out'
+                                            for window_out_basename in window_out_basenames],
+                         windows=windows, out_isafe_fname=f'{out_vcf_basename}.iSAFE.out')
+    shutil.rmtree(windows_dir)
 
 
 # * Parsing args
@@ -272,14 +586,29 @@ def parse_args():
     parser.add_argument('--hapsets', nargs='+',
                         required=True, help='list of .tar.gz files where each contains the haps for one hapset')
     #parser.add_argument('--out-basename', required=True, help='base name for output files')
-    parser.add_argument('--sel-pop', required=True, help='test for selection in this population')
+    parser.add_argument('--sel-pop', help='test for selection in this population')
     parser.add_argument('--alt-pop', help='for two-pop tests, compare with this population')
+    parser.add_argument('--sel-pops', nargs='+',
+                        help='instead of --sel-pop, compute the one-pop components among --components for each of these pops')
+    parser.add_argument('--pop-pairs', nargs='+', metavar='SEL_POP,ALT_POP',
+                        help='instead of --sel-pop/--alt-pop, compute the two-pop components among --components '
+                        'for each of these pop pairs')
     parser.add_argument('--components', required=True,
                         choices=('ihs', 'ihh12', 'nsl', 'delihh', 'xpehh', 'fst', 'delDAF', 'derFreq', 'iSAFE'),
                         nargs='+', help='which component tests to compute')
     parser.add_argument('--component-computation-params', help='info defining how to compute each component')
     parser.add_argument('--threads', type=int, help='selscan threads')
+    parser.add_argument('--selscan-cache-dir',
+                        help='local directory in which to cache selscan outputs, keyed by the content of the input tpeds, '
+                        'the selscan executable, the component and its flags')
+    parser.add_argument('--selscan-cache-max-gb', type=float, default=50.0,
+                        help='max size of --selscan-cache-dir; least recently used entries are evicted beyond this size')
+    parser.add_argument('--selscan-threads-table',
+                        help='tsv of benchmarked selscan runtimes written by tune_selscan_threads.py; if given, used to '
+                        'choose the threads for each selscan invocation and the number of pops processed concurrently')
     parser.add_argument('--checkpoint-file', help='file used for checkpointing')
+    parser.add_argument('--profile-jsonl', help='append to this file a json record of the resource usage of each '
+                        'external command run, along with the hapset size')
     #parser.add_argument('--out-json', required=True, help='json file describing the manifest of each file')
 
     # parser.add_argument('--ihs-bins', help='use ihs bins for normalization')
@@ -292,22 +621,29 @@ def parse_args():
 
 # * compute_component_scores
 
+ONE_POP_COMPONENTS = ('ihs', 'ihh12', 'nsl', 'delihh', 'derFreq', 'iSAFE')
+TWO_POP_COMPONENTS = ('xpehh', 'fst', 'delDAF')
+
+# the checkpoint file may be updated from several threads, when components for several pops are computed in parallel
+_checkpoint_lock = threading.Lock()
+
 def add_file_to_checkpoint(checkpoint_file, fname):
     #if not os.path.isfile(checkpoint_file):
     _log.info(f'add_file_to_checkpoint: checkpoint_file={checkpoint_file} fname={fname}')
     if not checkpoint_file:
         _log.info(f'No checkpoint file -- not adding {fname} to checkpoint')
         return
-    checkpoint_file_tmp = checkpoint_file + '.tmp.tar'
-    if not os.path.isfile(checkpoint_file_tmp):
-        execute(f'cp {checkpoint_file} {checkpoint_file_tmp}')
-
-    fname_rel = os.path.relpath(fname)
-    execute(f'tar -rvf {checkpoint_file_tmp} {fname_rel}')
-    os.rename(checkpoint_file_tmp, checkpoint_file)
-    execute(f'ls -l {checkpoint_file}')
-    _log.info(f'checkpoint file {checkpoint_file} after adding {fname}:')
-    execute(f'tar -tvf {checkpoint_file} 1>&2')
+    with _checkpoint_lock:
+        checkpoint_file_tmp = checkpoint_file + '.tmp.tar'
+        if not os.path.isfile(checkpoint_file_tmp):
+            execute(f'cp {checkpoint_file} {checkpoint_file_tmp}')
+
+        fname_rel = os.path.relpath(fname)
+        execute(f'tar -rvf {checkpoint_file_tmp} {fname_rel}')
+        os.rename(checkpoint_file_tmp, checkpoint_file)
+        execute(f'ls -l {checkpoint_file}')
+        _log.info(f'checkpoint file {checkpoint_file} after adding {fname}:')
+        execute(f'tar -tvf {checkpoint_file} 1>&2')
 
 def execute_with_checkpoint(out_fname, cmd, cwd, checkpoint_file):
     """Run the given command to create a given file, and compress it.
@@ -324,7 +660,115 @@ def execute_with_checkpoint(out_fname, cmd, cwd, checkpoint_file):
         execute(cmd, cwd=cwd)
         #execute(f'gzip {fname}', cwd=cwd)
         add_file_to_checkpoint(checkpoint_file=checkpoint_file, fname=out_fname)
-    
+
+def get_hapset_n_variants(replicaInfo):
+    """Return the number of variants in a hapset, or None if not recorded in its replicaInfo"""
+    # for simulated hapsets, n_variants is recorded only in the nested replicaInfo
+    return replicaInfo.get('n_variants', replicaInfo.get('replicaInfo', {}).get('n_variants'))
+
+def get_pop_jobs(args):
+    """Return the list of (sel_pop, alt_pop, components) combinations for which to compute components.
+    alt_pop is None for one-pop components."""
+    if args.sel_pops or args.pop_pairs:
+        chk(not (args.sel_pop or args.alt_pop), '--sel-pop/--alt-pop cannot be combined with --sel-pops/--pop-pairs')
+        pop_jobs = []
+        one_pop_components = [c for c in args.components if c in ONE_POP_COMPONENTS]
+        if one_pop_components:
+            pop_jobs.extend((sel_pop, None, one_pop_components) for sel_pop in (args.sel_pops or []))
+        two_pop_components = [c for c in args.components if c in TWO_POP_COMPONENTS]
+        if two_pop_components:
+            for pop_pair in (args.pop_pairs or []):
+                sel_pop, alt_pop = pop_pair.split(',')
+                pop_jobs.append((sel_pop, alt_pop, two_pop_components))
+        return pop_jobs
+    chk(args.sel_pop, 'one of --sel-pop, --sel-pops or --pop-pairs is required')
+    return [(args.sel_pop, args.alt_pop, list(args.components))]
+
+def compute_components_for_pops(*, hapset_haps_tar_gz, hapset_dir, hapset_manifest_json_fname, replicaInfo,
+                                sel_pop, alt_pop, components, threads, component_computation_params, checkpoint_file,
+                                selscan_threads_table=None):
+    """Compute the given components for one unpacked hapset and one sel pop (and alt pop, for two-pop components),
+    writing the results to hapset_dir.  Each selscan invocation gets at most `threads` threads."""
+
+    out_basename = os.path.basename(hapset_haps_tar_gz) + '__selpop_' + str(sel_pop)
+    if alt_pop:
+        out_basename += '__altpop_' + str(alt_pop)
+
+    _log.info(f'Computing {components=} for {sel_pop=} {alt_pop=} using {threads} threads')
+    with profile_context(hapset=os.path.basename(hapset_haps_tar_gz), sel_pop=sel_pop, alt_pop=alt_pop,
+                         n_variants=get_hapset_n_variants(replicaInfo),
+                         pop_sample_sizes=replicaInfo.get('pop_sample_sizes'),
+                         region_len=(replicaInfo.get('region_end') or 0) - (replicaInfo.get('region_beg') or 0)):
+        pop_id_to_idx = dict([(pop_id, idx) for idx, pop_id in enumerate(replicaInfo['popIds'])])
+        sel_pop_idx = pop_id_to_idx[sel_pop]
+        sel_pop_tped = os.path.realpath(os.path.join(hapset_dir, replicaInfo["tpedFiles"][sel_pop_idx]))
+        if alt_pop:
+            alt_pop_idx = pop_id_to_idx[alt_pop]
+            alt_pop_tped = os.path.realpath(os.path.join(hapset_dir, replicaInfo["tpedFiles"][alt_pop_idx]))
+        
+        for component in components:
+            if component in SELSCAN_COMPONENTS:
+                component_threads = threads
+                if selscan_threads_table:
+                    hapset_size = (get_hapset_n_variants(replicaInfo) or 0) * \
+                        get_selscan_n_haps(replicaInfo['pop_sample_sizes'], sel_pop,
+                                           alt_pop if component == 'xpehh' else None)
+                    component_threads, _ = selscan_threads_table.predict(component, hapset_size, max_threads=threads)
+                cmd = selscan_cmd(tped=sel_pop_tped, out=out_basename, component=component, threads=component_threads,
+                                  tped_ref=alt_pop_tped if component == 'xpehh' else None)
+                out_fname = f'{out_basename}.{component}.out'
+                cache_key = None
+                if _selscan_output_cache and not os.path.isfile(os.path.join(hapset_dir, out_fname)):
+                    cache_key = _selscan_output_cache.key(
+                        tpeds=[sel_pop_tped] + ([alt_pop_tped] if component == 'xpehh' else []),
+                        component=component, flags=list(SELSCAN_COMPONENT_FLAGS.get(component, ())))
+                    if _selscan_output_cache.restore(cache_key, out_prefix=os.path.join(hapset_dir, f'{out_basename}.')):
+                        add_file_to_checkpoint(checkpoint_file=checkpoint_file, fname=os.path.join(hapset_dir, out_fname))
+                        cache_key = None
+                #execute(cmd, cwd=hapset_dir)
+                with profile_context(component=component, threads=component_threads):
+                    execute_with_checkpoint(cmd=cmd, out_fname=out_fname, cwd=hapset_dir, checkpoint_file=checkpoint_file)
+                if cache_key:
+                    _selscan_output_cache.store(cache_key, out_prefix=os.path.join(hapset_dir, f'{out_basename}.'),
+                                                suffixes=[f'{component}.out', f'{component}.log'])
+
+        if 'delihh' in components:
+            if 'ihs' not in components:
+                raise RuntimeError('To compute delihh must first compute ihs')
+            calc_delihh(readfilename=f'{hapset_dir}/{out_basename}.ihs.out',
+                        writefilename=f'{hapset_dir}/{out_basename}.delihh.out')
+
+        # the sel pop tped is parsed once, for both fst/delDAF and derFreq
+        sel_pop_tped_data = None
+        if 'fst' in components or 'delDAF' in components:
+            fst_and_delDAF_out_fname = os.path.join(hapset_dir, out_basename + '.fst_and_delDAF.tsv')
+            if os.path.isfile(fst_and_delDAF_out_fname):
+                _log.info(f'Reusing {fst_and_delDAF_out_fname} from checkpoint file {checkpoint_file}')
+            else:
+                sel_pop_tped_data = read_tped(sel_pop_tped, n_haps=get_selscan_n_haps(replicaInfo['pop_sample_sizes'], sel_pop))
+                write_fst_and_delDAF(sel_pop_tped_data=sel_pop_tped_data,
+                                     alt_pop_tped_data=read_tped(alt_pop_tped, n_haps=get_selscan_n_haps(
+                                         replicaInfo['pop_sample_sizes'], alt_pop)),
+                                     out_fst_and_delDAF_tsv=fst_and_delDAF_out_fname,
+                                     fst_estimator=component_computation_params.get('fst_estimator') or 'hudson')
+                add_file_to_checkpoint(checkpoint_file=checkpoint_file, fname=fst_and_delDAF_out_fname)
+
+        if 'derFreq' in components:
+            calc_derFreq(in_tped=sel_pop_tped, out_derFreq_tsv=f'{hapset_dir}/{out_basename}.derFreq.tsv',
+                         tped_data=sel_pop_tped_data or read_tped(sel_pop_tped, n_haps=get_selscan_n_haps(
+                             replicaInfo['pop_sample_sizes'], sel_pop)))
+
+        if 'iSAFE' in components:
+            with profile_context(component='iSAFE'):
+                compute_isafe_scores(hapset_manifest_json_fname=hapset_manifest_json_fname,
+                                     sel_pop=sel_pop,
+                                     isafe_extra_flags=component_computation_params.get('isafe_extra_flags', ''),
+                                     window_bp=component_computation_params.get('isafe_window_bp') or \
+                                     ISAFE_DEFAULT_WINDOW_BP,
+                                     window_overlap_bp=component_computation_params.get('isafe_window_overlap_bp') or \
+                                     ISAFE_DEFAULT_WINDOW_OVERLAP_BP)
+# end: def compute_components_for_pops(...)
+
 def compute_component_scores_for_one_hapset(*, args, hapset_haps_tar_gz, hapset_num, checkpoint_file):
 
     # TODO: check the presence of sentinel file (or a checksum file?) before each operation.
@@ -333,9 +777,6 @@ def compute_component_scores_for_one_hapset(*, args, hapset_haps_tar_gz, hapset_
 
     # TODO: uniformize things, so that for each component there is its own method?
 
-    # TODO: add an (optional?) thread that monitors the memory and load at regular intervals,
-    # maybe using psutils, and add to the output.  [is this monitoring feature of cromwell supported by terra?]
-
     if os.path.getsize(hapset_haps_tar_gz) == 0:
         raise RuntimeError(f'Skipping failed sim {hapset_haps_tar_gz} hapset_num={hapset_num}')
 
@@ -347,70 +788,54 @@ def compute_component_scores_for_one_hapset(*, args, hapset_haps_tar_gz, hapset_
     execute(f'mkdir -p {hapset_dir}')
     execute(f'tar -zvxf {hapset_haps_tar_gz} -C {hapset_dir}/')
 
-    out_basename = os.path.basename(hapset_haps_tar_gz) + '__selpop_' + str(args.sel_pop)
-    if args.alt_pop:
-        out_basename += '__altpop_' + str(args.alt_pop)
-
-    n_cpus = available_cpu_count()
-    threads = min(args.threads or n_cpus, n_cpus)
-    _log.info(f'Using {threads} threads')
     #shutil.copyfile(args.replica_info, f'{args.replica_id_string}.replica_info.json')
     hapset_manifest_json_fname = find_one_file(f'{hapset_dir}/*.replicaInfo.json')
     replicaInfo = _json_loadf(hapset_manifest_json_fname)
-    pop_id_to_idx = dict([(pop_id, idx) for idx, pop_id in enumerate(replicaInfo['popIds'])])
-    sel_pop_idx = pop_id_to_idx[args.sel_pop]
-    sel_pop_tped = os.path.realpath(os.path.join(hapset_dir, replicaInfo["tpedFiles"][sel_pop_idx]))
-    if args.alt_pop:
-        alt_pop_idx = pop_id_to_idx[args.alt_pop]
-        alt_pop_tped = os.path.realpath(os.path.join(hapset_dir, replicaInfo["tpedFiles"][alt_pop_idx]))
-        
-    selscan_cmd_base = \
-        f'selscan --threads {threads} --tped {sel_pop_tped} ' \
-        f'--out {out_basename}'
-    for component in args.components:
-        if component in ('ihs', 'ihh12', 'nsl', 'xpehh'):
-            alt_pop_tped_opt = '' if component not in ('xpehh',) else \
-                f' --tped-ref {alt_pop_tped} '
-            ihs_detail = '' if component != 'ihs' else ' --ihs-detail '
-            cmd = f'{selscan_cmd_base} {alt_pop_tped_opt} --{component} {ihs_detail}'
-            #execute(cmd, cwd=hapset_dir)
-            execute_with_checkpoint(cmd=cmd, out_fname=f'{out_basename}.{component}.out', cwd=hapset_dir, checkpoint_file=checkpoint_file)
-
-    if 'delihh' in args.components:
-        if 'ihs' not in args.components:
-            raise RuntimeError('To compute delihh must first compute ihs')
-        calc_delihh(readfilename=f'{hapset_dir}/{out_basename}.ihs.out',
-                    writefilename=f'{hapset_dir}/{out_basename}.delihh.out')
-
-    if 'fst' in args.components or 'delDAF' in args.components:
-        fst_and_delDAF_out_fname = os.path.join(hapset_dir, out_basename + '.fst_and_delDAF.tsv')
-        cmd = \
-            f'freqs_stats {sel_pop_tped} {alt_pop_tped} ' \
-            f' {fst_and_delDAF_out_fname}'
-        execute_with_checkpoint(cmd=cmd, out_fname=f'{out_basename}.fst_and_delDAF.tsv', cwd=hapset_dir, checkpoint_file=checkpoint_file)
-
-    if 'derFreq' in args.components:
-        calc_derFreq(in_tped=sel_pop_tped, out_derFreq_tsv=f'{hapset_dir}/{out_basename}.derFreq.tsv')
-
-    if 'iSAFE' in args.components:
-        compute_isafe_scores(hapset_manifest_json_fname=hapset_manifest_json_fname,
-                             sel_pop=args.sel_pop,
-                             isafe_extra_flags=component_computation_params.get('isafe_extra_flags', ''))
+
+    # the hapset is unpacked once, and the components for all requested pops and pop pairs are computed from it,
+    # splitting the available cpus among the pops and pop pairs processed in parallel.
+    pop_jobs = get_pop_jobs(args)
+    n_cpus = available_cpu_count()
+    threads = min(args.threads or n_cpus, n_cpus)
+    n_parallel_jobs = max(1, min(len(pop_jobs), threads))
+    threads_per_job = max(1, threads // n_parallel_jobs)
+    selscan_threads_table = SelscanThreadsTable.load(args.selscan_threads_table) if args.selscan_threads_table else None
+    if selscan_threads_table and pop_jobs:
+        n_variants = get_hapset_n_variants(replicaInfo) or 0
+        parallelism = selscan_threads_table.choose_parallelism(
+            jobs=[(n_variants * get_selscan_n_haps(replicaInfo['pop_sample_sizes'], sel_pop, alt_pop),
+                   [c for c in components if c in SELSCAN_COMPONENTS])
+                  for sel_pop, alt_pop, components in pop_jobs],
+            n_cpus=threads)
+        if parallelism:
+            n_parallel_jobs, threads_per_job = parallelism
+    _log.info(f'Using {threads} threads: {len(pop_jobs)=} {n_parallel_jobs=} {threads_per_job=}')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_parallel_jobs) as executor:
+        pop_job_futures = [executor.submit(compute_components_for_pops,
+                                           hapset_haps_tar_gz=hapset_haps_tar_gz, hapset_dir=hapset_dir,
+                                           hapset_manifest_json_fname=hapset_manifest_json_fname,
+                                           replicaInfo=replicaInfo, sel_pop=sel_pop, alt_pop=alt_pop,
+                                           components=components, threads=threads_per_job,
+                                           component_computation_params=component_computation_params,
+                                           checkpoint_file=checkpoint_file,
+                                           selscan_threads_table=selscan_threads_table)
+                           for sel_pop, alt_pop, components in pop_jobs]
+        for pop_job_future in pop_job_futures:
+            pop_job_future.result()
 
     exts = [".replicaInfo.json", ".ihs.out", ".nsl.out", ".ihh12.out", ".delihh.out", ".derFreq.tsv",
             ".iSAFE.out", ".vcf.gz", ".case.txt", ".cont.txt", ".xpehh.out", ".xpehh.log", ".fst_and_delDAF.tsv"]
     for ext in exts:
         matching_files_pattern = f'{hapset_dir}/*{ext}'
-        matching_files = list(glob.glob(matching_files_pattern))
-        if len(matching_files) != 1:
+        matching_files = sorted(glob.glob(matching_files_pattern))
+        if len(matching_files) != len(pop_jobs) and ext != '.replicaInfo.json':
             _log.info(f'{matching_files_pattern=}: {len(matching_files)=} {matching_files=}')
-            continue
-        f = matching_files[0]
-        f_base = os.path.basename(f)
-        f_out = f'{hapset_dir}.{f_base}'
-        misc_utils.chk(not os.path.isfile(f_out), f'already exists: {f_out}')
-        _log.info(f'linking {f=} to {f_out=}')
-        os.link(f, f_out)
+        for f in matching_files:
+            f_base = os.path.basename(f)
+            f_out = f'{hapset_dir}.{f_base}'
+            misc_utils.chk(not os.path.isfile(f_out), f'already exists: {f_out}')
+            _log.info(f'linking {f=} to {f_out=}')
+            os.link(f, f_out)
 
 def parse_file_list(z):
     z_orig = copy.deepcopy(z)
@@ -426,7 +851,13 @@ def parse_file_list(z):
     return result[::-1]
 
 def compute_component_scores(args):
+    global _command_profiler, _selscan_output_cache
     _log.info(f'Starting compute_component_scores: args={args}')
+    if args.profile_jsonl:
+        _command_profiler = CommandProfiler(args.profile_jsonl)
+    if args.selscan_cache_dir:
+        _selscan_output_cache = SelscanOutputCache(args.selscan_cache_dir,
+                                                   max_bytes=int(args.selscan_cache_max_gb * 2**30))
     if args.checkpoint_file:
         if os.path.isfile(args.checkpoint_file) and os.path.getsize(args.checkpoint_file) > 0:
             checkpoint_file_size = os.path.getsize(args.checkpoint_file)
@@ -443,7 +874,9 @@ def compute_component_scores(args):
         compute_component_scores_for_one_hapset(args=copy.deepcopy(args),
                                                 hapset_haps_tar_gz=f, hapset_num=hapset_num,
                                                 checkpoint_file=args.checkpoint_file)
-        
+    if _selscan_output_cache:
+        _selscan_output_cache.log_stats()
+
 if __name__=='__main__':
   compute_component_scores(parse_args())
   #hapset_to_vcf('/data/ilya-work/proj/dockstore-tool-cms2/tmp/az/model_defdef15_hard_sel1_common.citest_neutral__block_0__of_2__rep_0.replicaInfo.json', 'testout_vcf', '4')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-"""Computes summary stats for a set of genomic intervals.
+"""Computes summary stats for a set of genomic intervals: interval lengths, per-chrom coverage, pairwise overlap
+between the intervals files, and gaps between intervals.
 """
 
 import platform
@@ -9,12 +10,10 @@ if not tuple(map(int, platform.python_version_tuple())) >= (3,8):
     raise RuntimeError('Python >=3.8 required')
 
 import argparse
-import base64
 import csv
 import collections
 import concurrent.futures
 import contextlib
-import copy
 import datetime
 import functools
 import glob
@@ -36,14 +35,12 @@ import time
 import urllib
 import urllib.request
 
-# third-party imports
-import dominate
-import dominate.tags
-import dominate.util
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
+# third-party imports; dominate is imported only where needed, to keep startup fast
+from misc_utils import (lazy_import, dump_file, _pretty_print_json, _write_json, _load_dict_sorted, _json_loads,
+                        _json_loadf, slurp_file, open_or_gzopen, available_cpu_count, execute, chk, parse_file_list)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 _log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG,
@@ -51,125 +48,6 @@ logging.basicConfig(level=logging.DEBUG,
 
 MAX_INT32 = (2 ** 31)-1
 
-def dump_file(fname, value):
-    """store string in file"""
-    with open(fname, 'w')  as out:
-        out.write(str(value))
-
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
-
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
-
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
-
-
-def slurp_file(fname, maxSizeMb=50):
-    """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
-    than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
-    with open_or_gzopen(fname) as f:
-        return f.read()
-
-def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
-
-    # if this is a gzip file
-    if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
-    else:
-        return open(fname, *open_opts, **kwargs)
-
-def available_cpu_count():
-    """
-    Return the number of available virtual or physical CPUs on this system.
-    The number of available CPUs can be smaller than the total number of CPUs
-    when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
-
-    Adapted from http://stackoverflow.com/a/1006301/715090
-    """
-
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-
-def execute(action, **kw):
-    succeeded = False
-    try:
-        _log.debug('Running command: %s', action)
-        subprocess.check_call(action, shell=True, **kw)
-        succeeded = True
-    finally:
-        _log.debug('Returned from running command: succeeded=%s, command=%s', succeeded, action)
-
-def chk(cond, msg='condition failed'):
-    if not cond:
-        raise RuntimeError(f'Error: {msg}') 
-
 def is_int(val):
     try:
         x = int(str(val))
@@ -189,11 +67,18 @@ def parse_args():
     parser.add_argument('--metadata-json', help='metadata to show at top of report')
 
     parser.add_argument('--intervals-report-html', required=True, help='output file for intervals report')
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='number of bed lines to parse at a time')
+    parser.add_argument('--chrom-sizes', help='tab-separated file of chrom names and lengths (e.g. a .fai or '
+                        '.chrom.sizes file); if given, per-chrom coverage is also shown as a fraction of chrom length')
 
     return parser.parse_args()
 
 @contextlib.contextmanager
 def create_html_page(html_fname, title=''):
+    import dominate
+    import dominate.tags
+    import dominate.util
+
     tags = dominate.tags
     doc = dominate.document(title=title)
 
@@ -202,20 +87,9 @@ def create_html_page(html_fname, title=''):
         tags.meta(name="viewport", content="width=device-width, initial-scale=1.0")
         tags.meta(http_equiv="Expires", content="Thu, 1 June 2000 23:59:00 GMT")
         tags.meta(http_equiv="pragma", content="no-cache")
-        tags.style('table, th, td {border: 1px solid black;}')
+        tags.style('table, th, td {border: 1px solid black; border-collapse: collapse; padding: 2px 6px;}')
         tags.style('th {background-color: lightblue;}')
-        #tags.base(href=os.path.basename(html_fname))
-
-        tags.script(src="http://code.jquery.com/jquery-1.7.1.min.js")
-
-        tags.link(href="https://unpkg.com/tabulator-tables@4.9.3/dist/css/tabulator.min.css", rel="stylesheet")
-        tags.script(type="text/javascript", src="https://unpkg.com/tabulator-tables@4.9.3/dist/js/tabulator.min.js")
-        
-        # tags.link(href="https://raw.githubusercontent.com/olifolkerd/tabulator/4.9.3/dist/css/tabulator.min.css",
-        #           rel="stylesheet")
-        # tags.script(type='text/javascript',
-        #             src="https://raw.githubusercontent.com/olifolkerd/tabulator/4.9.3/dist/js/tabulator.min.js")
-        #tags.script(src='https://www.brainbell.com/javascript/download/resizable.js')
+        tags.style('td {text-align: right;}')
 
     def txt(v): return dominate.util.text(str(v)) if not hasattr(v, 'raw_html') else dominate.util.raw(v.data)
     def trow(vals, td_or_th=tags.td): return tags.tr((td_or_th(txt(val)) for val in vals), __pretty=False)
@@ -227,23 +101,6 @@ def create_html_page(html_fname, title=''):
         return s
     
     with doc:
-        raw("""<script  type="text/javascript">
-         $(function() {
-       $('a[href*="#"]:not([href="#"])').click(function() {
-         if (location.pathname.replace(/^\//,'') == this.pathname.replace(/^\//,'') && location.hostname == this.hostname) {
-           var target = $(this.hash);
-           target = target.length ? target : $('[name=' + this.hash.slice(1) +']');
-           if (target.length) {
-             $('html, body').animate({
-               scrollTop: target.offset().top
-             }, 1000);
-             return false;
-           }
-         }
-       });
-     });
-        </script>""")
-
         tags.div(cls='header').add(txt(datetime.datetime.now()))
         with tags.div(cls='body'):
             tags.h1(title)
@@ -255,58 +112,210 @@ def create_html_page(html_fname, title=''):
     with open(html_fname, 'w') as out:
         out.write(doc.render())
 
-def html_insert_fig(tags):
-
-    my_stringIObytes = io.BytesIO()
-    plt.savefig(my_stringIObytes, format='jpg')
-    my_stringIObytes.seek(0)
-    my_base64_jpgData = base64.b64encode(my_stringIObytes.read())
-
-    encoded = my_base64_jpgData
-    #print('type:', type(encoded))
-    tags.img(src='data:image/png;base64,'+encoded.decode())
-
-def parse_file_list(z):
-    z_orig = copy.deepcopy(z)
-    z = list(z or [])
-    result = []
-    while z:
-        f = z.pop()
-        if not f.startswith('@'):
-            result.append(f)
-        else:
-            z.extend(slurp_file(f[1:]).strip().split('\n'))
-    _log.info(f'parse_file_list: parsed {z_orig} as {result}')
-    return result[::-1]
+# * Reading intervals
+
+def read_intervals(intervals_file, chunk_size=1000000):
+    """Read the chrom, beg and end columns of a (possibly gzipped) bed file, parsing `chunk_size` lines at a time
+    into numpy arrays.
+
+    Returns:
+      a tuple (chroms, begs, ends) of arrays
+    """
+    chroms, begs, ends = [], [], []
+    try:
+        for chunk in pd.read_csv(intervals_file, sep=r'\s+', header=None, usecols=[0, 1, 2], comment='#',
+                                 dtype={0: str, 1: np.int64, 2: np.int64}, chunksize=chunk_size, compression='infer'):
+            chroms.append(chunk[0].to_numpy())
+            begs.append(chunk[1].to_numpy())
+            ends.append(chunk[2].to_numpy())
+    except pd.errors.EmptyDataError:
+        pass
+    if not chroms:
+        return np.array([], dtype=object), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(chroms), np.concatenate(begs), np.concatenate(ends)
+
+def read_chrom_sizes(chrom_sizes_file):
+    """Read a map from chrom name to chrom length from the first two columns of a .chrom.sizes or .fai file"""
+    chrom_sizes = pd.read_csv(chrom_sizes_file, sep='\t', header=None, usecols=[0, 1], dtype={0: str, 1: np.int64})
+    return dict(zip(chrom_sizes[0], chrom_sizes[1]))
+
+def _chrom_sort_key(chrom):
+    """Sort key that orders chroms naturally: chr2 before chr10, numbered chroms before chrX"""
+    chrom_num = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    return (0, int(chrom_num), '') if chrom_num.isdigit() else (1, 0, chrom_num)
+
+# * Interval sweeps
+
+def merge_intervals(begs, ends):
+    """Merge overlapping or bookended intervals on one chrom, in one sweep over the intervals sorted by beg.
+
+    Sorting is stable, which is linear-time for input that is already sorted, as bed files usually are.
+
+    Returns:
+      a tuple (merged_begs, merged_ends) of arrays of disjoint, non-adjacent intervals sorted by beg
+    """
+    if not len(begs):
+        return begs, ends
+    order = np.argsort(begs, kind='stable')
+    begs, ends = begs[order], ends[order]
+    # the furthest end reached by any interval so far; an interval starting past it starts a new merged interval
+    reach = np.maximum.accumulate(ends)
+    start_idxs = np.flatnonzero(np.concatenate(([True], begs[1:] > reach[:-1])))
+    return begs[start_idxs], reach[np.append(start_idxs[1:] - 1, len(begs) - 1)]
+
+def merge_chrom_intervals(chroms, begs, ends):
+    """Merge intervals separately on each chrom.
+
+    Returns:
+      map from chrom to the (merged_begs, merged_ends) of its intervals
+    """
+    chrom_codes, chrom_names = pd.factorize(chroms)
+    order = np.argsort(chrom_codes, kind='stable')
+    chrom_bounds = np.searchsorted(chrom_codes[order], np.arange(len(chrom_names) + 1))
+    return {chrom: merge_intervals(begs[order[chrom_beg:chrom_end]], ends[order[chrom_beg:chrom_end]])
+            for chrom, chrom_beg, chrom_end in zip(chrom_names, chrom_bounds[:-1], chrom_bounds[1:])}
+
+def covered_bp(merged_begs, merged_ends):
+    """Number of bp covered by disjoint intervals"""
+    return int((merged_ends - merged_begs).sum())
+
+def intersection_bp(merged1, merged2):
+    """Number of bp covered by both of two sets of merged intervals on one chrom.
+
+    Computed from the union, obtained by merging the two sets together: |A & B| = |A| + |B| - |A | B|.
+    """
+    union_bp = covered_bp(*merge_intervals(np.concatenate((merged1[0], merged2[0])),
+                                           np.concatenate((merged1[1], merged2[1]))))
+    return covered_bp(*merged1) + covered_bp(*merged2) - union_bp
+
+def jaccard(chrom2merged1, chrom2merged2):
+    """Jaccard index (bp in intersection over bp in union) of two genome-wide sets of merged intervals"""
+    inter_bp = sum(intersection_bp(chrom2merged1[chrom], chrom2merged2[chrom])
+                   for chrom in set(chrom2merged1) & set(chrom2merged2))
+    union_bp = sum(covered_bp(*merged) for merged in chrom2merged1.values()) + \
+        sum(covered_bp(*merged) for merged in chrom2merged2.values()) - inter_bp
+    return inter_bp / union_bp if union_bp else float('nan')
+
+# * Stats
+
+# bins for histograms of interval lengths: lengths below 1bp, then ten log-spaced bins per decade up to 1Gbp
+LEN_HIST_BIN_EDGES = (0.0,) + tuple(10 ** (i / 10) for i in range(91))
+
+def compute_one_file_stats(intervals_file, chunk_size):
+    """Compute summary stats, length and gap histograms, and the merged intervals, for one bed file"""
+    chroms, begs, ends = read_intervals(intervals_file, chunk_size=chunk_size)
+    lens = ends - begs
+    chk(np.all(lens >= 0), f'{intervals_file}: intervals with end before beg')
+    chrom2merged = merge_chrom_intervals(chroms, begs, ends)
+    # gaps between consecutive merged intervals on the same chrom
+    gaps = np.concatenate([merged_begs[1:] - merged_ends[:-1] for merged_begs, merged_ends in chrom2merged.values()]
+                          or [np.array([], dtype=np.int64)])
+    return dict(intervals_file=intervals_file,
+                n_intervals=len(lens),
+                tot_len=int(lens.sum()),
+                mean_len=float(lens.mean()) if len(lens) else float('nan'),
+                median_len=float(np.median(lens)) if len(lens) else float('nan'),
+                min_len=int(lens.min()) if len(lens) else None,
+                max_len=int(lens.max()) if len(lens) else None,
+                len_hist=np.histogram(np.minimum(lens, LEN_HIST_BIN_EDGES[-1]), bins=LEN_HIST_BIN_EDGES)[0],
+                chrom2merged=chrom2merged,
+                n_merged=sum(len(merged_begs) for merged_begs, _ in chrom2merged.values()),
+                chrom_covered_bp={chrom: covered_bp(*merged) for chrom, merged in chrom2merged.items()},
+                covered_bp=sum(covered_bp(*merged) for merged in chrom2merged.values()),
+                median_gap=float(np.median(gaps)) if len(gaps) else None,
+                gap_hist=np.histogram(np.minimum(gaps, LEN_HIST_BIN_EDGES[-1]), bins=LEN_HIST_BIN_EDGES)[0])
+
+# * Rendering
+
+def _fmt_bp(bp):
+    """Format a length in bp compactly, e.g. 1500000 -> '1.5M'"""
+    for scale, suffix in ((1e9, 'G'), (1e6, 'M'), (1e3, 'k')):
+        if bp >= scale:
+            return f'{bp/scale:g}{suffix}'
+    return f'{bp:g}'
+
+def svg_histogram(bin_edges, counts, title, width=640, height=220):
+    """Render a histogram with log-spaced bins as a self-contained svg element string.
+
+    All bins are drawn with equal widths, so the x axis is logarithmic in the bin edges.
+    """
+    margin_left, margin_bottom, margin_top = 50, 30, 20
+    plot_w, plot_h = width - margin_left - 10, height - margin_bottom - margin_top
+    bar_w = plot_w / len(counts)
+    max_count = max(1, int(np.max(counts))) if len(counts) else 1
+    elems = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-size="10">',
+             f'<text x="{width/2}" y="12" text-anchor="middle" font-size="12">{title}</text>',
+             f'<text x="2" y="{margin_top+8}">{max_count:,}</text>',
+             f'<line x1="{margin_left}" y1="{margin_top+plot_h}" x2="{margin_left+plot_w}" y2="{margin_top+plot_h}" '
+             'stroke="black"/>']
+    for bin_idx, count in enumerate(counts):
+        bar_x = margin_left + bin_idx * bar_w
+        if count:
+            bar_h = plot_h * count / max_count
+            elems.append(f'<rect x="{bar_x:.1f}" y="{margin_top+plot_h-bar_h:.1f}" width="{max(bar_w-0.5, 0.5):.1f}" '
+                         f'height="{bar_h:.1f}" fill="steelblue"><title>[{_fmt_bp(bin_edges[bin_idx])}, '
+                         f'{_fmt_bp(bin_edges[bin_idx+1])}): {count:,}</title></rect>')
+        if bin_edges[bin_idx] > 0 and abs(np.log10(bin_edges[bin_idx]) - round(np.log10(bin_edges[bin_idx]))) < 1e-6:
+            elems.append(f'<text x="{bar_x:.1f}" y="{height-margin_bottom+14}" text-anchor="middle">'
+                         f'{_fmt_bp(bin_edges[bin_idx])}</text>')
+    elems.append('</svg>')
+    return '\n'.join(elems)
+
+# * compute_intervals_stats
 
 def compute_intervals_stats(args):
-    with create_html_page(html_fname=args.intervals_report_html, title='Intervals report') as (doc, tags, txt, trow, raw, raw_w):
+    intervals_files = parse_file_list(args.intervals_files)
+    _log.info(f'parse_file_list: parsed {args.intervals_files} as {intervals_files}')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(len(intervals_files),
+                                                                       available_cpu_count()))) as executor:
+        files_stats = list(executor.map(functools.partial(compute_one_file_stats, chunk_size=args.chunk_size),
+                                        intervals_files))
+    file_names = [os.path.basename(file_stats['intervals_file']) for file_stats in files_stats]
+    chrom_sizes = read_chrom_sizes(args.chrom_sizes) if args.chrom_sizes else {}
+    chroms = sorted(set().union(*[file_stats['chrom_covered_bp'] for file_stats in files_stats]), key=_chrom_sort_key)
+
+    with create_html_page(html_fname=args.intervals_report_html, title='Intervals report') as (doc, tags, txt, trow, raw, raw_s):
         tags.h2('Intervals stats')
 
         if args.metadata_json:
             report_metadata = _json_loadf(args.metadata_json)
             tags.p(str(report_metadata))
-        
-        for intervals_file in parse_file_list(args.intervals_files):
+
+        with tags.table():
+            trow(['Intervals file', 'Intervals count', 'Total len', 'Mean len', 'Median len', 'Min len', 'Max len',
+                  'Merged intervals count', 'Covered bp', 'Median gap'], td_or_th=tags.th)
+            for file_name, file_stats in zip(file_names, files_stats):
+                trow([file_name] +
+                     [f'{file_stats[stat]:,.0f}' if file_stats[stat] is not None else ''
+                      for stat in ('n_intervals', 'tot_len', 'mean_len', 'median_len', 'min_len', 'max_len',
+                                   'n_merged', 'covered_bp', 'median_gap')])
+
+        tags.h2('Coverage by chrom')
+        with tags.table():
+            trow(['Chrom'] + (['Chrom len'] if chrom_sizes else []) + file_names, td_or_th=tags.th)
+            for chrom in chroms:
+                chrom_covered = [file_stats['chrom_covered_bp'].get(chrom, 0) for file_stats in files_stats]
+                if chrom in chrom_sizes:
+                    trow([chrom, f'{chrom_sizes[chrom]:,}'] +
+                         [f'{c:,} ({100*c/chrom_sizes[chrom]:.2f}%)' for c in chrom_covered])
+                else:
+                    trow([chrom] + ([''] if chrom_sizes else []) + [f'{c:,}' for c in chrom_covered])
+
+        if len(files_stats) > 1:
+            tags.h2('Pairwise overlap (Jaccard index of covered bp)')
+            with tags.table():
+                trow([''] + file_names, td_or_th=tags.th)
+                for file_name, file_stats in zip(file_names, files_stats):
+                    trow([file_name] + [f'{jaccard(file_stats["chrom2merged"], other_stats["chrom2merged"]):.4f}'
+                                        for other_stats in files_stats])
+
+        for file_name, file_stats in zip(file_names, files_stats):
             tags.hr()
-            tags.h3(f'Intervals file: {os.path.basename(intervals_file)}')
-
-            interval_lens = []
-            with open(intervals_file) as intervals_file_in:
-                for line in intervals_file_in:
-                    chrom, beg, end, *rest = line.strip().split()
-                    interval_lens.append(int(end) - int(beg))
-            tags.p(f'Intervals count: {len(interval_lens):,}; mean len: {int(np.mean(interval_lens)):,}; '
-                   f'median len: {int(np.median(interval_lens)):,} '
-                   f'min len: {np.min(interval_lens):,} '
-                   f'max len: {np.max(interval_lens):,} '
-                   f'tot len: {np.sum(interval_lens):,}')
-
-            plt.clf()
-            plt.hist(interval_lens, bins=60)
-            plt.title(os.path.basename(intervals_file))
-            html_insert_fig(tags)
+            tags.h3(f'Intervals file: {file_name}')
+            raw(svg_histogram(LEN_HIST_BIN_EDGES, file_stats['len_hist'], title=f'Interval lengths: {file_name}'))
+            raw(svg_histogram(LEN_HIST_BIN_EDGES, file_stats['gap_hist'],
+                              title=f'Gaps between merged intervals: {file_name}'))
+# end: def compute_intervals_stats(args)
 
 if __name__ == '__main__':
     compute_intervals_stats(parse_args())
-
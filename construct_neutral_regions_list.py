@@ -34,126 +34,18 @@ import time
 import urllib
 import urllib.request
 
+from misc_utils import (lazy_import, dump_file, _pretty_print_json, _write_json, _load_dict_sorted, _json_loads,
+                        _json_loadf, slurp_file, open_or_gzopen, available_cpu_count, execute)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
 _log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 MAX_INT32 = (2 ** 31)-1
 
-def dump_file(fname, value):
-    """store string in file"""
-    with open(fname, 'w')  as out:
-        out.write(str(value))
-
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
-
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
-
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
-
-def slurp_file(fname, maxSizeMb=50):
-    """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
-    than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
-    with open_or_gzopen(fname) as f:
-        return f.read()
-
-def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
-
-    # if this is a gzip file
-    if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
-    else:
-        return open(fname, *open_opts, **kwargs)
-
-def available_cpu_count():
-    """
-    Return the number of available virtual or physical CPUs on this system.
-    The number of available CPUs can be smaller than the total number of CPUs
-    when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
-
-    Adapted from http://stackoverflow.com/a/1006301/715090
-    """
-
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-
-def execute(action, **kw):
-    succeeded = False
-    try:
-        _log.debug('Running command: %s', action)
-        subprocess.check_call(action, shell=True, **kw)
-        succeeded = True
-    finally:
-        _log.debug('Returned from running command: succeeded=%s, command=%s', succeeded, action)
-
 def chk(cond, msg='condition failed'):
     if not cond:
         raise RuntimeError(f'Error: {msg}') 
@@ -180,6 +72,10 @@ def parse_args():
                         help='genomic feature files used in finding empirical neutral regions')
 
     parser.add_argument('--neutral-regions-bed', required=True, help='output file for neutral regions')
+    parser.add_argument('--dump-intermediate-beds', action='store_true',
+                        help='save the intermediate interval sets as numbered .bed files, for debugging')
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help='number of lines to parse at a time when streaming large annotation files')
 
     return parser.parse_args()
 
@@ -373,27 +269,148 @@ def wait_for_nre_results(driver, args):
 # submit contents
 #element.submit()
 
-def construct_full_chroms_bed(chrom_sizes, end_margin, full_chroms_bed):
-    with open(chrom_sizes) as chrom_sizes_in, open(full_chroms_bed, 'w') as full_chroms_bed_out:
+# * Interval algebra
+
+def _merge_intervals(starts, ends):
+    """Sort and merge overlapping or bookended intervals, dropping empty ones; returns arrays of merged starts and ends"""
+    nonempty = starts < ends
+    starts, ends = starts[nonempty], ends[nonempty]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.lexsort((ends, starts))
+    starts, ends = starts[order], ends[order]
+    ends_so_far = np.maximum.accumulate(ends)
+    group_begs = np.flatnonzero(np.r_[True, starts[1:] > ends_so_far[:-1]])
+    return starts[group_begs], np.maximum.reduceat(ends, group_begs)
+
+def _subtract_intervals(a_starts, a_ends, b_starts, b_ends):
+    """Subtract merged intervals b from merged intervals a, with one sweep over the sorted interval boundaries"""
+    if len(a_starts) == 0:
+        return a_starts, a_ends
+    # the state after each boundary is (1 if inside a) + (2 if inside b); we keep the segments where it is 1.
+    positions = np.concatenate([a_starts, a_ends, b_starts, b_ends])
+    deltas = np.concatenate([np.full(len(a_starts), 1), np.full(len(a_ends), -1),
+                             np.full(len(b_starts), 2), np.full(len(b_ends), -2)])
+    order = np.argsort(positions, kind='stable')
+    positions, states = positions[order], np.cumsum(deltas[order])
+    last_at_position = np.r_[positions[1:] != positions[:-1], True]
+    positions, states = positions[last_at_position], states[last_at_position]
+    keep = np.flatnonzero(states[:-1] == 1)
+    return _merge_intervals(positions[keep], positions[keep+1])
+
+class GenomicIntervals(object):
+    """A set of genomic intervals, kept in memory as sorted, merged, per-chrom numpy arrays of
+    0-based half-open starts and ends (as in .bed files).  Chroms are kept in order of first appearance.
+    """
+
+    def __init__(self, chrom2intervals=None):
+        self.chrom2intervals = collections.OrderedDict()
+        for chrom, (starts, ends) in (chrom2intervals or {}).items():
+            self.chrom2intervals[chrom] = _merge_intervals(np.asarray(starts, dtype=np.int64),
+                                                           np.asarray(ends, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, chroms, starts, ends):
+        """Construct from parallel arrays of chrom names, starts and ends"""
+        chroms = np.asarray(chroms, dtype=str)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        uniq_chroms, first_idxs = np.unique(chroms, return_index=True)
+        return cls(collections.OrderedDict((str(chrom), (starts[chroms == chrom], ends[chroms == chrom]))
+                                           for chrom in uniq_chroms[np.argsort(first_idxs)]))
+
+    @classmethod
+    def from_bed(cls, bed_fname, skip_rows=0, cols=(0, 1, 2)):
+        """Load intervals from the given columns (chrom, start, end) of a tab-separated file"""
+        bed = pd.read_csv(bed_fname, sep='\t', header=None, skiprows=skip_rows, usecols=list(cols),
+                          comment='#', dtype={cols[0]: str, cols[1]: np.int64, cols[2]: np.int64})
+        return cls.from_arrays(bed[cols[0]].to_numpy(), bed[cols[1]].to_numpy(), bed[cols[2]].to_numpy())
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Construct from an iterable of (chroms, starts, ends) array triples, merging as each chunk arrives
+        so that memory use is bounded by the size of the merged result plus one chunk"""
+        chrom2intervals = collections.OrderedDict()
+        for chroms, starts, ends in chunks:
+            for chrom, (chunk_starts, chunk_ends) in cls.from_arrays(chroms, starts, ends).chrom2intervals.items():
+                prev_starts, prev_ends = chrom2intervals.get(chrom, (chunk_starts[:0], chunk_ends[:0]))
+                chrom2intervals[chrom] = _merge_intervals(np.concatenate([prev_starts, chunk_starts]),
+                                                          np.concatenate([prev_ends, chunk_ends]))
+        return cls(chrom2intervals)
+
+    def subtract(self, other):
+        """Return the parts of these intervals not covered by `other`"""
+        empty = np.zeros(0, dtype=np.int64)
+        return GenomicIntervals(collections.OrderedDict(
+            (chrom, _subtract_intervals(starts, ends, *other.chrom2intervals.get(chrom, (empty, empty))))
+            for chrom, (starts, ends) in self.chrom2intervals.items()))
+
+    def pad(self, pad_bp, chrom_sizes):
+        """Extend each interval by `pad_bp` on both sides, clipped to the chrom bounds given by `chrom_sizes`"""
+        return GenomicIntervals(collections.OrderedDict(
+            (chrom, (np.maximum(starts - pad_bp, 0), np.minimum(ends + pad_bp, chrom_sizes.get(chrom, MAX_INT32))))
+            for chrom, (starts, ends) in self.chrom2intervals.items()))
+
+    def filter_by_len(self, min_len):
+        """Keep only intervals of length at least `min_len`"""
+        return GenomicIntervals(collections.OrderedDict(
+            (chrom, (starts[ends - starts >= min_len], ends[ends - starts >= min_len]))
+            for chrom, (starts, ends) in self.chrom2intervals.items()))
+
+    def total_bp(self):
+        return int(sum(np.sum(ends - starts) for starts, ends in self.chrom2intervals.values()))
+
+    def to_bed(self, bed_fname):
+        with open(bed_fname, 'w') as bed_out:
+            for chrom, (starts, ends) in self.chrom2intervals.items():
+                bed_out.writelines(f'{chrom}\t{start}\t{end}\n' for start, end in zip(starts.tolist(), ends.tolist()))
+# end: class GenomicIntervals(object)
+
+# * Constructing neutral regions
+
+def load_chrom_sizes(chrom_sizes):
+    """Load chrom sizes from a .chrom.sizes file"""
+    chrom2size = collections.OrderedDict()
+    with open(chrom_sizes) as chrom_sizes_in:
         for line in chrom_sizes_in:
             chrom, chrom_size = line.strip().split()
-            chrom_size = int(chrom_size)
-            chk(chrom.startswith('chr'), 'bad chrom start')
-            chrom_num = chrom[len('chr'):]
-            if is_int(chrom_num) and 1 <= int(chrom_num) <= 22:
-                full_chroms_bed_out.write(f'{chrom}\t{end_margin}\t{chrom_size-end_margin}\n')
-    return full_chroms_bed
-
-def construct_gaps_bed(gaps_txt_gz, gaps_bed):
-    execute(f'cat {gaps_txt_gz} | zcat | cut -f 2-4 > {gaps_bed}')
-
-def construct_genes_bed(genes_gff3, genes_pad_bp, chrom_sizes, genes_bed):
-    execute(f'cat {genes_gff3} | gunzip --stdout - | awk \'$3 == "gene"\' - '
-            f'| grep -v lncRNA | convert2bed -i gff - '
-            f'| bedtools slop -i stdin -g {chrom_sizes} -b {genes_pad_bp} > {genes_bed}')
-
-def construct_pophumanscan_bed(pophumanscan_coords, pophumanscan_bed):
-    execute(f"cat {pophumanscan_coords} | awk '(NR>1)' | cut -f 3-5 | sort -k1,1 -k2,2n | uniq > {pophumanscan_bed}")
+            chrom2size[chrom] = int(chrom_size)
+    return chrom2size
+
+def construct_full_chroms(chrom2size, end_margin):
+    """Construct intervals covering autosomes 1-22, except for `end_margin` at each end"""
+    full_chroms = collections.OrderedDict()
+    for chrom, chrom_size in chrom2size.items():
+        chk(chrom.startswith('chr'), 'bad chrom start')
+        chrom_num = chrom[len('chr'):]
+        if is_int(chrom_num) and 1 <= int(chrom_num) <= 22:
+            full_chroms[chrom] = ([end_margin], [chrom_size-end_margin])
+    return GenomicIntervals(full_chroms)
+
+def _read_tsv_chunks(fname, usecols, n_cols, chunk_size):
+    """Stream a (possibly gzipped) tab-separated file in chunks of `chunk_size` lines, keeping only the columns `usecols`
+    (as strings).  Comment lines (starting with #) are skipped."""
+    return pd.read_csv(fname, sep='\t', header=None, names=list(range(n_cols)), usecols=usecols, dtype=str,
+                       comment='#', quoting=csv.QUOTE_NONE, chunksize=chunk_size, compression='infer')
+
+def load_gaps(gaps_txt_gz, chunk_size):
+    """Load the UCSC gap track (telomeres, centromeres and assembly gaps)"""
+    def gaps_chunks():
+        for chunk in _read_tsv_chunks(gaps_txt_gz, usecols=[1, 2, 3], n_cols=9, chunk_size=chunk_size):
+            yield chunk[1].to_numpy(), chunk[2].astype(np.int64).to_numpy(), chunk[3].astype(np.int64).to_numpy()
+    return GenomicIntervals.from_chunks(gaps_chunks())
+
+def load_genes(genes_gff3, genes_pad_bp, chrom2size, chunk_size):
+    """Load the genes (other than lncRNAs) from a GFF3 file, padded by `genes_pad_bp` and clipped to chrom bounds"""
+    def genes_chunks():
+        for chunk in _read_tsv_chunks(genes_gff3, usecols=[0, 2, 3, 4, 8], n_cols=9, chunk_size=chunk_size):
+            chunk = chunk[(chunk[2] == 'gene') & ~chunk[8].str.contains('lncRNA', regex=False, na=False)]
+            chroms = chunk[0].to_numpy()
+            # GFF3 coords are 1-based and inclusive
+            starts = chunk[3].astype(np.int64).to_numpy() - 1
+            ends = chunk[4].astype(np.int64).to_numpy()
+            chrom_sizes = chunk[0].map(chrom2size).fillna(MAX_INT32).astype(np.int64).to_numpy()
+            yield chroms, np.maximum(starts - genes_pad_bp, 0), np.minimum(ends + genes_pad_bp, chrom_sizes)
+    return GenomicIntervals.from_chunks(genes_chunks())
 
 def construct_dgv_bed(dgv_bed):
     execute(f'wget https://hgdownload.soe.ucsc.edu/gbdb/hg19/dgv/dgvSupporting.bb')
@@ -404,30 +421,43 @@ def construct_neutral_regions_list(args):
     neut_reg_params = _json_loadf(args.empirical_neutral_regions_params)
     genomic_features = _json_loadf(args.genomic_features_for_finding_empirical_neutral_regions)
 
-    full_chroms_bed = construct_full_chroms_bed(chrom_sizes=genomic_features["chrom_sizes"],
-                                                end_margin=neut_reg_params["telomeres_pad_bp"],
-                                                full_chroms_bed='01.full_chroms.bed')
-    construct_gaps_bed(genomic_features["ucsc_gap_track"], '02.gaps.bed')
-    execute(f'bedtools subtract -a 01.full_chroms.bed -b 02.gaps.bed > 03.full_chroms.sub_gaps.bed')
-
-    construct_genes_bed(genes_gff3=genomic_features["gencode_annots"], chrom_sizes=genomic_features["chrom_sizes"],
-                        genes_pad_bp=neut_reg_params["genes_pad_bp"], genes_bed='04.genes.bed')
-    execute(f'bedtools subtract -a 03.full_chroms.sub_gaps.bed -b 04.genes.bed > 05.full_chroms.sub_gaps.sub_genes.bed')
-
-    construct_pophumanscan_bed(pophumanscan_coords=genomic_features["pophumanscan_coords"], pophumanscan_bed='06.pophumanscan.bed')
-    execute(f'bedtools subtract -a 05.full_chroms.sub_gaps.sub_genes.bed -b 06.pophumanscan.bed > '
-            f'07.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.bed')
-
-    construct_dgv_bed(dgv_bed='08.dgv.bed')
-    execute(f'bedtools subtract -a 07.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.bed -b 08.dgv.bed > '
-            f'09.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.bed')
-    
-
-    min_region_len_bp = neut_reg_params["min_region_len_bp"]
-    execute(f"awk '{{if($3-$2 >= {min_region_len_bp}) print}}' 09.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.bed "
-            f" > 10.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.len_filt.bed")
-
-    execute(f'cp 10.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.len_filt.bed {args.neutral_regions_bed}')
+    def dump_intervals(intervals, bed_fname):
+        if args.dump_intermediate_beds:
+            intervals.to_bed(bed_fname)
+        _log.info(f'{bed_fname}: {intervals.total_bp()=}')
+
+    chrom2size = load_chrom_sizes(genomic_features["chrom_sizes"])
+    neutral_regions = construct_full_chroms(chrom2size, end_margin=neut_reg_params["telomeres_pad_bp"])
+    dump_intervals(neutral_regions, '01.full_chroms.bed')
+
+    gaps = load_gaps(genomic_features["ucsc_gap_track"], chunk_size=args.chunk_size)
+    dump_intervals(gaps, '02.gaps.bed')
+    neutral_regions = neutral_regions.subtract(gaps)
+    dump_intervals(neutral_regions, '03.full_chroms.sub_gaps.bed')
+
+    genes = load_genes(genes_gff3=genomic_features["gencode_annots"], genes_pad_bp=neut_reg_params["genes_pad_bp"],
+                       chrom2size=chrom2size, chunk_size=args.chunk_size)
+    dump_intervals(genes, '04.genes.bed')
+    neutral_regions = neutral_regions.subtract(genes)
+    dump_intervals(neutral_regions, '05.full_chroms.sub_gaps.sub_genes.bed')
+
+    pophumanscan = GenomicIntervals.from_bed(genomic_features["pophumanscan_coords"], skip_rows=1, cols=(2, 3, 4))
+    dump_intervals(pophumanscan, '06.pophumanscan.bed')
+    neutral_regions = neutral_regions.subtract(pophumanscan)
+    dump_intervals(neutral_regions, '07.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.bed')
+
+    construct_dgv_bed(dgv_bed='dgv.tmp.bed')
+    dgv = GenomicIntervals.from_bed('dgv.tmp.bed')
+    dump_intervals(dgv, '08.dgv.bed')
+    neutral_regions = neutral_regions.subtract(dgv)
+    dump_intervals(neutral_regions, '09.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.bed')
+
+    neutral_regions = neutral_regions.filter_by_len(neut_reg_params["min_region_len_bp"])
+    dump_intervals(neutral_regions, '10.full_chroms.sub_gaps.sub_genes.sub_pophumanscan.sub_dgv.len_filt.bed')
+
+    neutral_regions.to_bed(args.neutral_regions_bed)
+    os.unlink('dgv.tmp.bed')
+# end: def construct_neutral_regions_list(args)
 
 if __name__ == '__main__':
     construct_neutral_regions_list(parse_args())
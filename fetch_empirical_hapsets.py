@@ -37,9 +37,13 @@ import subprocess
 import sys
 import tempfile
 import time
+import urllib.request
 
-import numpy as np
-import pandas as pd
+from misc_utils import (lazy_import, dump_file, _pretty_print_json, _write_json, _load_dict_sorted, _json_loads,
+                        _json_loadf, slurp_file, open_or_gzopen, available_cpu_count)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 # * Utils
 
@@ -49,112 +53,6 @@ logging.basicConfig(level=logging.DEBUG,
 
 MAX_INT32 = (2 ** 31)-1
 
-def dump_file(fname, value):
-    """store string in file"""
-    with open(fname, 'w')  as out:
-        out.write(str(value))
-
-def _pretty_print_json(json_val, sort_keys=True):
-    """Return a pretty-printed version of a dict converted to json, as a string."""
-    return json.dumps(json_val, indent=4, separators=(',', ': '), sort_keys=sort_keys)
-
-def _write_json(fname, json_val):
-    dump_file(fname=fname, value=_pretty_print_json(json_val))
-
-def _load_dict_sorted(d):
-    return collections.OrderedDict(sorted(d.items()))
-
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
-
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
-
-
-def slurp_file(fname, maxSizeMb=50):
-    """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
-    than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
-    large files.  If `maxSizeMb` is None or 0, file size is unlimited."""
-    fileSize = os.path.getsize(fname)
-    if maxSizeMb  and  fileSize > maxSizeMb*1024*1024:
-        raise RuntimeError('Tried to slurp large file {} (size={}); are you sure?  Increase `maxSizeMb` param if yes'.
-                           format(fname, fileSize))
-    with open_or_gzopen(fname) as f:
-        return f.read()
-
-def open_or_gzopen(fname, *opts, **kwargs):
-    mode = 'r'
-    open_opts = list(opts)
-    assert type(mode) == str, "open mode must be of type str"
-
-    # 'U' mode is deprecated in py3 and may be unsupported in future versions,
-    # so use newline=None when 'U' is specified
-    if len(open_opts) > 0:
-        mode = open_opts[0]
-        if sys.version_info[0] == 3:
-            if 'U' in mode:
-                if 'newline' not in kwargs:
-                    kwargs['newline'] = None
-                open_opts[0] = mode.replace("U","")
-
-    # if this is a gzip file
-    if fname.endswith('.gz'):
-        # if text read mode is desired (by spec or default)
-        if ('b' not in mode) and (len(open_opts)==0 or 'r' in mode):
-            # if python 2
-            if sys.version_info[0] == 2:
-                # gzip.open() under py2 does not support universal newlines
-                # so we need to wrap it with something that does
-                # By ignoring errors in BufferedReader, errors should be handled by TextIoWrapper
-                return io.TextIOWrapper(io.BufferedReader(gzip.open(fname)))
-
-        # if 't' for text mode is not explicitly included,
-        # replace "U" with "t" since under gzip "rb" is the
-        # default and "U" depends on "rt"
-        gz_mode = str(mode).replace("U","" if "t" in mode else "t")
-        gz_opts = [gz_mode]+list(opts)[1:]
-        return gzip.open(fname, *gz_opts, **kwargs)
-    else:
-        return open(fname, *open_opts, **kwargs)
-
-def available_cpu_count():
-    """
-    Return the number of available virtual or physical CPUs on this system.
-    The number of available CPUs can be smaller than the total number of CPUs
-    when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
-
-    Adapted from http://stackoverflow.com/a/1006301/715090
-    """
-
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-
 def execute(cmd, retries=0, retry_delay=0, **kw):
     succeeded = False
     attempt = 0
@@ -269,7 +167,7 @@ def string_to_file_name(string_value, file_system_path=None, length_margin=0):
 def parse_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--empirical-regions-bed', required=True, help='empirical regions bed file')
+    parser.add_argument('--empirical-regions-bed', help='empirical regions bed file')
     parser.add_argument('--sel-pop',
                         help='only use regions with putative selection in this pop; if not specified, treat all regions as neutral')
     parser.add_argument('--phased-vcfs-url-template',
@@ -282,14 +180,25 @@ def parse_args():
     parser.add_argument('--related-individuals-url',
                         default='ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/release/20130502/20140625_related_individuals.txt',
                         help='list of individuals related to other 1KG individuals, to be dropped from analysis')
-    parser.add_argument('--genetic-maps-tar-gz', required=True, help='genetic maps')
+    parser.add_argument('--unrelated-individuals-cache-dir',
+                        help='directory for caching the choice of unrelated individuals (default: --tmp-dir)')
+    parser.add_argument('--genetic-maps-tar-gz', help='genetic maps')
     parser.add_argument('--pops-data-url', default='ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/phase3/20131219.populations.tsv',
                         help='info on pops and superpops')
     #parser.add_argument('--pops-outgroups-json', required=True, help='map from pop to pops to use as outgroups')
-    parser.add_argument('--superpop-to-representative-pop-json', required=True,
+    parser.add_argument('--superpop-to-representative-pop-json',
                         help='map from superpop to representative sub-pop used in model-fitting')
+    parser.add_argument('--sample-panel',
+                        help='sample panel constructed by --out-sample-panel; if given, the pedigree, pops data, '
+                        'superpop-to-representative-pop and genetic maps inputs are taken from it')
+    parser.add_argument('--out-sample-panel',
+                        help='only construct the sample panel (unrelated samples, their vcf columns for each pop, '
+                        'outgroups and genetic maps), save it to this file and exit')
+    parser.add_argument('--sample-panel-vcf-header-chrom', default='22',
+                        help='chrom whose phased vcf header is used to determine the vcf columns of samples '
+                        'when constructing the sample panel')
     parser.add_argument('--tmp-dir', default='.', help='directory for temp files')
-    parser.add_argument('--out-fnames-prefix', required=True, help='prefix for output filenames')
+    parser.add_argument('--out-fnames-prefix', help='prefix for output filenames')
     return parser.parse_args()
 
 # * def load_empirical_regions_bed(empirical_regions_bed)
@@ -337,49 +246,109 @@ def fetch_one_chrom_regions_phased_vcf(chrom, regions, phased_vcfs_url_template,
     return chrom_regions_vcf
 
 
-# * def gather_unrelated_individuals(ped_data, related_individuals_url)
-def gather_unrelated_individuals(ped_data, related_individuals_url):
-    """Pick a subset of the 1KG individuals such that no two are known to be related."""
+# * def fetch_url_bytes(url)
+def fetch_url_bytes(url):
+    """Return the raw contents of a local file or of a URL"""
+    if os.path.isfile(url):
+        with open(url, 'rb') as f:
+            return f.read()
+    with urllib.request.urlopen(url) as f:
+        return f.read()
+
+# * def gather_unrelated_individuals(pedigree_data_url, related_individuals_url, cache_dir)
+def _parse_relatives_col(col):
+    """Parse a column of quoted, comma-separated lists of relatives (or '0' for none) into one list per row"""
+    col = col.fillna('0').astype(str).str.strip().str.strip('"')
+    return col.where(col != '0', '').str.split(',')
+
+def select_unrelated_individuals(ped_data, related_sample_ids):
+    """Pick a subset of the 1KG individuals such that no two are known to be related.
 
-    related_individuals = pd.read_table(related_individuals_url)
+    Builds an undirected relationship graph over all samples in the pedigree, from the Siblings, Second_Order
+    and Third_Order columns, then greedily picks a maximal independent set among eligible samples (founders
+    not listed in `related_sample_ids`), going through the samples in pedigree order so that the result is
+    deterministic.
+
+    Args:
+      ped_data: the pedigree table, with spaces in column names replaced by underscores
+      related_sample_ids: IDs of samples known to be related to other samples
+    Returns:
+      list of IDs of the chosen samples, in pedigree order
+    """
+    sample_ids = ped_data['Individual_ID'].to_numpy()
+    sample2idx = pd.Series(np.arange(len(sample_ids)), index=sample_ids)
+    sample2idx = sample2idx[~sample2idx.index.duplicated()]
+
+    edges = []
+    for col in ('Siblings', 'Second_Order', 'Third_Order'):
+        rels = pd.DataFrame({'src': np.arange(len(sample_ids)),
+                             'dst': _parse_relatives_col(ped_data[col]).to_numpy()}).explode('dst')
+        rels['dst'] = rels['dst'].str.strip()
+        rels = rels[rels['dst'].isin(sample2idx.index)]
+        edges.append(np.stack([rels['src'].to_numpy(dtype=np.int64),
+                               sample2idx[rels['dst']].to_numpy(dtype=np.int64)]))
+    edges = np.concatenate(edges, axis=1)
+    edges = np.concatenate([edges, edges[::-1]], axis=1)  # relationships are symmetric
+
+    # adjacency lists in CSR form
+    edges = edges[:, np.argsort(edges[0], kind='stable')]
+    adj_ptr = np.searchsorted(edges[0], np.arange(len(sample_ids)+1))
+    adj = edges[1]
+
+    eligible = (~ped_data['Individual_ID'].isin(related_sample_ids)) & \
+        (ped_data['Paternal_ID'].astype(str) == '0') & \
+        (ped_data['Maternal_ID'].astype(str) == '0') & \
+        (ped_data['Relationship'] != 'child')
+    _log.debug(f'{len(ped_data)=} {int(eligible.sum())=} {edges.shape[1]=}')
+
+    related_to_kept = np.zeros(len(sample_ids), dtype=bool)
+    keep = np.zeros(len(sample_ids), dtype=bool)
+    for sample_idx in np.flatnonzero(eligible.to_numpy()):
+        if related_to_kept[sample_idx]:
+            _log.debug(f'skipping {sample_ids[sample_idx]} due to a relative already kept')
+            continue
+        keep[sample_idx] = True
+        related_to_kept[adj[adj_ptr[sample_idx]:adj_ptr[sample_idx+1]]] = True
+
+    _log.debug(f'{int(keep.sum())-len(ped_data)=}')
+    return list(sample_ids[keep])
+# end: def select_unrelated_individuals(ped_data, related_sample_ids)
+
+# version of the algorithm in select_unrelated_individuals(); bump it when the algorithm changes, so that selections
+# cached by earlier versions are not reused
+UNRELATED_INDIVIDUALS_SELECTION_VERSION = 2
+
+def gather_unrelated_individuals(pedigree_data_url, related_individuals_url, cache_dir):
+    """Load the 1KG pedigree and pick a subset of the individuals such that no two are known to be related.
+
+    The selection is cached in `cache_dir`, keyed by the hash of the pedigree and related-individuals files and by
+    UNRELATED_INDIVIDUALS_SELECTION_VERSION, so repeated invocations on the same inputs reuse it.
 
-    orig_len = len(ped_data)
+    Returns:
+      the pedigree table (with spaces in column names replaced by underscores) restricted to the chosen individuals
+    """
+    pedigree_data_bytes = fetch_url_bytes(pedigree_data_url)
+    related_individuals_bytes = fetch_url_bytes(related_individuals_url)
+
+    ped_data = pd.read_table(io.BytesIO(pedigree_data_bytes), dtype=str)
     ped_data = ped_data.rename(columns={c: c.replace(' ', '_') for c in ped_data.columns})
-    ped_data = ped_data[(~ped_data['Individual_ID'].isin(related_individuals['Sample '])) & \
-                        (ped_data['Paternal_ID'] == '0') & \
-                        (ped_data['Maternal_ID'] == '0') & \
-                        (ped_data['Relationship'] != 'child')]
-
-    _log.debug(f'{len(ped_data)-orig_len=}')
-
-    keep = []
-    related_to_kept = set()
-    skip_reasons = collections.defaultdict(list)
-    _log.debug(ped_data.columns)
-    for row in ped_data.itertuples():
-        r = row._asdict()
-        this_id = r['Individual_ID']
-        keep_this = False
-        if this_id not in related_to_kept:
-            keep_this = True
-            for col in ('Siblings', 'Second_Order', 'Third_Order'):
-                val = r[col].strip()
-                if val != '0':
-                    if val.startswith('"'):
-                        val = val[1:]
-                    if val.endswith('"'):
-                        val = val[:-1]
-                    for rel in val.split(','):
-                        related_to_kept.add(rel)
-                        skip_reasons[rel].append(this_id)
-        if not keep_this:
-            _log.debug(f'skipping {this_id} due to {skip_reasons[this_id]}')
-        keep.append(keep_this)
-    ped_data = ped_data[keep]
-    _log.debug(f'{len(ped_data)-orig_len=}')
-
-    return ped_data
-# end: def gather_unrelated_individuals(ped_data, related_individuals_url)
+
+    cache_key = hashlib.sha256(pedigree_data_bytes + b'\0' + related_individuals_bytes).hexdigest()
+    cache_fname = os.path.join(cache_dir,
+                               f'unrelated_individuals.v{UNRELATED_INDIVIDUALS_SELECTION_VERSION}.{cache_key}.json')
+    if os.path.isfile(cache_fname):
+        _log.info(f'Reusing unrelated individuals from {cache_fname}')
+        unrelated_sample_ids = _json_loadf(cache_fname)['unrelated_sample_ids']
+    else:
+        related_individuals = pd.read_table(io.BytesIO(related_individuals_bytes), dtype=str)
+        unrelated_sample_ids = select_unrelated_individuals(ped_data, related_individuals['Sample '].str.strip())
+        # write to a temp file and rename, so that a task preempted mid-write does not leave a truncated cache file
+        cache_fname_tmp = f'{cache_fname}.tmp{os.getpid()}'
+        _write_json(fname=cache_fname_tmp, json_val={'unrelated_sample_ids': unrelated_sample_ids})
+        os.replace(cache_fname_tmp, cache_fname)
+
+    return ped_data[ped_data['Individual_ID'].isin(unrelated_sample_ids)]
+# end: def gather_unrelated_individuals(pedigree_data_url, related_individuals_url, cache_dir)
 
 # * def get_pop2vcfcols(samples_ped_data, pops_data, vcf_cols)
 def get_pop2vcfcols(samples_ped_data, pops_data, vcf_cols):
@@ -419,32 +388,48 @@ def compute_outgroup_pops(pops_data, superpop_to_representative_pop):
     return dict(pop2outgroup_pops)
 # end: def compute_outgroup_pops(pops_data, superpop_to_representative_pop)
 
+# * genetic maps
+def unpack_genetic_maps(genetic_maps_tar_gz, tmp_dir):
+    """Unpack the genetic maps tarball into tmp_dir, if not already unpacked there; return the unpacked dir"""
+    genmaps_dir = os.path.join(os.path.realpath(tmp_dir), 'genmaps')
+    if not os.path.isdir(genmaps_dir):
+        os.mkdir(genmaps_dir)
+        execute(f'tar xvzf {genetic_maps_tar_gz} -C {genmaps_dir}')
+    return genmaps_dir
+
+def load_genetic_map(genmap_fname):
+    """Load one hapmap-format genetic map, returning arrays of basepair positions and the corresponding cM positions"""
+    genmap_data = pd.read_table(genmap_fname)
+    # convert once here, rather than on every lookup
+    return (genmap_data['Position(bp)'].to_numpy(dtype=np.float64),
+            genmap_data['Map(cM)'].to_numpy(dtype=np.float64))
+
 # * class GeneticMaps()
 class GeneticMaps(object):
     """Keeps track of genetic maps and provides interpolation"""
 
-    def __init__(self, genetic_maps_tar_gz, superpop_to_representative_pop, tmp_dir):
-        tmp_dir = os.path.realpath(tmp_dir)
-        self.genmaps_dir = os.path.join(tmp_dir, 'genmaps')
-        if not os.path.isdir(self.genmaps_dir):
-            os.mkdir(self.genmaps_dir)
-            execute(f'tar xvzf {genetic_maps_tar_gz} -C {self.genmaps_dir}')
+    def __init__(self, genetic_maps_tar_gz, superpop_to_representative_pop, tmp_dir, sample_panel=None):
         self.pop_chrom_to_genmap = {}
         self.superpop_to_representative_pop = superpop_to_representative_pop
+        self.sample_panel = sample_panel
+        if sample_panel is None:
+            self.genmaps_dir = unpack_genetic_maps(genetic_maps_tar_gz, tmp_dir)
 
     def __call__(self, chrom, pos, pop):
         if pop in self.superpop_to_representative_pop:
             pop = self.superpop_to_representative_pop[pop]
             # TODO: weigh genmap based on relative sample sizes
         if (pop, chrom) not in self.pop_chrom_to_genmap:
-            self.pop_chrom_to_genmap[(pop, chrom)] = \
-                pd.read_table(os.path.join(self.genmaps_dir, 'hg19', pop,
-                                           f'{pop}_recombination_map_hapmap_format_hg19_chr_{chrom}.txt'))
+            if self.sample_panel is not None:
+                self.pop_chrom_to_genmap[(pop, chrom)] = self.sample_panel.get_genmap(pop=pop, chrom=chrom)
+            else:
+                self.pop_chrom_to_genmap[(pop, chrom)] = \
+                    load_genetic_map(os.path.join(self.genmaps_dir, 'hg19', pop,
+                                                  f'{pop}_recombination_map_hapmap_format_hg19_chr_{chrom}.txt'))
         # TODO: add check np.all(np.diff(xp) > 0)
         #return np.float64(239.239)
-        return np.interp(np.float64(pos),
-                         xp=self.pop_chrom_to_genmap[(pop, chrom)]['Position(bp)'].astype(np.float64),
-                         fp=self.pop_chrom_to_genmap[(pop, chrom)]['Map(cM)'].astype(np.float64))
+        xp, fp = self.pop_chrom_to_genmap[(pop, chrom)]
+        return np.interp(np.float64(pos), xp=xp, fp=fp)
             
 # end: class GeneticMaps(object)
 
@@ -489,155 +474,268 @@ def determine_ancestral_allele(info_dict, all_alleles, stats):
     return allele2anc
 # end: def determine_ancestral_allele(info_dict, all_alleles, stats)
 
-# * construct_hapset_for_one_empirical_region
-def construct_hapset_for_one_empirical_region(region_key, region_lines, region_sel_pop, pops_to_include, pop2vcfcols,
-                                              pop2samples, genmap, stats, tmp_dir, out_fnames_prefix):
-    """Given one empirical region and the pops in which it is putatively been under selection,
-    for each such pop, create a hapset.
+# * decode_vcf_line
+_GT_RE = re.compile(r'([0-2])\|([0-2])')
+
+def decode_vcf_line(vcf_line, n_samples, used_samples, stats):
+    """Parse one vcf line into a compact genotype row, so that it can be shared by all hapsets that include it.
+
+    Args:
+      vcf_line: one data line of the vcf
+      n_samples: number of sample columns in the vcf
+      used_samples: array of indices (from 0, among the sample columns) of samples included in any hapset
+      stats: count of various scenarios
+    Returns:
+      None if the variant should be skipped, else a tuple (chrom, pos, anc_gts), where anc_gts is an
+      int8 array of shape (n_samples, 2) giving for each haplotype 1 if it carries the ancestral allele,
+      0 if it carries the derived allele, and -1 if the genotype could not be parsed.
+    """
+    chrom, pos, id_, ref, alt, qual, filter_, info, format_, sample_data_str = vcf_line.split(sep='\t', maxsplit=9)
+    pos = int(pos)
+    info_dict = dict(inf.split(sep='=', maxsplit=1) for inf in info.split(';') if '=' in inf)
+    if info_dict['VT'] != 'SNP':
+        # TODO: handle VT=SNP,INDEL
+        return None
+    alts = alt.split(',')
+    all_alleles = [a.upper() for a in ([ref] + alts)]
+
+    if has_bad_allele(all_alleles):
+        stats['bad_allele'] += 1
+        return None
+
+    if not format_.startswith('GT'):
+        stats['bad_format'] += 1
+        return None
+
+    # determine the ancestral allele
+    allele2anc = determine_ancestral_allele(info_dict=info_dict, all_alleles=all_alleles, stats=stats)
+    # allele index -> 1 for ancestral, 0 for derived, -1 for allele indices not present at this site
+    anc_lookup = np.array([int(allele2anc[str(i)]) if i < len(all_alleles) else -1 for i in range(3)], dtype=np.int8)
+
+    sample_data_str = sample_data_str.rstrip('\n')
+    anc_gts = np.full((n_samples, 2), -1, dtype=np.int8)
+    if format_ == 'GT' and len(sample_data_str) == 4*n_samples - 1:
+        # fast path: every genotype is of the form a|b, so the line can be decoded as a fixed-width byte array
+        gt_bytes = np.frombuffer((sample_data_str + '\t').encode('ascii'), dtype=np.uint8).reshape(n_samples, 4)
+        allele_idxs = gt_bytes[:, [0, 2]].astype(np.int16) - ord('0')
+        gt_ok = (gt_bytes[:, 1] == ord('|')) & (gt_bytes[:, 3] == ord('\t')) & \
+            np.all((allele_idxs >= 0) & (allele_idxs <= 2), axis=1)
+        anc_gts[gt_ok] = anc_lookup[allele_idxs[gt_ok]]
+    else:
+        sample_data = sample_data_str.split('\t')
+        chk(len(sample_data) == n_samples, f'gt issue: {pos=} {n_samples=} {len(sample_data)=}')
+        for sample_idx in used_samples:
+            gt_match = _GT_RE.match(sample_data[sample_idx].split(':', maxsplit=1)[0])
+            if gt_match:
+                anc_gts[sample_idx] = anc_lookup[[int(gt_match.group(1)), int(gt_match.group(2))]]
+
+    n_bad_gts = int(np.count_nonzero(np.any(anc_gts[used_samples] < 0, axis=1)))
+    if n_bad_gts:
+        _log.warning(f'BAD GT: {chrom=} {pos=} {n_bad_gts=}')
+
+    return chrom, pos, anc_gts
+# end: def decode_vcf_line(vcf_line, n_samples, used_samples, stats)
+
+# * class EmpiricalHapsetWriter
+class EmpiricalHapsetWriter(object):
+    """Incrementally constructs the hapset for one empirical region and one pop in which the region
+    is putatively under selection, from decoded vcf lines as they stream by.
 
     Args:
       region_key: a string of the form chr:beg-end defining the extent of the region
-      region_lines: a list of vcf lines for the region
       region_sel_pop: pop in which the region is selected (or None if neutral)
       pops_to_include: pops to include in the hapset
       pop2vcfcols: map from pop to the vcf cols containing data for samples from that pop
       pop2samples: map from pop to the headings of vcf cols containing data for samples from that pop
       genmap: callable mapping basepair position to genetic map position in centimorgans
+      stats: count of various scenarios
       tmp_dir: temp dir to use
-    Returns:
-      path to a .tar.gz of the hapset
+      out_fnames_prefix: prefix for the hapset name
     """
-    _log.debug(f'in comstruct_hapset_for_one_empirical_region_and_one_selpop: '
-               f'{region_key=} {len(region_lines)=} {region_sel_pop=} {pops_to_include=} {pop2vcfcols=} {stats=}')
-    tmp_dir = os.path.realpath(tmp_dir)
-    hapset_name = string_to_file_name(f'{out_fnames_prefix}_hg19_{region_key}_{region_sel_pop}')
-    hapset_dir = os.path.join(tmp_dir, hapset_name)
-    if not os.path.isdir(hapset_dir):
-        os.mkdir(hapset_dir)
-    all_pops = pops_to_include # [region_sel_pop] + list(outgroup_pops)
-    tped_fnames = [os.path.join(hapset_dir, string_to_file_name(f'{hapset_name}_{pop}.tped')) for pop in all_pops]
-    _log.debug(f'{tped_fnames=}')
-    with contextlib.ExitStack() as exit_stack:
-        tpeds = [exit_stack.enter_context(open(tped_fname, 'w')) for tped_fname in tped_fnames]
-        region_beg = None
-        region_offset = None
-        region_end = None
-        n_variants = 0
-        for vcf_line_num, vcf_line in enumerate(region_lines):
-            #
-            # CEU, CHB, YRI, BEB
-            # subsample?
-            #
-            chrom, pos, id_, ref, alt, qual, filter_, info, format_, sample_data_str = vcf_line.split(sep='\t', maxsplit=9)
-            pos = int(pos)
-            info_dict = dict(inf.split(sep='=', maxsplit=1) for inf in info.split(';') if '=' in inf)
-            if info_dict['VT'] != 'SNP':
-                # TODO: handle VT=SNP,INDEL
-                continue
-            alts = alt.split(',')
-            all_alleles = [a.upper() for a in ([ref] + alts)]
-            
-            if has_bad_allele(all_alleles):
-                stats['bad_allele'] += 1
-                continue
 
-            if not format_.startswith('GT'):
-                stats['bad_format'] += 1
-                continue
+    def __init__(self, region_key, region_sel_pop, pops_to_include, pop2vcfcols,
+                 pop2samples, genmap, stats, tmp_dir, out_fnames_prefix):
+        _log.debug(f'in EmpiricalHapsetWriter: '
+                   f'{region_key=} {region_sel_pop=} {pops_to_include=} {stats=}')
+        tmp_dir = os.path.realpath(tmp_dir)
+        self.tmp_dir = tmp_dir
+        self.region_sel_pop = region_sel_pop
+        self.all_pops = pops_to_include # [region_sel_pop] + list(outgroup_pops)
+        self.pop2samples = pop2samples
+        self.genmap = genmap
+        self.stats = stats
+
+        self.hapset_name = string_to_file_name(f'{out_fnames_prefix}_hg19_{region_key}_{region_sel_pop}')
+        self.hapset_dir = os.path.join(tmp_dir, self.hapset_name)
+        if not os.path.isdir(self.hapset_dir):
+            os.mkdir(self.hapset_dir)
+
+        self.pop_sample_idxs = [np.array(pop2vcfcols[pop], dtype=np.int64) - 9 for pop in self.all_pops]
+        self.hapset_sample_idxs = np.concatenate(self.pop_sample_idxs)
+        self.pop_sample_sizes = {pop: 2*len(pop_sample_idxs)
+                                 for pop, pop_sample_idxs in zip(self.all_pops, self.pop_sample_idxs)}
+
+        self.tped_fnames = [os.path.join(self.hapset_dir, string_to_file_name(f'{self.hapset_name}_{pop}.tped'))
+                            for pop in self.all_pops]
+        _log.debug(f'{self.tped_fnames=}')
+        self.exit_stack = contextlib.ExitStack()
+        self.tpeds = [self.exit_stack.enter_context(open(tped_fname, 'w')) for tped_fname in self.tped_fnames]
+
+        self.region_beg = None
+        self.region_offset = None
+        self.region_end = None
+        self.n_variants = 0
+
+    def add_variant(self, chrom, pos, vcf_line_num, anc_gts):
+        """Add one decoded vcf line (see decode_vcf_line()) to the hapset, if it is informative for this hapset's pops"""
+        hapset_gts = anc_gts[self.hapset_sample_idxs]
+        if np.any(hapset_gts < 0):
+            self.stats['bad_gt'] += 1
+            return
+        if not np.any(hapset_gts == 1):
+            self.stats['no_ancestral_gts'] += 1
+            return
+        if not np.any(hapset_gts == 0):
+            self.stats['no_derived_gts'] += 1
+            return
+
+        for pop, tped, pop_sample_idxs in zip(self.all_pops, self.tpeds, self.pop_sample_idxs):
+            pop_gts = ' ' + ' '.join((anc_gts[pop_sample_idxs].ravel() + ord('0')).astype(np.uint8).tobytes().decode('ascii'))
+            cm_pos = self.genmap(chrom=chrom, pos=pos, pop=pop)
+
+            if self.region_offset is None:
+                self.region_offset = pos
+
+            pos_from_offset = pos - self.region_offset
+
+            if self.region_beg is None:
+                self.region_beg = pos_from_offset
+            self.region_end = pos_from_offset
+
+            self.n_variants += 1
+            tped.write(f'1 {vcf_line_num} {cm_pos} {pos_from_offset} {pop_gts}\n')
+    # end: def add_variant(self, chrom, pos, vcf_line_num, anc_gts)
+
+    def finish(self):
+        """Close the tpeds, write the hapset manifest, and bundle the hapset.
+
+        Returns:
+          path to a .tar.gz of the hapset
+        """
+        self.exit_stack.close()
+
+        # construct a manifest json, including region_beg
+        # maybe also represent with region_beg_cm for symmetry
+
+        # specify that it's a real region etc
+        # then, tar it up, with either tar command or the tarfile module.
+        hapset_manifest = {
+            'hapset_id': self.hapset_name,
+            'region_offset': self.region_offset,
+            'region_beg': self.region_beg,
+            'region_end': self.region_end,
+            'n_variants': self.n_variants,
+            'simulated': False,
+            'selection': True,
+            'selpop': self.region_sel_pop,
+            'tpeds': {
+                pop: os.path.basename(tped_fname) for pop, tped_fname in zip(self.all_pops, self.tped_fnames)
+            },
+            'popIds': self.all_pops,
+            'pop_sample_sizes': self.pop_sample_sizes,
+            'tpedFiles': [os.path.basename(tped_fname) for tped_fname in self.tped_fnames],
+            'pop2samples': self.pop2samples
+        }
+        _write_json(fname=os.path.join(self.hapset_dir, string_to_file_name(f'{self.hapset_name}.replicaInfo.json')),
+                    json_val=hapset_manifest)
+        hapset_tar_gz = os.path.join(self.tmp_dir, f'{self.hapset_name}.hapset.tar.gz')
+        execute(f'tar cvfz {hapset_tar_gz} -C {self.hapset_dir} .')
+        return hapset_tar_gz
+    # end: def finish(self)
+# end: class EmpiricalHapsetWriter(object)
+
+# * class SamplePanel
+class SamplePanel(object):
+    """The choice of 1KG samples to use, their grouping into pops, the outgroups of each pop, and the genetic maps.
+
+    These are the same for every shard of a scatter over sel pops, so they are computed once (see
+    construct_sample_panel()) and saved in an uncompressed .npz file.  Arrays in the file are only read when
+    accessed, so a shard reads just the genetic maps it needs.
+    """
 
-            # determine the ancestral allele
-            allele2anc = determine_ancestral_allele(info_dict=info_dict, all_alleles=all_alleles, stats=stats)
-            
-            sample_data = sample_data_str.strip().split('\t')
-
-            pops_genotypes = []
-            gt_re = re.compile(r'([0-2])\|([0-2])')
-            bad_gt = False
-            has_ancestral = False
-            has_derived = False
-            pop_sample_sizes = collections.Counter()
-            for pop in all_pops:
-                pop_gts = ''
-                for vcf_col in pop2vcfcols[pop]:
-                    try:
-                        gt = sample_data[vcf_col-9].split(':', maxsplit=1)[0]
-                    except IndexError:
-                        _log.warning(f'gt issue: {vcf_line_num=} {pos=} {vcf_col=} {len(sample_data)=}')
-                        raise
-                    gt_match = gt_re.match(gt)
-                    if not gt_match:
-                        bad_gt = True
-                        _log.warning(f'BAD GT: {gt=} {vcf_col=} {vcf_line_num=} {pos=}')
-                        break
-                    for gt_grp_idx in (1,2):
-                        ancestral_or_not = allele2anc[gt_match.group(gt_grp_idx)]
-                        if ancestral_or_not == '1':
-                            has_ancestral = True
-                        if ancestral_or_not == '0':
-                            has_derived = True
-                        pop_gts += (' ' + ancestral_or_not)
-                        pop_sample_sizes[pop] += 1
-                # end: for vcf_col in pop2vcfcols[pop]
-                if bad_gt:
-                    break
-                pops_genotypes.append(pop_gts)
-            # end: for pop in all_pops
-
-            if bad_gt:
-                stats['bad_gt'] += 1
-                continue
-            if not has_ancestral:
-                stats['no_ancestral_gts'] += 1
-                continue
-            if not has_derived:
-                stats['no_derived_gts'] += 1
-                continue
-
-            for pop, tped, pop_gts in zip(all_pops, tpeds, pops_genotypes):
-                cm_pos = genmap(chrom=chrom, pos=pos, pop=pop)
-
-                if region_offset is None:
-                    region_offset = pos
-
-                pos_from_offset = pos - region_offset
-
-                if region_beg is None:
-                    region_beg = pos_from_offset
-                region_end = pos_from_offset
-
-                n_variants += 1
-                tped.write(f'1 {vcf_line_num} {cm_pos} {pos_from_offset} {pop_gts}\n')
-        # end: for vcf_line in region_lines:
-    # end: with contextlib.ExitStack() as exit_stack:
-
-    # construct a manifest json, including region_beg
-    # maybe also represent with region_beg_cm for symmetry
-
-    # specify that it's a real region etc
-    # then, tar it up, with either tar command or the tarfile module.
-    hapset_manifest = {
-        'hapset_id': hapset_name,
-        'region_offset': region_offset,
-        'region_beg': region_beg,
-        'region_end': region_end,
-        'n_variants': n_variants,
-        'simulated': False,
-        'selection': True,
-        'selpop': region_sel_pop,
-        'tpeds': { 
-            pop: os.path.basename(tped_fname) for pop, tped_fname in zip(all_pops, tped_fnames)
-        },
-        'popIds': all_pops,
-        'pop_sample_sizes': pop_sample_sizes,
-        'tpedFiles': [os.path.basename(tped_fname) for tped_fname in tped_fnames],
-        'pop2samples': pop2samples
+    FORMAT_VERSION = 1
+
+    def __init__(self, sample_panel_npz):
+        self.data = np.load(sample_panel_npz, allow_pickle=False)
+        format_version = int(self.data['format_version'])
+        chk(format_version == self.FORMAT_VERSION,
+            f'{sample_panel_npz}: sample panel format version {format_version} != {self.FORMAT_VERSION}')
+        self.pop2outgroup_pops = json.loads(str(self.data['pop2outgroup_pops_json']))
+        self.superpop_to_representative_pop = json.loads(str(self.data['superpop_to_representative_pop_json']))
+        self.pop2superpop = json.loads(str(self.data['pop2superpop_json']))
+
+    def get_pop2vcfcols(self, vcf_cols):
+        """For each pop, get the numbers of the vcf columns for unrelated individuals in that pop"""
+        if list(vcf_cols[9:]) == list(self.data['vcf_sample_ids']):
+            return collections.defaultdict(list, {pop: list(map(int, self.data[f'pop2vcfcols/{pop}']))
+                                                  for pop in json.loads(str(self.data['pops_json']))})
+        _log.warning('vcf samples differ from those in the sample panel; recomputing vcf columns')
+        return get_pop2vcfcols(samples_ped_data=pd.DataFrame({'Individual_ID': self.data['unrelated_sample_ids'],
+                                                              'Population': self.data['unrelated_sample_pops']}),
+                               pops_data=pd.DataFrame({'Population Code': list(self.pop2superpop.keys()),
+                                                       'Super Population': list(self.pop2superpop.values())}),
+                               vcf_cols=vcf_cols)
+
+    def get_genmap(self, pop, chrom):
+        """Return arrays of basepair positions and the corresponding cM positions for the genetic map of one pop and chrom"""
+        return (self.data[f'genmap/{pop}/{chrom}/pos'], self.data[f'genmap/{pop}/{chrom}/cm'])
+# end: class SamplePanel(object)
+
+# * construct_sample_panel
+def construct_sample_panel(args):
+    """Compute the sample panel (see SamplePanel) and save it to args.out_sample_panel"""
+    ped_data = gather_unrelated_individuals(args.pedigree_data_url, args.related_individuals_url,
+                                            cache_dir=args.unrelated_individuals_cache_dir or args.tmp_dir)
+    pops_data = pd.read_table(args.pops_data_url)
+    superpop_to_representative_pop = _json_loadf(args.superpop_to_representative_pop_json)
+    pop2outgroup_pops = compute_outgroup_pops(pops_data=pops_data,
+                                              superpop_to_representative_pop=superpop_to_representative_pop)
+    pop2superpop = dict(pops_data[['Population Code', 'Super Population']].dropna().itertuples(index=False))
+
+    vcf_header_fname = os.path.realpath(os.path.join(args.tmp_dir, 'sample_panel_vcf_header.vcf'))
+    vcf_url = string.Template(args.phased_vcfs_url_template).substitute(chrom=args.sample_panel_vcf_header_chrom)
+    execute(f'tabix -H {vcf_url} > {vcf_header_fname}', cwd=os.path.realpath(args.tmp_dir), retries=5, retry_delay=10)
+    with open(vcf_header_fname) as vcf_header_in:
+        vcf_cols = [line for line in vcf_header_in if line.startswith('#CHROM')][0].strip().split('\t')
+    pop2vcfcols = get_pop2vcfcols(ped_data, pops_data, vcf_cols)
+
+    panel_arrays = {
+        'format_version': np.array(SamplePanel.FORMAT_VERSION),
+        'unrelated_sample_ids': ped_data['Individual_ID'].to_numpy(dtype=str),
+        'unrelated_sample_pops': ped_data['Population'].to_numpy(dtype=str),
+        'vcf_sample_ids': np.array(vcf_cols[9:], dtype=str),
+        'pops_json': np.array(json.dumps(sorted(pop2vcfcols))),
+        'pop2outgroup_pops_json': np.array(json.dumps(pop2outgroup_pops)),
+        'superpop_to_representative_pop_json': np.array(json.dumps(superpop_to_representative_pop)),
+        'pop2superpop_json': np.array(json.dumps(pop2superpop)),
     }
-    _write_json(fname=os.path.join(hapset_dir, string_to_file_name(f'{hapset_name}.replicaInfo.json')),
-                json_val=hapset_manifest)
-    hapset_tar_gz = os.path.join(tmp_dir, f'{hapset_name}.hapset.tar.gz')
-    execute(f'tar cvfz {hapset_tar_gz} -C {hapset_dir} .')
-    return hapset_tar_gz
-# end: def construct_hapset_for_one_empirical_region(region_key, region_lines, region_sel_pop, outgroup_pops, pop2cols, ...)
+    for pop, vcf_cols_for_pop in pop2vcfcols.items():
+        panel_arrays[f'pop2vcfcols/{pop}'] = np.array(vcf_cols_for_pop, dtype=np.int32)
+
+    genmaps_dir = unpack_genetic_maps(args.genetic_maps_tar_gz, args.tmp_dir)
+    genmap_fname_re = re.compile(r'(?P<pop>[^/]+)_recombination_map_hapmap_format_hg19_chr_(?P<chrom>[^/]+)\.txt$')
+    for genmap_fname in sorted(glob.glob(os.path.join(genmaps_dir, 'hg19', '*', '*.txt'))):
+        genmap_fname_match = genmap_fname_re.search(genmap_fname)
+        if not genmap_fname_match:
+            continue
+        pop, chrom = genmap_fname_match.group('pop'), genmap_fname_match.group('chrom')
+        panel_arrays[f'genmap/{pop}/{chrom}/pos'], panel_arrays[f'genmap/{pop}/{chrom}/cm'] = \
+            load_genetic_map(genmap_fname)
+
+    _log.info(f'Saving sample panel to {args.out_sample_panel}: {len(panel_arrays)=}')
+    with open(args.out_sample_panel, 'wb') as out_sample_panel:
+        np.savez(out_sample_panel, **panel_arrays)
+# end: def construct_sample_panel(args)
 
 # * construct_pops_info
 def construct_pops_info(pop2outgroup_pops):
@@ -700,52 +798,78 @@ def fetch_empirical_regions(args):
     # ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/phase3/20131219.populations.tsv
     # ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/phase3/20131219.superpopulations.tsv
 
-    ped_data = gather_unrelated_individuals(pd.read_table(args.pedigree_data_url), args.related_individuals_url)
-    
-    pops_data = pd.read_table(args.pops_data_url)
-    superpop_to_representative_pop = _json_loadf(args.superpop_to_representative_pop_json)
-    pop2outgroup_pops = compute_outgroup_pops(pops_data=pops_data,
-                                              superpop_to_representative_pop=superpop_to_representative_pop)
+    chk(args.empirical_regions_bed and args.out_fnames_prefix,
+        '--empirical-regions-bed and --out-fnames-prefix are required')
+    if args.sample_panel:
+        sample_panel = SamplePanel(args.sample_panel)
+        superpop_to_representative_pop = sample_panel.superpop_to_representative_pop
+        pop2outgroup_pops = sample_panel.pop2outgroup_pops
+    else:
+        sample_panel = None
+        ped_data = gather_unrelated_individuals(args.pedigree_data_url, args.related_individuals_url,
+                                                cache_dir=args.unrelated_individuals_cache_dir or args.tmp_dir)
+
+        pops_data = pd.read_table(args.pops_data_url)
+        superpop_to_representative_pop = _json_loadf(args.superpop_to_representative_pop_json)
+        pop2outgroup_pops = compute_outgroup_pops(pops_data=pops_data,
+                                                  superpop_to_representative_pop=superpop_to_representative_pop)
     all_pops = list(pop2outgroup_pops.keys())
     
     chrom2regions = load_empirical_regions_bed(args.empirical_regions_bed, args.sel_pop)
     _log.debug(f'{chrom2regions=}')
     
-    genmap = GeneticMaps(args.genetic_maps_tar_gz, superpop_to_representative_pop, args.tmp_dir)
+    genmap = GeneticMaps(args.genetic_maps_tar_gz, superpop_to_representative_pop, args.tmp_dir,
+                         sample_panel=sample_panel)
 
     stats = collections.Counter()
 
     for chrom in sorted(chrom2regions):
         chrom_regions_vcf = fetch_one_chrom_regions_phased_vcf(chrom, chrom2regions[chrom].keys(),
                                                                args.phased_vcfs_url_template, args.tmp_dir)
-        region_lines = []
+        # hapset writers for the current region, one per pop in which the region is putatively selected;
+        # each vcf line is decoded once and then passed to all of them.
+        region_writers = []
         with open(chrom_regions_vcf) as chrom_regions_vcf_in:
             for vcf_line in itertools.chain(chrom_regions_vcf_in, ['#EOF']):
                 #_log.debug(f'{vcf_line[:200]=}')
                 if vcf_line.startswith('##'): continue
                 if vcf_line.startswith('#CHROM'):
                     vcf_cols = vcf_line.strip().split('\t')
-                    pop2vcfcols = get_pop2vcfcols(ped_data, pops_data, vcf_cols)
+                    pop2vcfcols = sample_panel.get_pop2vcfcols(vcf_cols) if sample_panel \
+                        else get_pop2vcfcols(ped_data, pops_data, vcf_cols)
                     pop2samples = {pop: [vcf_cols[vcf_col_num] for vcf_col_num in pop2vcfcols[pop]] for pop in all_pops}
+                    n_samples = len(vcf_cols) - 9
+                    used_samples = np.array(sorted(set(itertools.chain.from_iterable(pop2vcfcols.values()))),
+                                            dtype=np.int64) - 9
                     continue
                 if vcf_line.startswith('#'):
-                    if region_lines:
-                        for region_sel_pop in chrom2regions[chrom][region_key]:
-                            pops_to_include = ([region_sel_pop] + list(pop2outgroup_pops[region_sel_pop])) \
-                                if region_sel_pop else all_pops
-                            construct_hapset_for_one_empirical_region(
-                                region_key=region_key, region_lines=region_lines[1:],
-                                region_sel_pop=region_sel_pop,
-                                pops_to_include=pops_to_include,
-                                pop2vcfcols=pop2vcfcols,
-                                pop2samples=pop2samples,
-                                genmap=genmap,
-                                stats=stats,
-                                tmp_dir=args.tmp_dir,
-                                out_fnames_prefix=args.out_fnames_prefix)
+                    for region_writer in region_writers:
+                        region_writer.finish()
+                    region_writers = []
+                    if vcf_line.startswith('#EOF'):
+                        break
                     region_key = vcf_line.strip()[1:]
-                    region_lines = []
-                region_lines.append(vcf_line)
+                    for region_sel_pop in chrom2regions[chrom][region_key]:
+                        pops_to_include = ([region_sel_pop] + list(pop2outgroup_pops[region_sel_pop])) \
+                            if region_sel_pop else all_pops
+                        region_writers.append(EmpiricalHapsetWriter(
+                            region_key=region_key,
+                            region_sel_pop=region_sel_pop,
+                            pops_to_include=pops_to_include,
+                            pop2vcfcols=pop2vcfcols,
+                            pop2samples=pop2samples,
+                            genmap=genmap,
+                            stats=stats,
+                            tmp_dir=args.tmp_dir,
+                            out_fnames_prefix=args.out_fnames_prefix))
+                    vcf_line_num = 0
+                    continue
+                decoded_vcf_line = decode_vcf_line(vcf_line, n_samples=n_samples, used_samples=used_samples, stats=stats)
+                if decoded_vcf_line:
+                    chrom_here, pos, anc_gts = decoded_vcf_line
+                    for region_writer in region_writers:
+                        region_writer.add_variant(chrom=chrom_here, pos=pos, vcf_line_num=vcf_line_num, anc_gts=anc_gts)
+                vcf_line_num += 1
     # for chrom in sorted(chrom2regions)
     _log.info(f'{stats=}')
     
@@ -753,4 +877,8 @@ def fetch_empirical_regions(args):
 
 if __name__=='__main__':
   #compute_component_scores(parse_args())
-  fetch_empirical_regions(parse_args())
+  args = parse_args()
+  if args.out_sample_panel:
+    construct_sample_panel(args)
+  else:
+    fetch_empirical_regions(args)
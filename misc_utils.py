@@ -1,29 +1,26 @@
-"""Miscellaneous utilities not specific to bioinformatics"""
+"""Miscellaneous utilities not specific to bioinformatics.
+
+This module is shared by the pipeline scripts, which run as many short-lived tasks, so it imports only lightweight
+standard modules; heavy dependencies should be imported with lazy_import().
+"""
 
-import argparse
-import csv
 import collections
-import concurrent.futures
-import contextlib
-import copy
-import functools
 import glob
 import gzip
+import importlib.util
 import io
 import json
 import logging
-import math
-import multiprocessing
 import os
 import os.path
-import pathlib
-import random
 import re
-import shutil
 import subprocess
 import sys
-import tempfile
-import time
+
+try:
+    import orjson  # optional: faster json parsing
+except ImportError:
+    orjson = None
 
 # * Utils
 
@@ -33,6 +30,25 @@ logging.basicConfig(level=logging.DEBUG,
 
 MAX_INT32 = (2 ** 31)-1
 
+def lazy_import(module_name):
+    """Return the named module, deferring its actual loading until one of its attributes is first accessed.
+
+    Used for heavy modules (e.g. pandas) that are needed only on some code paths of a script, so that
+    the other code paths do not pay for loading them.  Submodules (e.g. matplotlib.pyplot) cause their parent
+    package to be loaded right away, so should instead be imported where used.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.find_spec(module_name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {module_name!r}', name=module_name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    loader.exec_module(module)
+    return module
+
 def dump_file(fname, value):
     """store string in file"""
     with open(fname, 'w')  as out:
@@ -48,14 +64,140 @@ def _write_json(fname, json_val):
 def _load_dict_sorted(d):
     return collections.OrderedDict(sorted(d.items()))
 
-def _json_loads(s):
-    return json.loads(s.strip(), object_hook=_load_dict_sorted, object_pairs_hook=collections.OrderedDict)
+def _sort_json_dicts(json_val):
+    """Return a copy of a parsed json value, with the keys of all its dicts sorted"""
+    if isinstance(json_val, dict):
+        return _load_dict_sorted({k: _sort_json_dicts(v) for k, v in json_val.items()})
+    if isinstance(json_val, list):
+        return [_sort_json_dicts(v) for v in json_val]
+    return json_val
+
+def _json_loads(s, sort_keys=False):
+    """Parse a json string or bytes.  Dicts keep the key order of the json text, unless `sort_keys` is True.
+
+    Uses orjson if it is installed, falling back to the json module for inputs orjson rejects
+    (such as NaN values, which _write_json() may write).
+    """
+    json_val = None
+    if orjson is not None:
+        try:
+            json_val = orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    if json_val is None:
+        json_val = json.loads(s)
+    return _sort_json_dicts(json_val) if sort_keys else json_val
 
-def _json_loadf(fname):
-    return _json_loads(slurp_file(fname))
+def _json_loadf(fname, sort_keys=False):
+    """Parse a (possibly gzipped) json file; see _json_loads().  Unlike slurp_file(), there is no limit on file size."""
+    with open_or_gzopen(fname, 'rb') as f:
+        return _json_loads(f.read(), sort_keys=sort_keys)
 
 json_loadf = _json_loadf
 
+class JsonScanner(object):
+    """Parses the json text of a file incrementally, reading the file in chunks, so that large json values can be
+    processed one part at a time without loading the whole file into memory.
+
+    The caller walks the json structure with iter_object_keys() and iter_array(), parsing the parts it needs whole
+    with value().
+    """
+
+    def __init__(self, f, fname, chunk_size=1 << 20):
+        """Scan the json text read from the text file object `f`; `fname` is used in error messages"""
+        self.f = f
+        self.fname = fname
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.at_eof = '', 0, False
+
+    def _read_more(self):
+        more = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.at_eof = not more
+        self.buf, self.pos = self.buf[self.pos:] + more, 0
+
+    def peek(self):
+        """Skip whitespace, and return the next char, or '' at the end of the file"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf) or self.at_eof:
+                return self.buf[self.pos:self.pos+1]
+            self._read_more()
+
+    def expect(self, chars):
+        """Consume the next char, which must be one of `chars`, and return it"""
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f'{self.fname}: expected one of {chars!r} but got {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Parse and return the next json value"""
+        self.peek()
+        while True:
+            try:
+                json_val, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number ending at the end of what has been read so far may continue past it
+                if self.at_eof or (end < len(self.buf) and self.buf[end] not in '0123456789.eE+-'):
+                    self.pos = end
+                    return json_val
+            except json.JSONDecodeError:
+                if self.at_eof:
+                    raise
+            self._read_more()
+
+    def iter_object_keys(self):
+        """Iterate over the keys of a json object, leaving the scanner at the start of each key's value,
+        which the caller must consume (e.g. with value()) before continuing"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """Iterate over the elements of a json array, parsed"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+# end: class JsonScanner(object)
+
+def iter_json_array(fname, key=None, chunk_size=1 << 20):
+    """Iterate over the elements of a large json array, without loading the whole array into memory.
+
+    Args:
+      fname: (possibly gzipped) json file, containing either the array or an object of which the array is a value
+      key: if given, the file contains an object, and the array is its value for this key
+      chunk_size: number of characters to read from the file at a time
+
+    Yields:
+      the array's elements, parsed, one at a time
+    """
+    with open_or_gzopen(fname, 'rt') as f:
+        scanner = JsonScanner(f, fname=fname, chunk_size=chunk_size)
+        if key is None:
+            yield from scanner.iter_array()
+            return
+        for obj_key in scanner.iter_object_keys():
+            if obj_key == key:
+                yield from scanner.iter_array()
+                return
+            scanner.value()
+        raise KeyError(f'iter_json_array({fname}): key {key!r} not found')
+# end: def iter_json_array(fname, key=None, chunk_size=1 << 20)
+
 def slurp_file(fname, maxSizeMb=50):
     """Read entire file into one string.  If file is gzipped, uncompress it on-the-fly.  If file is larger
     than `maxSizeMb` megabytes, throw an error; this is to encourage proper use of iterators for reading
@@ -109,43 +251,27 @@ def find_one_file(glob_pattern):
         return matching_files[0]
     raise RuntimeError(f'find_one_file({glob_pattern}): {len(matching_files)} matches - {matching_files}')
 
+def parse_file_list(z):
+    """Expand a list of file names, where names starting with @ refer to files listing further file names"""
+    z = list(z or [])
+    result = []
+    while z:
+        f = z.pop()
+        if not f.startswith('@'):
+            result.append(f)
+        else:
+            with open(f[1:]) as f_in:
+                z.extend(f_in.read().strip().split('\n'))
+    return result[::-1]
+
 def available_cpu_count():
     """
     Return the number of available virtual or physical CPUs on this system.
     The number of available CPUs can be smaller than the total number of CPUs
     when the cpuset(7) mechanism is in use, as is the case on some cluster
-    systems.
-
-    Adapted from http://stackoverflow.com/a/1006301/715090
+    systems, or when a container's cpu quota is limited by its cgroup; see get_resource_budget().
     """
-
-    cgroup_cpus = MAX_INT32
-    try:
-        def get_cpu_val(name):
-            return float(slurp_file('/sys/fs/cgroup/cpu/cpu.'+name).strip())
-        cfs_quota = get_cpu_val('cfs_quota_us')
-        if cfs_quota > 0:
-            cfs_period = get_cpu_val('cfs_period_us')
-            _log.debug('cfs_quota %s, cfs_period %s', cfs_quota, cfs_period)
-            cgroup_cpus = max(1, int(cfs_quota / cfs_period))
-    except Exception as e:
-        pass
-
-    proc_cpus = MAX_INT32
-    try:
-        with open('/proc/self/status') as f:
-            status = f.read()
-        m = re.search(r'(?m)^Cpus_allowed:\s*(.*)$', status)
-        if m:
-            res = bin(int(m.group(1).replace(',', ''), 16)).count('1')
-            if res > 0:
-                proc_cpus = res
-    except IOError:
-        pass
-
-    _log.debug('cgroup_cpus %d, proc_cpus %d, multiprocessing cpus %d',
-               cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
-    return min(cgroup_cpus, proc_cpus, multiprocessing.cpu_count())
+    return get_resource_budget().n_cpus
 
 def execute(action, **kw):
     succeeded = False
@@ -160,3 +286,188 @@ def chk(cond, msg):
     if not cond:
         raise RuntimeError(f'chk failed: {msg}')
 
+# * Reading tables
+
+class FixedSchemaTsvReader(object):
+    """Reads a series of tsv files with the same columns, such as the per-hapset *.normed_and_collated.tsv files.
+
+    Column names and dtypes are inferred from the first file only.  The remaining files are parsed with these
+    dtypes fixed, which skips pandas' per-column type inference.  They are read with pyarrow's csv reader if pyarrow
+    is installed, and otherwise with pandas' C parser on a memory-mapped file.  A file whose columns or dtypes turn out
+    different from the first file's is re-read with type inference.  Each returned DataFrame therefore has the same
+    columns and dtypes as pd.read_table(fname, low_memory=False) would give.
+    """
+
+    def __init__(self, use_pyarrow=None):
+        self.dtypes = None
+        self.use_pyarrow = (importlib.util.find_spec('pyarrow') is not None) if use_pyarrow is None else use_pyarrow
+        self.n_reread = 0
+
+    def _read_with_fixed_dtypes(self, fname):
+        pd = lazy_import('pandas')
+        if not self.use_pyarrow:
+            return pd.read_table(fname, dtype=self.dtypes, memory_map=True, low_memory=False)
+
+        import pyarrow
+        import pyarrow.csv
+        column_types = {col: pyarrow.string() if dtype == object else pyarrow.from_numpy_dtype(dtype)
+                        for col, dtype in self.dtypes.items()}
+        table = pyarrow.csv.read_csv(fname, parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+                                     convert_options=pyarrow.csv.ConvertOptions(column_types=column_types,
+                                                                                strings_can_be_null=True))
+        return table.to_pandas()
+
+    def read(self, fname):
+        """Read one tsv file into a DataFrame"""
+        pd = lazy_import('pandas')
+        if self.dtypes is None:
+            df = pd.read_table(fname, low_memory=False)
+            self.dtypes = df.dtypes.to_dict()
+            return df
+
+        try:
+            df = self._read_with_fixed_dtypes(fname)
+            if list(df.columns) == list(self.dtypes) and df.dtypes.to_dict() == self.dtypes:
+                return df
+            _log.debug(f'{fname}: schema differs from that of the first file; re-reading with type inference')
+        except (ValueError, TypeError, OverflowError) as e:
+            _log.debug(f'{fname}: could not parse with the fixed dtypes ({e}); re-reading with type inference')
+        self.n_reread += 1
+        return pd.read_table(fname, low_memory=False)
+
+    def iter_read(self, fnames, n_read_ahead=4):
+        """Read tsv files in order, yielding a DataFrame for each.
+
+        While the caller processes one file, up to n_read_ahead of the following files are read in background threads.
+        pyarrow parses without holding the GIL, so with pyarrow this overlaps parsing with the caller's own work.
+        """
+        import concurrent.futures
+        import itertools
+        fnames = iter(fnames)
+        for fname in itertools.islice(fnames, 1):
+            yield self.read(fname)  # learn the schema before the other files are read
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_read_ahead) as executor:
+            futures = collections.deque(executor.submit(self.read, fname)
+                                        for fname in itertools.islice(fnames, n_read_ahead))
+            while futures:
+                df = futures.popleft().result()
+                futures.extend(executor.submit(self.read, fname) for fname in itertools.islice(fnames, 1))
+                yield df
+# end: class FixedSchemaTsvReader(object)
+
+# * Resource budget
+
+# The cpus and memory available to this process, as limited by cpu affinity and by the cgroups (v1 or v2) of the
+# container in which it runs.  mem_bytes is None if no memory limit could be determined.
+ResourceBudget = collections.namedtuple('ResourceBudget', ['n_cpus', 'mem_bytes'])
+
+# cgroup v1 reports the absence of a memory limit as a very large number, rather than as "max"
+_CGROUP_V1_NO_MEM_LIMIT = 2 ** 60
+
+def _read_first_line(fname):
+    """Return the first line of a file, stripped, or None if the file cannot be read"""
+    try:
+        with open(fname) as f:
+            return f.readline().strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def _cgroup_dirs(controller, cgroup_root, proc_self_cgroup):
+    """Return the cgroup dirs whose `controller` ('cpu' or 'memory') limits apply to this process, as a list of
+    (cgroup_version, dir) pairs, innermost first.
+
+    The process's cgroups are read from `proc_self_cgroup`, and their dirs are looked up under the cgroup filesystems
+    mounted at `cgroup_root`: the v2 unified hierarchy is at `cgroup_root` itself (or at `cgroup_root`/unified on hosts
+    mixing v1 and v2), and each v1 hierarchy is at `cgroup_root`/<its controllers>.  Limits of enclosing cgroups also
+    apply, so dirs up to the root of each hierarchy are included.  Inside containers, the process's cgroup is often
+    itself mounted as the root, in which case only the root is found.
+    """
+    cgroup_dirs = []
+    for line in (slurp_file(proc_self_cgroup).strip().split('\n') if os.path.isfile(proc_self_cgroup) else []):
+        hierarchy_id, controllers, cgroup_path = line.split(':', maxsplit=2)
+        if hierarchy_id == '0' and not controllers:
+            cgroup_version = 2
+            mount_dir = cgroup_root if os.path.isfile(os.path.join(cgroup_root, 'cgroup.controllers')) \
+                else os.path.join(cgroup_root, 'unified')
+        elif controller in controllers.split(','):
+            cgroup_version = 1
+            mount_dir = os.path.join(cgroup_root, controllers)
+            if not os.path.isdir(mount_dir):
+                mount_dir = os.path.join(cgroup_root, controller)
+        else:
+            continue
+        mount_dir = os.path.normpath(mount_dir)
+        cgroup_dir = os.path.normpath(os.path.join(mount_dir, cgroup_path.lstrip('/')))
+        while True:
+            if os.path.isdir(cgroup_dir):
+                cgroup_dirs.append((cgroup_version, cgroup_dir))
+            if cgroup_dir == mount_dir or not cgroup_dir.startswith(mount_dir + os.sep):
+                break
+            cgroup_dir = os.path.dirname(cgroup_dir)
+    return cgroup_dirs
+
+def _cgroup_cpu_limit(cgroup_root, proc_self_cgroup):
+    """Return the number of cpus to which this process is limited by the cpu quotas of its cgroups, or None"""
+    cpu_limits = []
+    for cgroup_version, cgroup_dir in _cgroup_dirs('cpu', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup):
+        try:
+            if cgroup_version == 2:
+                # cpu.max is "<quota> <period>", with quota "max" if unlimited
+                cpu_max = (_read_first_line(os.path.join(cgroup_dir, 'cpu.max')) or 'max').split()
+                if cpu_max[0] != 'max':
+                    cpu_limits.append(int(cpu_max[0]) / int(cpu_max[1]))
+            else:
+                cfs_quota = int(_read_first_line(os.path.join(cgroup_dir, 'cpu.cfs_quota_us')) or -1)
+                if cfs_quota > 0:
+                    cpu_limits.append(cfs_quota / int(_read_first_line(os.path.join(cgroup_dir, 'cpu.cfs_period_us'))))
+        except (ValueError, IndexError, TypeError, ZeroDivisionError):
+            _log.warning(f'Could not parse cpu quota in {cgroup_dir}')
+    return min(cpu_limits, default=None)
+
+def _cgroup_mem_limit(cgroup_root, proc_self_cgroup):
+    """Return the memory, in bytes, to which this process is limited by its cgroups, or None"""
+    mem_limits = []
+    for cgroup_version, cgroup_dir in _cgroup_dirs('memory', cgroup_root=cgroup_root,
+                                                   proc_self_cgroup=proc_self_cgroup):
+        mem_limit = _read_first_line(os.path.join(cgroup_dir, 'memory.max' if cgroup_version == 2
+                                                  else 'memory.limit_in_bytes'))
+        if mem_limit and mem_limit != 'max':
+            try:
+                if int(mem_limit) < _CGROUP_V1_NO_MEM_LIMIT:
+                    mem_limits.append(int(mem_limit))
+            except ValueError:
+                _log.warning(f'Could not parse memory limit in {cgroup_dir}: {mem_limit}')
+    return min(mem_limits, default=None)
+
+def _total_mem_bytes(proc_meminfo):
+    """Return the total memory of the host, in bytes, or None"""
+    m = re.search(r'(?m)^MemTotal:\s*(\d+)\s*kB', slurp_file(proc_meminfo)) if os.path.isfile(proc_meminfo) else None
+    return int(m.group(1)) * 1024 if m else None
+
+def get_resource_budget(cgroup_root='/sys/fs/cgroup', proc_root='/proc'):
+    """Return the ResourceBudget of cpus and memory available to this process.
+
+    The cpu count is the smallest of the cpus this process may run on (see sched_getaffinity(2)) and the cpu quotas of
+    its cgroups, rounded down but at least 1.  The memory is the smaller of the memory limits of its cgroups and the
+    total memory of the host.  Both cgroup v1 and v2 are supported.
+
+    Args:
+      cgroup_root: where the cgroup filesystems are mounted
+      proc_root: where the proc filesystem is mounted
+    """
+    proc_self_cgroup = os.path.join(proc_root, 'self', 'cgroup')
+    try:
+        affinity_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        affinity_cpus = os.cpu_count() or 1
+    cgroup_cpus = _cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup)
+    n_cpus = affinity_cpus if cgroup_cpus is None else max(1, min(affinity_cpus, int(cgroup_cpus)))
+
+    mem_limits = [mem_limit for mem_limit in (_cgroup_mem_limit(cgroup_root=cgroup_root,
+                                                                proc_self_cgroup=proc_self_cgroup),
+                                              _total_mem_bytes(os.path.join(proc_root, 'meminfo')))
+                  if mem_limit is not None]
+    mem_bytes = min(mem_limits, default=None)
+
+    _log.debug(f'get_resource_budget: {affinity_cpus=} {cgroup_cpus=} {n_cpus=} {mem_limits=}')
+    return ResourceBudget(n_cpus=n_cpus, mem_bytes=mem_bytes)
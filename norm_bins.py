@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""Computes frequency-binned normalization stats for component scores of neutral hapsets, and saves them in the form
+read by `norm --load-bins`.
+
+Each score file is read once; the count, mean and sum of squared deviations of the scores in each derived allele
+frequency bin are accumulated with Welford/Chan updates, so partial stats from different files can be combined.
+Partial stats can be saved with --save-state (e.g. by each task computing component scores for a block of hapsets),
+and merged later with --states, so that the score files themselves never need to be gathered in one place.
+Merged stats can themselves be saved with --save-state, so the merging can proceed as a tree-reduction.
+Saved stats record the format version, the component and the bin edges, and merging stats that differ in any of
+these is an error.
+"""
+
+# * imports etc
+
+import platform
+
+if not tuple(map(int, platform.python_version_tuple())) >= (3,8):
+    raise RuntimeError('Python >=3.8 required')
+
+import argparse
+import collections
+import logging
+
+from misc_utils import lazy_import, chk, parse_file_list
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# * Utils
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+# * Component score files
+
+# for each component, the layout of the selscan output file:
+# (has_header, derived allele freq column, score column, alt pop derived allele freq column).
+# columns are numbered from 0.  for xpehh, the alt pop freq column is used for binning when the pops are flipped.
+ComponentScoresLayout = collections.namedtuple('ComponentScoresLayout', ['has_header', 'freq_col', 'score_col', 'alt_freq_col'])
+
+COMPONENT_SCORES_LAYOUTS = {
+    # locus, phys, freq_1, ihh_1, ihh_0, ihs_unnormed [, der_ihh_l, der_ihh_r, anc_ihh_l, anc_ihh_r]
+    'ihs': ComponentScoresLayout(has_header=False, freq_col=2, score_col=5, alt_freq_col=None),
+    # locus, phys, freq_1, ihh_1, ihh_0, delihh_unnormed
+    'delihh': ComponentScoresLayout(has_header=False, freq_col=2, score_col=5, alt_freq_col=None),
+    # locus, phys, freq_1, sl_1, sl_0, nsl_unnormed
+    'nsl': ComponentScoresLayout(has_header=False, freq_col=2, score_col=5, alt_freq_col=None),
+    # id, pos, p1, ihh12
+    'ihh12': ComponentScoresLayout(has_header=True, freq_col=2, score_col=3, alt_freq_col=None),
+    # id, pos, gpos, p1, ihh1, p2, ihh2, xpehh
+    'xpehh': ComponentScoresLayout(has_header=True, freq_col=3, score_col=7, alt_freq_col=5),
+}
+
+def read_component_scores(fname, component):
+    """Read the derived allele freqs and the unnormalized scores from one selscan output file.
+
+    Returns:
+      tuple (freqs, scores, alt_freqs) of float arrays; alt_freqs is None except for two-pop components.
+      Sites with non-finite scores are dropped.  An empty or header-only file (e.g. for a hapset with no variants
+      passing selscan's filters) gives empty arrays.
+    """
+    layout = COMPONENT_SCORES_LAYOUTS[component]
+    cols = [layout.freq_col, layout.score_col] + ([layout.alt_freq_col] if layout.alt_freq_col is not None else [])
+    try:
+        scores_data = pd.read_csv(fname, sep='\t', header=None, skiprows=1 if layout.has_header else 0,
+                                  usecols=cols, dtype=np.float64)
+    except pd.errors.EmptyDataError:
+        _log.warning(f'{fname}: no {component} scores')
+        scores_data = pd.DataFrame({col: np.zeros(0, dtype=np.float64) for col in cols})
+    scores = scores_data[layout.score_col].to_numpy()
+    ok = np.isfinite(scores)
+    return (scores_data[layout.freq_col].to_numpy()[ok], scores[ok],
+            scores_data[layout.alt_freq_col].to_numpy()[ok] if layout.alt_freq_col is not None else None)
+
+# * class NormBinsAccumulator
+class NormBinsAccumulator(object):
+    """Accumulates, for each derived allele frequency bin, the count, mean and sum of squared deviations from the mean
+    (M2) of a component score.
+
+    Frequencies in [0,1] are split into `n_bins` equal-width bins, each bin including its upper bound.
+
+    Args:
+      n_bins: number of frequency bins
+      component: the component whose scores are accumulated
+      flip_pops: for two-pop components, whether the scores are for the pops swapped relative to the score files
+    """
+
+    # version of the layout of the files written by save_state(); bump when the layout changes
+    STATE_FORMAT_VERSION = 1
+
+    def __init__(self, n_bins, component, flip_pops=False):
+        chk(n_bins > 0, f'bad number of bins: {n_bins}')
+        self.n_bins = n_bins
+        self.component = component
+        self.flip_pops = flip_pops
+        self.bin_edges = np.linspace(0.0, 1.0, n_bins+1)
+        self.n = np.zeros(n_bins, dtype=np.int64)
+        self.mean = np.zeros(n_bins, dtype=np.float64)
+        self.m2 = np.zeros(n_bins, dtype=np.float64)
+        self.files_used = []
+
+    def freqs_to_bins(self, freqs):
+        """Map derived allele frequencies to bin indices"""
+        return np.clip(np.ceil(np.asarray(freqs) * self.n_bins).astype(np.int64) - 1, 0, self.n_bins-1)
+
+    def _combine(self, n_b, mean_b, m2_b):
+        """Combine per-bin stats of another batch of scores into ours (Chan et al. parallel update)"""
+        n_a, mean_a, m2_a = self.n, self.mean, self.m2
+        n = n_a + n_b
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean_b - mean_a
+            frac_b = np.where(n > 0, n_b / np.maximum(n, 1), 0.0)
+            self.mean = mean_a + delta * frac_b
+            self.m2 = m2_a + m2_b + delta * delta * n_a * frac_b
+        self.n = n
+
+    def add(self, freqs, scores):
+        """Add a batch of scores, with the derived allele frequencies of their sites"""
+        bins = self.freqs_to_bins(freqs)
+        scores = np.asarray(scores, dtype=np.float64)
+        n_b = np.bincount(bins, minlength=self.n_bins)
+        sums_b = np.bincount(bins, weights=scores, minlength=self.n_bins)
+        mean_b = np.where(n_b > 0, sums_b / np.maximum(n_b, 1), 0.0)
+        m2_b = np.bincount(bins, weights=(scores - mean_b[bins])**2, minlength=self.n_bins)
+        self._combine(n_b, mean_b, m2_b)
+
+    def merge(self, other):
+        """Merge the stats accumulated by another accumulator into this one"""
+        chk(other.component == self.component, f'cannot merge bins: {self.component=} {other.component=}')
+        chk(other.flip_pops == self.flip_pops, f'cannot merge bins: {self.flip_pops=} {other.flip_pops=}')
+        chk(other.n_bins == self.n_bins and np.array_equal(other.bin_edges, self.bin_edges),
+            f'cannot merge bins: {self.bin_edges=} {other.bin_edges=}')
+        self._combine(other.n, other.mean, other.m2)
+        self.files_used.extend(other.files_used)
+
+    def save_state(self, fname):
+        """Save the accumulated stats, so that they can be merged with others by load_state() and merge()"""
+        with open(fname, 'wb') as out:
+            np.savez_compressed(out, format_version=self.STATE_FORMAT_VERSION,
+                                component=self.component, flip_pops=self.flip_pops, bin_edges=self.bin_edges,
+                                n=self.n, mean=self.mean, m2=self.m2,
+                                files_used=np.array(self.files_used, dtype=str))
+
+    @classmethod
+    def load_state(cls, fname):
+        """Load stats saved by save_state()"""
+        with np.load(fname) as state:
+            format_version = int(state['format_version']) if 'format_version' in state else None
+            chk(format_version == cls.STATE_FORMAT_VERSION,
+                f'{fname}: unsupported format version {format_version}; expected {cls.STATE_FORMAT_VERSION}')
+            bin_edges = state['bin_edges']
+            norm_bins = cls(n_bins=len(bin_edges)-1, component=str(state['component']),
+                            flip_pops=bool(state['flip_pops']))
+            chk(np.array_equal(bin_edges, norm_bins.bin_edges), f'{fname}: bins are not equal-width: {bin_edges=}')
+            norm_bins.n, norm_bins.mean, norm_bins.m2 = state['n'], state['mean'], state['m2']
+            chk(len(norm_bins.n) == len(norm_bins.mean) == len(norm_bins.m2) == norm_bins.n_bins,
+                f'{fname}: per-bin stats do not match the bins')
+            norm_bins.files_used = state['files_used'].tolist()
+        return norm_bins
+
+    def variance(self):
+        """Per-bin sample variance"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 1, self.m2 / (self.n - 1), np.nan)
+
+    def write_norm_bins(self, fname):
+        """Save the bins in the layout written by `norm --save-bins` and read by `norm --load-bins`:
+        the number of bins on the first line, followed by one line per bin giving its count, mean and variance."""
+        variance = self.variance()
+        with open(fname, 'w') as out:
+            out.write(f'{self.n_bins}\n')
+            for n, mean, var in zip(self.n.tolist(), self.mean.tolist(), variance.tolist()):
+                out.write(f'{n}\t{mean if n > 0 else np.nan!r}\t{var!r}\n')
+
+    def write_log(self, fname, files_used=None):
+        files_used = self.files_used if files_used is None else files_used
+        with open(fname, 'w') as out:
+            out.write(f'files: {len(files_used)}\n')
+            for f in files_used:
+                out.write(f'{f}\n')
+            out.write('bin\tn\tmean\tstd\n')
+            for bin_num, (n, mean, var) in enumerate(zip(self.n.tolist(), self.mean.tolist(), self.variance().tolist())):
+                out.write(f'{bin_num}\t{n}\t{mean}\t{np.sqrt(var)}\n')
+# end: class NormBinsAccumulator(object)
+
+# * compute_norm_bins
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--component', required=True, choices=sorted(COMPONENT_SCORES_LAYOUTS),
+                        help='component whose scores are in --files')
+    parser.add_argument('--files', nargs='+',
+                        help='selscan output files with the scores; names starting with @ refer to files listing file names')
+    parser.add_argument('--states', nargs='+',
+                        help='partial stats saved with --save-state, to merge with the stats from --files; '
+                        'names starting with @ refer to files listing file names')
+    parser.add_argument('--bins', type=int, required=True, help='number of derived allele frequency bins')
+    parser.add_argument('--save-bins', help='save the normalization bins to this file')
+    parser.add_argument('--save-state', help='save the accumulated stats to this file, for later merging with --states')
+    parser.add_argument('--log', help='write a summary of the bins to this file')
+    parser.add_argument('--save-bins-flip-pops',
+                        help='for two-pop components, also save to this file the bins for the scores with the pops swapped')
+    parser.add_argument('--log-flip-pops', help='write a summary of the --save-bins-flip-pops bins to this file')
+    parser.add_argument('--states-flip-pops', nargs='+',
+                        help='partial stats saved with --save-state-flip-pops, to merge with the flipped-pops stats from --files')
+    parser.add_argument('--save-state-flip-pops',
+                        help='for two-pop components, save to this file the accumulated stats for the scores with the pops swapped')
+
+    return parser.parse_args()
+
+def compute_norm_bins(args):
+    """Compute the normalization bins for one component over all given score files, reading each file once,
+    and/or merge previously saved partial stats"""
+    files = parse_file_list(args.files)
+    states = parse_file_list(args.states)
+    states_flip_pops = parse_file_list(args.states_flip_pops)
+    chk(files or states, 'no --files or --states given')
+    chk(args.save_bins or args.save_state, 'no --save-bins or --save-state given')
+    flip_pops = bool(args.save_bins_flip_pops or args.save_state_flip_pops)
+    chk(not flip_pops or COMPONENT_SCORES_LAYOUTS[args.component].alt_freq_col is not None,
+        f'--save-bins-flip-pops/--save-state-flip-pops not applicable to {args.component}')
+    chk(flip_pops or not (states_flip_pops or args.log_flip_pops),
+        '--states-flip-pops/--log-flip-pops given without --save-bins-flip-pops/--save-state-flip-pops')
+
+    norm_bins = NormBinsAccumulator(args.bins, component=args.component)
+    norm_bins_flip_pops = NormBinsAccumulator(args.bins, component=args.component, flip_pops=True)
+    for fname in files:
+        freqs, scores, alt_freqs = read_component_scores(fname, args.component)
+        norm_bins.add(freqs, scores)
+        norm_bins.files_used.append(fname)
+        if flip_pops:
+            # with the pops swapped, the score is negated and sites are binned by the other pop's freq
+            norm_bins_flip_pops.add(alt_freqs, -scores)
+            norm_bins_flip_pops.files_used.append(fname)
+    for state_fname in states:
+        norm_bins.merge(NormBinsAccumulator.load_state(state_fname))
+    for state_fname in states_flip_pops:
+        norm_bins_flip_pops.merge(NormBinsAccumulator.load_state(state_fname))
+    _log.info(f'Computed {args.component} bins from {len(files)} files and {len(states)} saved states: {norm_bins.n=}')
+
+    if args.save_state:
+        norm_bins.save_state(args.save_state)
+    if args.save_bins:
+        norm_bins.write_norm_bins(args.save_bins)
+    if args.log:
+        norm_bins.write_log(args.log)
+    if args.save_state_flip_pops:
+        norm_bins_flip_pops.save_state(args.save_state_flip_pops)
+    if args.save_bins_flip_pops:
+        norm_bins_flip_pops.write_norm_bins(args.save_bins_flip_pops)
+    if args.log_flip_pops:
+        norm_bins_flip_pops.write_log(args.log_flip_pops)
+# end: def compute_norm_bins(args)
+
+if __name__=='__main__':
+    compute_norm_bins(parse_args())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""Groups hapsets into blocks, each to be processed by one component-computation task, so that the blocks have
+similar predicted runtimes.
+
+The runtime of each hapset is predicted from its replicaInfo (number of variants, number of haplotypes, region length)
+by a linear cost model.  The replicaInfos are read from the replicaInfos.json files written by runcosi.py for each
+block of sims (--replica-infos), so the hapsets themselves need not be localized; for other hapsets, the replicaInfo
+can be read from each hapset .tar.gz (--hapsets alone).  The model's coefficients can be fitted to the command profiles
+recorded by compute_cms2_components.py --profile-jsonl (--observed-profiles), and saved (--save-cost-model) for reuse
+(--cost-model).  The hapsets are then assigned to as many blocks as are needed to keep
+each block near the target runtime, longest hapsets first, each to the currently least-loaded block.  Every hapset is
+assigned to some block.
+"""
+
+# * imports etc
+
+import platform
+
+if not tuple(map(int, platform.python_version_tuple())) >= (3,8):
+    raise RuntimeError('Python >=3.8 required')
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import os.path
+import tarfile
+
+from misc_utils import lazy_import, chk, parse_file_list, _write_json, iter_json_array
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# * Utils
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+# * Hapset features
+
+# features of a hapset from which its processing cost is predicted
+COST_FEATURES = ('n_variants', 'n_variants_x_n_haps', 'region_len')
+
+def replica_info_features(replicaInfo, hapset_name):
+    """Return the cost features of a hapset, given its replicaInfo, as a dict.  Failed sims have all features zero."""
+    features = dict.fromkeys(COST_FEATURES, 0)
+    if not replicaInfo.get('succeeded', True):
+        _log.warning(f'Failed sim {hapset_name}')
+        return features
+    # for simulated hapsets, the replicaInfo in the hapset records n_variants only in the nested replicaInfo
+    n_variants = replicaInfo.get('n_variants', replicaInfo.get('replicaInfo', {}).get('n_variants'))
+    chk(n_variants is not None, f'n_variants not recorded in replicaInfo of {hapset_name}')
+    n_haps = sum(replicaInfo['pop_sample_sizes'].values())
+    features.update(n_variants=n_variants, n_variants_x_n_haps=n_variants*n_haps,
+                    region_len=(replicaInfo['region_end'] or 0) - (replicaInfo['region_beg'] or 0))
+    return features
+
+def read_hapset_features(hapset_tar_gz):
+    """Read the replicaInfo from a hapset .tar.gz, and return the hapset's cost features as a dict.
+
+    Failed sims, represented by empty files, have all features zero.
+    """
+    if os.path.getsize(hapset_tar_gz) == 0:
+        _log.warning(f'Empty hapset {hapset_tar_gz}')
+        return dict.fromkeys(COST_FEATURES, 0)
+    with tarfile.open(hapset_tar_gz, mode='r|gz') as hapset_tar:
+        for member in hapset_tar:
+            if member.name.endswith('.replicaInfo.json'):
+                replicaInfo = json.load(hapset_tar.extractfile(member))
+                break
+        else:
+            raise RuntimeError(f'No replicaInfo in {hapset_tar_gz}')
+    return replica_info_features(replicaInfo, hapset_tar_gz)
+
+def iter_replica_infos(replica_infos_jsons):
+    """Yield the replicaInfos, in order, from replicaInfos.json files written by runcosi.py --outJson.
+
+    The files are streamed, so that the replicaInfos of all the hapsets need not be held in memory at once.
+    """
+    for replica_infos_json in replica_infos_jsons:
+        yield from iter_json_array(replica_infos_json, key='replicaInfos')
+
+def read_profile_timings(profile_jsonls):
+    """Read per-hapset runtimes from command profiles recorded by compute_cms2_components.py --profile-jsonl.
+
+    The runtime of a hapset is the total wall time of the commands run for it for one (sel pop, alt pop);
+    commands not tied to a hapset are ignored.
+
+    Returns:
+      DataFrame with a column for each of COST_FEATURES, and a `runtime_s` column, with a row for each
+      (hapset, sel pop, alt pop).
+    """
+    timings = collections.OrderedDict()
+    for profile_jsonl in profile_jsonls:
+        with open(profile_jsonl) as profile:
+            for line in profile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get('hapset') is None or record.get('n_variants') is None:
+                    continue
+                key = (record['hapset'], record.get('sel_pop'), record.get('alt_pop'))
+                if key not in timings:
+                    n_haps = sum((record.get('pop_sample_sizes') or {}).values())
+                    timings[key] = dict(n_variants=record['n_variants'],
+                                        n_variants_x_n_haps=record['n_variants'] * n_haps,
+                                        region_len=record.get('region_len') or 0, runtime_s=0.0)
+                timings[key]['runtime_s'] += record['wall_time_s']
+    return pd.DataFrame(list(timings.values()), columns=list(COST_FEATURES) + ['runtime_s'])
+
+# * class HapsetCostModel
+class HapsetCostModel(object):
+    """Predicts the runtime, in seconds, of computing component scores for one hapset, as a linear function of
+    the hapset's COST_FEATURES.
+
+    Args:
+      intercept: fixed per-hapset cost (unpacking the hapset, starting the tools)
+      coeffs: map from feature name to cost per unit of that feature
+    """
+
+    # rough defaults, to use until a model has been fitted to observed timings
+    DEFAULT_INTERCEPT = 30.0
+    DEFAULT_COEFFS = {'n_variants': 1e-3, 'n_variants_x_n_haps': 2e-6, 'region_len': 0.0}
+
+    def __init__(self, intercept=DEFAULT_INTERCEPT, coeffs=None):
+        self.intercept = float(intercept)
+        self.coeffs = dict(self.DEFAULT_COEFFS if coeffs is None else coeffs)
+        chk(set(self.coeffs) == set(COST_FEATURES), f'bad cost model features: {sorted(self.coeffs)}')
+
+    def predict(self, features):
+        """Predict the runtime for a hapset with the given features"""
+        return self.intercept + sum(self.coeffs[f] * features[f] for f in COST_FEATURES)
+
+    @classmethod
+    def fit(cls, timings):
+        """Fit the model to observed timings.
+
+        Args:
+          timings: DataFrame with a column for each of COST_FEATURES, and a `runtime_s` column.
+        """
+        chk(len(timings) > len(COST_FEATURES), f'too few observed timings to fit a cost model: {len(timings)}')
+        X = np.column_stack([np.ones(len(timings))] + [timings[f].to_numpy(dtype=np.float64) for f in COST_FEATURES])
+        y = timings['runtime_s'].to_numpy(dtype=np.float64)
+        coeffs, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+        # a negative cost per unit of work is an artifact of noise or collinear features
+        coeffs = np.maximum(coeffs, 0.0)
+        _log.info(f'Fitted cost model to {len(timings)} timings: {coeffs=}')
+        return cls(intercept=coeffs[0], coeffs=dict(zip(COST_FEATURES, coeffs[1:].tolist())))
+
+    def save(self, fname):
+        _write_json(fname, dict(intercept=self.intercept, coeffs=self.coeffs))
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as f:
+            cost_model = json.load(f)
+        return cls(intercept=cost_model['intercept'], coeffs=cost_model['coeffs'])
+# end: class HapsetCostModel(object)
+
+# * pack_blocks
+
+def pack_blocks(costs, target_block_cost):
+    """Assign items with given costs to blocks, so that each block's total cost is near target_block_cost.
+
+    Returns:
+      list of blocks, each a sorted list of item indices; every item is in exactly one block.
+    """
+    chk(target_block_cost > 0, f'bad target block cost: {target_block_cost}')
+    if not len(costs):
+        return []
+    n_blocks = min(len(costs), max(1, math.ceil(sum(costs) / target_block_cost)))
+
+    # longest-processing-time-first: assign each item, most costly first, to the least loaded block
+    block_loads = [(0.0, block_num) for block_num in range(n_blocks)]
+    blocks = [[] for _ in range(n_blocks)]
+    for item_idx in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+        block_load, block_num = heapq.heappop(block_loads)
+        blocks[block_num].append(item_idx)
+        heapq.heappush(block_loads, (block_load + costs[item_idx], block_num))
+
+    return sorted((sorted(block) for block in blocks if block), key=lambda block: block[0])
+
+# * pack_hapset_blocks
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--hapsets', nargs='+',
+                        help='hapset .tar.gz files; names starting with @ refer to files listing file names.  '
+                        'With --replica-infos, only the file names are used, and the files need not exist.')
+    parser.add_argument('--replica-infos', nargs='+',
+                        help='replicaInfos.json files written by runcosi.py for the blocks of sims that produced '
+                        '--hapsets, in the order of --hapsets; names starting with @ refer to files listing file names')
+    parser.add_argument('--target-block-runtime-s', type=float, help='target predicted runtime of each block, in seconds')
+    parser.add_argument('--cost-model', help='json file with a cost model saved by --save-cost-model; '
+                        'if neither this nor --observed-profiles is given, rough default coefficients are used')
+    parser.add_argument('--observed-profiles', nargs='+',
+                        help='command profiles recorded by compute_cms2_components.py --profile-jsonl, to fit the '
+                        'cost model to; names starting with @ refer to files listing file names')
+    parser.add_argument('--save-cost-model', help='save the cost model used to this json file')
+    parser.add_argument('--out-blocks-json', help='write the blocks, as lists of indices into --hapsets, to this json file')
+    parser.add_argument('--out-blocks-tsv', help='write a summary of the blocks and their predicted runtimes to this file')
+
+    return parser.parse_args()
+
+def pack_hapset_blocks(args):
+    """Group hapsets into blocks with balanced predicted runtimes"""
+    chk(not (args.cost_model and args.observed_profiles), '--cost-model and --observed-profiles are mutually exclusive')
+    if args.observed_profiles:
+        cost_model = HapsetCostModel.fit(read_profile_timings(parse_file_list(args.observed_profiles)))
+    elif args.cost_model:
+        cost_model = HapsetCostModel.load(args.cost_model)
+    else:
+        cost_model = HapsetCostModel()
+    if args.save_cost_model:
+        cost_model.save(args.save_cost_model)
+
+    hapsets = parse_file_list(args.hapsets)
+    if not (args.out_blocks_json or args.out_blocks_tsv):
+        return
+    chk(args.target_block_runtime_s, '--target-block-runtime-s is required for packing blocks')
+
+    if args.replica_infos:
+        features = []
+        for hapset, replicaInfo in itertools.zip_longest(hapsets,
+                                                         iter_replica_infos(parse_file_list(args.replica_infos))):
+            chk(hapset is not None and replicaInfo is not None,
+                f'{len(hapsets)} hapsets but a different number of replicaInfos')
+            chk(os.path.basename(hapset) == os.path.basename(replicaInfo['region_haps_tar_gz']),
+                f'replicaInfo for {replicaInfo["region_haps_tar_gz"]} given for hapset {hapset}')
+            features.append(replica_info_features(replicaInfo, hapset))
+    else:
+        missing_hapsets = [hapset for hapset in hapsets if not os.path.isfile(hapset)]
+        chk(not missing_hapsets, f'--replica-infos not given, and hapset files to read replicaInfos from are missing: '
+            f'{missing_hapsets[:3]}{"..." if len(missing_hapsets) > 3 else ""}')
+        features = [read_hapset_features(hapset) for hapset in hapsets]
+    costs = [cost_model.predict(hapset_features) for hapset_features in features]
+    blocks = pack_blocks(costs, target_block_cost=args.target_block_runtime_s)
+    block_costs = [sum(costs[i] for i in block) for block in blocks]
+    _log.info(f'Packed {len(hapsets)} hapsets into {len(blocks)} blocks; predicted block runtimes: '
+              f'min={min(block_costs, default=0):.0f}s max={max(block_costs, default=0):.0f}s')
+
+    if args.out_blocks_json:
+        _write_json(args.out_blocks_json, dict(hapset_blocks_idxs=blocks))
+    if args.out_blocks_tsv:
+        pd.DataFrame(dict(block_num=range(len(blocks)), n_hapsets=[len(block) for block in blocks],
+                          predicted_runtime_s=block_costs,
+                          hapsets=[','.join(os.path.basename(hapsets[i]) for i in block) for block in blocks])) \
+            .to_csv(args.out_blocks_tsv, sep='\t', index=False, na_rep='nan')
+# end: def pack_hapset_blocks(args)
+
+if __name__=='__main__':
+    pack_hapset_blocks(parse_args())
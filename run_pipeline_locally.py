@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+"""Runs the pipeline of run_sims_and_compute_cms2_components.wdl -- simulations, component scores for neutral sims,
+normalization bin stats, then component scores, normalization and collation for selection sims -- on one machine,
+without Cromwell.
+
+The pipeline's tasks, mirroring the workflow's task calls, form a DAG.  Each task runs the same scripts with the same
+arguments as the corresponding WDL task, in its own dir under --scratch-dir, reading its inputs directly from the dirs
+of the tasks it depends on.  Tasks are started as soon as their dependencies finish and enough cpus are free, tasks
+with the longest chain of dependent tasks first, so a many-core machine stays busy without per-task container
+startup and file localization.
+
+A task that finishes writes a marker file; on a rerun with the same --scratch-dir, tasks whose marker and outputs
+are present are skipped, and the dirs of tasks that did not finish are cleared and the tasks rerun.
+"""
+
+# * imports etc
+
+import platform
+
+if not tuple(map(int, platform.python_version_tuple())) >= (3,8):
+    raise RuntimeError('Python >=3.8 required')
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import heapq
+import logging
+import os
+import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from misc_utils import _write_json, _json_loadf, chk, get_resource_budget
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+def script_cmd(script, *script_args):
+    """Shell command to run one of the pipeline's scripts with the given args, each quoted"""
+    return ' '.join(shlex.quote(str(arg)) for arg in [sys.executable, os.path.join(SCRIPTS_DIR, script)] + list(script_args))
+
+# * class Task
+class Task(object):
+    """One task of the pipeline: shell commands run in order, in the task's own dir.
+
+    Args:
+      name: unique task name; also the path of the task's dir, relative to the scratch dir
+      task_dir: dir in which to run the task
+      cmds: list of shell commands, or a function that takes the Task and returns the commands; the function is
+         called just before the task runs, for commands that depend on the outputs of the task's dependencies
+      deps: tasks that must finish before this one
+      outputs: names of files, relative to the task dir, that the task must produce
+      n_cpus: number of cpus used by the task
+    """
+
+    DONE_MARKER = '.task_done'
+
+    def __init__(self, name, task_dir, cmds, deps=(), outputs=(), n_cpus=1):
+        self.name = name
+        self.task_dir = task_dir
+        self.cmds = cmds
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+        self.n_cpus = n_cpus
+
+    def __repr__(self):
+        return f'Task({self.name})'
+
+    def path(self, fname):
+        """Path of a file in the task dir"""
+        return os.path.join(self.task_dir, fname)
+
+    def glob(self, pattern):
+        """Sorted paths of files in the task dir matching a glob pattern"""
+        return sorted(glob.glob(os.path.join(self.task_dir, pattern)))
+
+    def is_done(self):
+        """Whether the task has finished, in this or an earlier run, and its outputs are present"""
+        return os.path.isfile(self.path(self.DONE_MARKER)) and all(map(os.path.isfile, map(self.path, self.outputs)))
+
+    def run(self):
+        """Run the task's commands in a cleared task dir, logging their output to task.log in the task dir"""
+        shutil.rmtree(self.task_dir, ignore_errors=True)
+        os.makedirs(self.task_dir)
+        cmds = self.cmds(self) if callable(self.cmds) else self.cmds
+        with open(self.path('task.log'), 'w') as log:
+            for cmd in cmds:
+                log.write(f'+ {cmd}\n')
+                log.flush()
+                subprocess.run(cmd, shell=True, cwd=self.task_dir, stdout=log, stderr=subprocess.STDOUT, check=True)
+        missing_outputs = [f for f in self.outputs if not os.path.isfile(self.path(f))]
+        chk(not missing_outputs, f'task {self.name} did not produce {missing_outputs}')
+        open(self.path(self.DONE_MARKER), 'w').close()
+# end: class Task(object)
+
+# * run_tasks
+
+def critical_path_lengths(tasks):
+    """Map each task to the number of tasks on the longest chain of tasks that depend on it, including itself"""
+    dependents = collections.defaultdict(list)
+    for task in tasks:
+        for dep in task.deps:
+            dependents[dep].append(task)
+    lengths = {}
+    def length(task):
+        if task not in lengths:
+            lengths[task] = 1 + max((length(dependent) for dependent in dependents[task]), default=0)
+        return lengths[task]
+    for task in tasks:
+        length(task)
+    return lengths
+
+def run_tasks(tasks, max_cpus, keep_going=False):
+    """Run the tasks, each once its deps have finished, keeping the total cpus of running tasks within max_cpus.
+
+    Tasks already done are skipped.  Among tasks whose deps have finished, the task with the longest chain of
+    dependent tasks is started first, unless it needs more cpus than are free, in which case the next task that fits
+    is started.  After a task fails, no new tasks are started unless keep_going is set, in which case tasks that do
+    not depend on the failed task are still run.
+
+    Returns:
+      list of tasks that failed or were not run because a dep failed
+    """
+    pending = [task for task in tasks if not task.is_done()]
+    _log.info(f'{len(tasks) - len(pending)} of {len(tasks)} tasks already done; running {len(pending)} tasks '
+              f'on up to {max_cpus} cpus')
+    pending_set = set(pending)
+    priority = critical_path_lengths(pending)
+    n_deps_left = {task: sum(dep in pending_set for dep in task.deps) for task in pending}
+    dependents = collections.defaultdict(list)
+    for task in pending:
+        for dep in task.deps:
+            dependents[dep].append(task)
+
+    # heap of (-priority, tie-breaker, task) for tasks whose deps have all finished
+    task_nums = {task: task_num for task_num, task in enumerate(pending)}
+    ready = [(-priority[task], task_nums[task], task) for task in pending if not n_deps_left[task]]
+    heapq.heapify(ready)
+    running = {}
+    cpus_free = max_cpus
+    failed = []
+    n_done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_cpus) as executor:
+        while ready or running:
+            # start the highest-priority ready tasks that fit in the free cpus
+            skipped = []
+            while ready and cpus_free > 0 and (keep_going or not failed):
+                ready_item = heapq.heappop(ready)
+                task = ready_item[-1]
+                task_cpus = min(task.n_cpus, max_cpus)
+                if task_cpus > cpus_free:
+                    skipped.append(ready_item)
+                    continue
+                cpus_free -= task_cpus
+                _log.info(f'Starting {task.name} ({task_cpus} cpus)')
+                running[executor.submit(task.run)] = (task, task_cpus, time.time())
+            for ready_item in skipped:
+                heapq.heappush(ready, ready_item)
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                task, task_cpus, beg_time = running.pop(future)
+                cpus_free += task_cpus
+                try:
+                    future.result()
+                except Exception as e:
+                    _log.error(f'Task {task.name} failed after {time.time() - beg_time:.0f}s: {e}; '
+                               f'see {task.path("task.log")}')
+                    failed.append(task)
+                    continue
+                n_done += 1
+                _log.info(f'Finished {task.name} in {time.time() - beg_time:.0f}s ({n_done} of {len(pending)} done)')
+                for dependent in dependents[task]:
+                    n_deps_left[dependent] -= 1
+                    if not n_deps_left[dependent]:
+                        heapq.heappush(ready, (-priority[dependent], task_nums[dependent], dependent))
+    # end: with concurrent.futures.ThreadPoolExecutor(max_workers=max_cpus) as executor
+
+    not_done = [task for task in pending if not task.is_done()]
+    if not_done:
+        _log.error(f'{len(failed)} tasks failed, and {len(not_done) - len(failed)} were not run: {not_done}')
+    return not_done
+# end: def run_tasks(tasks, max_cpus, keep_going=False)
+
+# * Pipeline construction
+
+def one_pop_components_cmds(hapsets, sel_pop, component_computation_params_json, n_bins, threads):
+    """Commands of tasks.compute_one_pop_cms2_components"""
+    cmds = [script_cmd('compute_cms2_components.py', '--hapsets', *hapsets, '--sel-pop', sel_pop,
+                       '--components', 'ihs', 'nsl', 'ihh12', 'delihh', 'derFreq', 'iSAFE',
+                       '--component-computation-params', component_computation_params_json, '--threads', threads)]
+    for component in ('ihs', 'delihh', 'nsl', 'ihh12'):
+        cmds.append(script_cmd('norm_bins.py', '--component', component, '--bins', n_bins[component],
+                               '--save-state', f'norm_bins_state_{component}.npz') + f' --files *.{component}.out')
+    return cmds
+
+def two_pop_components_cmds(hapsets, sel_pop, alt_pop, threads):
+    """Commands of tasks.compute_two_pop_cms2_components"""
+    return [script_cmd('compute_cms2_components.py', '--hapsets', *hapsets, '--sel-pop', sel_pop, '--alt-pop', alt_pop,
+                       '--components', 'xpehh', 'fst', 'delDAF', '--threads', threads),
+            script_cmd('norm_bins.py', '--component', 'xpehh', '--bins', 1,
+                       '--save-state', 'norm_bins_state_xpehh.npz',
+                       '--save-state-flip-pops', 'norm_bins_state_flip_pops_xpehh.npz') + ' --files *.xpehh.out']
+
+class LocalPipeline(object):
+    """Constructs the tasks of the pipeline, given the pops info"""
+
+    def __init__(self, args, pops_info):
+        self.args = args
+        self.pops_info = pops_info
+        self.tasks = []
+        self.component_computation_params = _json_loadf(args.component_computation_params)
+        self.n_bins = dict(ihs=self.component_computation_params['n_bins_ihs'],
+                           nsl=self.component_computation_params['n_bins_nsl'],
+                           delihh=self.component_computation_params['n_bins_delihh'], ihh12=1)
+        self.pop_ids = pops_info['pop_ids']
+
+    def add_task(self, name, cmds, deps=(), outputs=(), n_cpus=1):
+        task = Task(name=name, task_dir=os.path.join(self.args.scratch_dir, name), cmds=cmds, deps=deps,
+                    outputs=outputs, n_cpus=n_cpus)
+        self.tasks.append(task)
+        return task
+
+    def alt_pops(self, sel_pop):
+        """Alt pops compared with sel_pop in two-pop components"""
+        sel_pop_idx = self.pop_ids.index(sel_pop)
+        return [alt_pop for alt_pop_idx, alt_pop in enumerate(self.pop_ids)
+                if alt_pop_idx != sel_pop_idx and self.pops_info['pop_alts_used'][sel_pop_idx][alt_pop_idx]]
+
+    def add_sims_tasks(self, paramFile, modelId, nreps):
+        """Tasks of run_sims.cosi2_run_one_sim_block for one model; returns a list of (task, hapsets) per block"""
+        args = self.args
+        numBlocks = nreps // args.numRepsPerBlock
+        blocks = []
+        for blockNum in range(numBlocks):
+            simBlockId = f'{modelId}__block_{blockNum}__of_{numBlocks}'
+            tpedPrefix = f'tpeds__{simBlockId}'
+            hapsets = [f'{tpedPrefix}__tar_gz__rep_{rep_num}' for rep_num in range(args.numRepsPerBlock)]
+            task = self.add_task(
+                name=f'sims/{simBlockId}',
+                cmds=[script_cmd('runcosi.py', '--paramFileCommon', args.paramFile_demographic_model,
+                                 '--paramFile', paramFile, '--recombFile', args.recombFile, '--simBlockId', simBlockId,
+                                 '--modelId', modelId, '--blockNum', blockNum, '--numRepsPerBlock', args.numRepsPerBlock,
+                                 '--numBlocks', numBlocks, '--maxAttempts', args.maxAttempts,
+                                 '--repAttemptTimeoutSeconds', args.repAttemptTimeoutSeconds,
+                                 '--repTimeoutSeconds', args.repTimeoutSeconds, '--tpedPrefix', tpedPrefix,
+                                 '--outJson', 'replicaInfos.json')],
+                outputs=hapsets + ['replicaInfos.json'], n_cpus=args.numRepsPerBlock)
+            blocks.append((task, [task.path(hapset) for hapset in hapsets]))
+        return blocks
+
+    def add_normalization_stats_tasks(self, neutral_sims_blocks):
+        """Tasks of compute_normalization_stats_wf.  Returns maps from component to map from sel pop to the task
+        computing its norm bins, and from (sel pop, alt pop) to the norm bins file for xpehh"""
+        args = self.args
+        # regroup the hapsets of all neutral sims blocks into blocks of hapset_block_size hapsets
+        neutral_hapsets = [(sims_task, hapset) for sims_task, hapsets in neutral_sims_blocks for hapset in hapsets]
+        hapset_blocks = [neutral_hapsets[i:i + args.hapset_block_size]
+                         for i in range(0, len(neutral_hapsets), args.hapset_block_size)]
+        def block_deps(hapset_block): return list({sims_task: None for sims_task, _ in hapset_block})
+        def block_hapsets(hapset_block): return [hapset for _, hapset in hapset_block]
+
+        norm_bins_tasks = {}
+        for sel_pop in self.pop_ids:
+            components_tasks = [self.add_task(name=f'neutral_components/selpop_{sel_pop}__block_{block_num}',
+                                              cmds=one_pop_components_cmds(block_hapsets(hapset_block), sel_pop,
+                                                                           args.component_computation_params,
+                                                                           self.n_bins, args.threads_per_task),
+                                              deps=block_deps(hapset_block),
+                                              outputs=[f'norm_bins_state_{c}.npz' for c in self.n_bins],
+                                              n_cpus=args.threads_per_task)
+                                for block_num, hapset_block in enumerate(hapset_blocks)]
+            prefix = f'{args.modelId}__selpop_{sel_pop}'
+            norm_bins_tasks[sel_pop] = self.add_task(
+                name=f'norm_bins/selpop_{sel_pop}',
+                cmds=[script_cmd('norm_bins.py', '--component', component, '--bins', self.n_bins[component],
+                                 '--states', *[t.path(f'norm_bins_state_{component}.npz') for t in components_tasks],
+                                 '--save-bins', f'{prefix}.norm_bins_{component}.dat',
+                                 '--log', f'{prefix}.norm_bins_{component}.log')
+                      for component in self.n_bins],
+                deps=components_tasks, outputs=[f'{prefix}.norm_bins_{component}.dat' for component in self.n_bins])
+
+        norm_bins_xpehh = {}
+        for sel_pop_idx, sel_pop in enumerate(self.pop_ids):
+            for alt_pop_idx, alt_pop in enumerate(self.pop_ids):
+                if not (alt_pop_idx > sel_pop_idx and (self.pops_info['pop_alts_used'][sel_pop_idx][alt_pop_idx] or
+                                                       self.pops_info['pop_alts_used'][alt_pop_idx][sel_pop_idx])):
+                    continue
+                components_tasks = [self.add_task(name=f'neutral_components/selpop_{sel_pop}__altpop_{alt_pop}'
+                                                  f'__block_{block_num}',
+                                                  cmds=two_pop_components_cmds(block_hapsets(hapset_block), sel_pop,
+                                                                               alt_pop, args.threads_per_task),
+                                                  deps=block_deps(hapset_block),
+                                                  outputs=['norm_bins_state_xpehh.npz',
+                                                           'norm_bins_state_flip_pops_xpehh.npz'],
+                                                  n_cpus=args.threads_per_task)
+                                    for block_num, hapset_block in enumerate(hapset_blocks)]
+                fname = f'{args.modelId}__selpop_{sel_pop}__altpop_{alt_pop}.norm_bins_xpehh'
+                flip_pops_fname = f'{args.modelId}__selpop_{alt_pop}__altpop_{sel_pop}.norm_bins_xpehh'
+                task = self.add_task(
+                    name=f'norm_bins/selpop_{sel_pop}__altpop_{alt_pop}',
+                    cmds=[script_cmd('norm_bins.py', '--component', 'xpehh', '--bins', 1,
+                                     '--states', *[t.path('norm_bins_state_xpehh.npz') for t in components_tasks],
+                                     '--states-flip-pops',
+                                     *[t.path('norm_bins_state_flip_pops_xpehh.npz') for t in components_tasks],
+                                     '--save-bins', f'{fname}.dat', '--log', f'{fname}.log',
+                                     '--save-bins-flip-pops', f'{flip_pops_fname}.dat',
+                                     '--log-flip-pops', f'{flip_pops_fname}.log')],
+                    deps=components_tasks, outputs=[f'{fname}.dat', f'{flip_pops_fname}.dat'])
+                norm_bins_xpehh[(sel_pop, alt_pop)] = (task, f'{fname}.dat')
+                norm_bins_xpehh[(alt_pop, sel_pop)] = (task, f'{flip_pops_fname}.dat')
+        return norm_bins_tasks, norm_bins_xpehh
+    # end: def add_normalization_stats_tasks(self, neutral_sims_blocks)
+
+    def add_sel_sims_tasks(self, sel_scen_idx, sel_sims_blocks, norm_bins_tasks, norm_bins_xpehh):
+        """Tasks of component_stats_for_sel_sims_wf for one selection scenario; returns the HDF5 collation tasks"""
+        args = self.args
+        sel_pop = self.pops_info['sel_pops'][sel_scen_idx]['pop_id']
+        alt_pops = self.alt_pops(sel_pop)
+        collate_tasks = []
+        for sel_blk_idx, (sims_task, hapsets) in enumerate(sel_sims_blocks):
+            blk_name = f'selscen_{sel_scen_idx}__selblk_{sel_blk_idx}'
+            one_pop_task = self.add_task(name=f'sel_components/{blk_name}__selpop_{sel_pop}',
+                                         cmds=one_pop_components_cmds(hapsets, sel_pop, args.component_computation_params,
+                                                                      self.n_bins, args.threads_per_task),
+                                         deps=[sims_task], n_cpus=args.threads_per_task)
+            two_pop_tasks = [self.add_task(name=f'sel_components/{blk_name}__selpop_{sel_pop}__altpop_{alt_pop}',
+                                           cmds=two_pop_components_cmds(hapsets, sel_pop, alt_pop, args.threads_per_task),
+                                           deps=[sims_task], n_cpus=args.threads_per_task)
+                             for alt_pop in alt_pops]
+
+            def norm_and_collate_cmds(task, one_pop_task=one_pop_task, two_pop_tasks=two_pop_tasks):
+                norm_bins_task = norm_bins_tasks[sel_pop]
+                prefix = f'{args.modelId}__selpop_{sel_pop}'
+                # the NormalizeAndCollateBlockInput struct passed by component_stats_for_sel_sims_wf
+                _write_json(task.path('inputs.json'), dict(
+                    sel_pop=dict(pop_id=sel_pop),
+                    replica_info=one_pop_task.glob('*.replicaInfo.json'),
+                    ihs_out=one_pop_task.glob('*.ihs.out'), delihh_out=one_pop_task.glob('*.delihh.out'),
+                    nsl_out=one_pop_task.glob('*.nsl.out'), ihh12_out=one_pop_task.glob('*.ihh12.out'),
+                    derFreq_out=one_pop_task.glob('*.derFreq.tsv'), iSAFE_out=one_pop_task.glob('*.iSAFE.out'),
+                    xpehh_out=[t.glob('*.xpehh.out') for t in two_pop_tasks],
+                    fst_and_delDAF_out=[t.glob('*.fst_and_delDAF.tsv') for t in two_pop_tasks],
+                    component_computation_params=self.component_computation_params,
+                    **{f'norm_bins_{component}': norm_bins_task.path(f'{prefix}.norm_bins_{component}.dat')
+                       for component in self.n_bins},
+                    norm_bins_xpehh=[norm_bins_xpehh[(sel_pop, alt_pop)][0].path(norm_bins_xpehh[(sel_pop, alt_pop)][1])
+                                     for alt_pop in alt_pops]))
+                return [script_cmd('norm_and_collate_block.py', '--input-json', 'inputs.json')]
+
+            norm_and_collate_task = self.add_task(
+                name=f'norm_and_collate/{blk_name}', cmds=norm_and_collate_cmds,
+                deps=[one_pop_task] + two_pop_tasks + [norm_bins_tasks[sel_pop]] +
+                [norm_bins_xpehh[(sel_pop, alt_pop)][0] for alt_pop in alt_pops])
+
+            out_fnames_prefix = f'sim.cosi2.{args.modelId}__{blk_name}'
+            def collate_cmds(task, norm_and_collate_task=norm_and_collate_task, out_fnames_prefix=out_fnames_prefix):
+                _write_json(task.path('inputs.json'), dict(
+                    out_fnames_prefix=out_fnames_prefix,
+                    sel_normed_and_collated=norm_and_collate_task.glob('*.normed_and_collated.tsv'),
+                    replica_infos=norm_and_collate_task.glob('*.normed_and_collated.replicaInfo.json')))
+                return [script_cmd('collate_stats_and_metadata_for_sel_sims_block.py', '--input-json', 'inputs.json',
+                                   '--max-hapset-id-len', 256,
+                                   '--hapsets-component-stats-h5-fname', f'{out_fnames_prefix}.all_component_stats.h5',
+                                   '--hapsets-metadata-tsv-gz-fname', f'{out_fnames_prefix}.hapsets_metadata.tsv.gz')]
+
+            collate_tasks.append(self.add_task(
+                name=f'collate/{blk_name}', cmds=collate_cmds, deps=[norm_and_collate_task],
+                outputs=[f'{out_fnames_prefix}.all_component_stats.h5', f'{out_fnames_prefix}.hapsets_metadata.tsv.gz']))
+        # end: for sel_blk_idx, (sims_task, hapsets) in enumerate(sel_sims_blocks)
+        return collate_tasks
+    # end: def add_sel_sims_tasks(self, sel_scen_idx, sel_sims_blocks, norm_bins_tasks, norm_bins_xpehh)
+
+    def add_all_tasks(self):
+        """Add the tasks of run_sims_and_compute_cms2_components_wf; returns the final HDF5 collation tasks"""
+        args = self.args
+        neutral_sims_blocks = self.add_sims_tasks(paramFile=args.paramFile_neutral, modelId=args.modelId + '_neutral',
+                                                  nreps=args.nreps_neutral)
+        norm_bins_tasks, norm_bins_xpehh = self.add_normalization_stats_tasks(neutral_sims_blocks)
+        collate_tasks = []
+        for sel_scen_idx, paramFile in enumerate(args.paramFiles_selection):
+            sel_sims_blocks = self.add_sims_tasks(
+                paramFile=paramFile, modelId=args.modelId + '_' + os.path.basename(paramFile)[:-len('.par')],
+                nreps=args.nreps)
+            collate_tasks.extend(self.add_sel_sims_tasks(sel_scen_idx, sel_sims_blocks, norm_bins_tasks, norm_bins_xpehh))
+        return collate_tasks
+# end: class LocalPipeline(object)
+
+# * run_pipeline_locally
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--scratch-dir', required=True, help='dir in which to run the tasks and keep their outputs; '
+                        'rerunning with the same dir skips the tasks that already finished')
+    parser.add_argument('--max-cpus', type=int,
+                        help='max total cpus of concurrently running tasks; defaults to the cpus available')
+    parser.add_argument('--threads-per-task', type=int, default=1,
+                        help='threads for each component computation task; on a many-core machine, more concurrent '
+                        'single-threaded tasks usually give higher throughput')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='after a task fails, keep running the tasks that do not depend on it')
+    parser.add_argument('--dry-run', action='store_true', help='list the tasks that would be run, without running them')
+
+    # inputs of run_sims_and_compute_cms2_components_wf
+    parser.add_argument('--paramFile-demographic-model', required=True, help='the unvarying part of the parameter file')
+    parser.add_argument('--paramFile-neutral', required=True, help='the varying part of the parameter file for neutral sims')
+    parser.add_argument('--paramFiles-selection', nargs='+', required=True,
+                        help='the varying part of the parameter file for each selection scenario')
+    parser.add_argument('--recombFile', required=True,
+                        help='recombination map from which the map of each simulated region is sampled')
+    parser.add_argument('--modelId', help='string identifying the demographic model; defaults to model_ followed by '
+                        'the name of --paramFile-demographic-model')
+    parser.add_argument('--nreps-neutral', type=int, required=True, help='number of neutral replicates to simulate')
+    parser.add_argument('--nreps', type=int, required=True, help='number of replicates for each selection scenario')
+    parser.add_argument('--numRepsPerBlock', type=int, default=1, help='number of replicates simulated by each task')
+    parser.add_argument('--maxAttempts', type=int, default=10000000)
+    parser.add_argument('--repAttemptTimeoutSeconds', type=int, default=600)
+    parser.add_argument('--repTimeoutSeconds', type=int, default=3600)
+    parser.add_argument('--component-computation-params', required=True,
+                        help='json file with a ComponentComputationParams struct')
+    parser.add_argument('--hapset-block-size', type=int, default=2,
+                        help='number of neutral hapsets processed by each component computation task')
+
+    args = parser.parse_args()
+    args.modelId = args.modelId or 'model_' + os.path.basename(args.paramFile_demographic_model)[:-len('.par')]
+    # tasks run in their own dirs, so input files are passed to them as absolute paths
+    for arg in ('scratch_dir', 'paramFile_demographic_model', 'paramFile_neutral', 'recombFile',
+                'component_computation_params'):
+        setattr(args, arg, os.path.realpath(getattr(args, arg)))
+    args.paramFiles_selection = list(map(os.path.realpath, args.paramFiles_selection))
+    return args
+
+def run_pipeline_locally(args):
+    """Construct the pipeline's tasks and run them"""
+    max_cpus = args.max_cpus or get_resource_budget().n_cpus
+
+    # the pops info determines the shape of the rest of the pipeline, so it is computed first
+    pops_info_task = Task(name='pops_info', task_dir=os.path.join(args.scratch_dir, 'pops_info'),
+                          cmds=[script_cmd('get_pops_info.py', '--dem-model', args.paramFile_demographic_model,
+                                           '--sweep-defs', *args.paramFiles_selection,
+                                           '--out-pops-info', f'{args.modelId}.pops_info.json')],
+                          outputs=[f'{args.modelId}.pops_info.json'])
+    chk(not run_tasks([pops_info_task], max_cpus=max_cpus), 'could not compute pops info')
+    pops_info = _json_loadf(pops_info_task.path(f'{args.modelId}.pops_info.json'))['pops_info']
+    chk(len(pops_info['sel_pops']) == len(args.paramFiles_selection),
+        f'pops info has {len(pops_info["sel_pops"])} sel pops for {len(args.paramFiles_selection)} selection scenarios')
+
+    pipeline = LocalPipeline(args, pops_info)
+    collate_tasks = pipeline.add_all_tasks()
+    if args.dry_run:
+        for task in pipeline.tasks:
+            print(f'{task.name}\t{"done" if task.is_done() else "to run"}\t{task.n_cpus} cpus\t'
+                  f'deps: {",".join(dep.name for dep in task.deps)}')
+        return
+
+    not_done = run_tasks(pipeline.tasks, max_cpus=max_cpus, keep_going=args.keep_going)
+    h5_blocks = [task.path(task.outputs[0]) for task in collate_tasks if task.is_done()]
+    _write_json(os.path.join(args.scratch_dir, 'outputs.json'),
+                dict(pops_info=pops_info, all_hapsets_component_stats_h5_blocks=h5_blocks))
+    chk(not not_done, f'{len(not_done)} tasks not done; rerun with the same --scratch-dir to retry them')
+# end: def run_pipeline_locally(args)
+
+if __name__=='__main__':
+    run_pipeline_locally(parse_args())
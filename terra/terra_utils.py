@@ -30,6 +30,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 # third-party imports
@@ -257,6 +258,148 @@ def get_workflow_metadata_gz(namespace, workspace, submission_id, workflow_id, e
     return fapi.__get(uri, headers=headers, timeout=240)
 # end: def get_workflow_metadata_gz(namespace, workspace, submission_id, workflow_id)
 
+# * Crawling workflow metadata
+
+# Cromwell workflow statuses after which a workflow's metadata no longer changes
+TERMINAL_WORKFLOW_STATUSES = ('Succeeded', 'Failed', 'Aborted')
+
+class RateLimiter(object):
+    """Spaces out events, across threads, to at most `max_per_s` per second"""
+
+    def __init__(self, max_per_s):
+        misc_utils.chk(max_per_s > 0, f'bad rate limit: {max_per_s}')
+        self.min_interval_s = 1.0 / max_per_s
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        """Wait until the next event is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            wait_s = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval_s
+        if wait_s > 0:
+            time.sleep(wait_s)
+# end: class RateLimiter(object)
+
+def fetch_with_retries(fetch, what, rate_limiter, max_attempts=5, backoff_s=2.0, max_backoff_s=60.0):
+    """Call `fetch`, which makes an API request and returns a requests.Response, retrying with exponential backoff
+    on errors and on responses indicating a transient problem (HTTP status 429 or 5xx).
+
+    Args:
+      fetch: function of no arguments making the request
+      what: description of the request, for log messages
+      rate_limiter: RateLimiter shared by all requests to the API
+    """
+    for attempt in range(max_attempts):
+        rate_limiter.wait()
+        try:
+            response = fetch()
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            problem = f'HTTP status {response.status_code}'
+        except Exception as e:
+            problem = repr(e)
+        if attempt+1 < max_attempts:
+            delay_s = min(max_backoff_s, backoff_s * 2**attempt) * random.uniform(0.5, 1.5)
+            _log.warning(f'{what}: {problem}; retrying in {delay_s:.1f}s')
+            time.sleep(delay_s)
+    raise RuntimeError(f'{what}: giving up after {max_attempts} attempts: {problem}')
+
+def find_subworkflow_ids(workflow_metadata):
+    """Return the ids of the subworkflows called by a workflow, including, if the metadata has expanded
+    subworkflows, the subworkflows nested within them"""
+    subworkflow_ids = []
+    metadatas = [workflow_metadata]
+    while metadatas:
+        for call_attempts in metadatas.pop().get('calls', {}).values():
+            for call in call_attempts:
+                if 'subWorkflowId' in call:
+                    subworkflow_ids.append(call['subWorkflowId'])
+                if 'subWorkflowMetadata' in call:
+                    metadatas.append(call['subWorkflowMetadata'])
+    return subworkflow_ids
+
+class WorkflowMetadataCache(object):
+    """On-disk cache of the metadata of finished workflows, keyed by workflow id.
+
+    Only metadata of workflows in one of TERMINAL_WORKFLOW_STATUSES is stored, since metadata of unfinished workflows
+    will change.
+    """
+
+    def __init__(self, cache_dir, expand_subworkflows):
+        self.cache_dir = cache_dir
+        self.fname_suffix = '.expanded.mdata.json.gz' if expand_subworkflows else '.mdata.json.gz'
+        misc_utils.mkdir_p(cache_dir)
+
+    def _fname(self, workflow_id):
+        return os.path.join(self.cache_dir, f'{workflow_id}{self.fname_suffix}')
+
+    def get(self, workflow_id):
+        """Return the cached metadata of the given workflow, or None if not cached"""
+        fname = self._fname(workflow_id)
+        if not os.path.isfile(fname):
+            return None
+        try:
+            with gzip.open(fname, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            _log.warning(f'Ignoring unreadable cached metadata {fname}: {e}')
+            return None
+
+    def put(self, workflow_id, workflow_metadata):
+        """Store the metadata of the given workflow, if it has finished"""
+        if workflow_metadata.get('status') not in TERMINAL_WORKFLOW_STATUSES:
+            return
+        fname = self._fname(workflow_id)
+        fname_tmp = f'{fname}.tmp{threading.get_ident()}'
+        with gzip.open(fname_tmp, 'wt') as out:
+            json.dump(workflow_metadata, out)
+        os.replace(fname_tmp, fname)
+# end: class WorkflowMetadataCache(object)
+
+def crawl_workflow_metadata(root_workflow_id, fetch_metadata, cache=None, max_workers=8):
+    """Get the metadata of a workflow and, recursively, of all its subworkflows, fetching the metadata of up to
+    `max_workers` workflows concurrently.
+
+    Args:
+      root_workflow_id: id of the workflow from which to start
+      fetch_metadata: function mapping a workflow id to the workflow's metadata, as parsed json
+      cache: if given, a WorkflowMetadataCache from which to take the metadata of already-fetched finished workflows,
+        and to which to add newly fetched finished workflows
+
+    Yields:
+      a tuple (workflow_id, workflow_metadata, from_cache) for each workflow, in order of completion
+    """
+    def get_metadata(workflow_id):
+        workflow_metadata = cache.get(workflow_id) if cache else None
+        if workflow_metadata is not None:
+            return workflow_metadata, True
+        workflow_metadata = fetch_metadata(workflow_id)
+        if cache:
+            cache.put(workflow_id, workflow_metadata)
+        return workflow_metadata, False
+
+    seen_workflow_ids = {root_workflow_id}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(get_metadata, root_workflow_id): root_workflow_id}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                workflow_id = pending.pop(future)
+                try:
+                    workflow_metadata, from_cache = future.result()
+                except Exception as e:
+                    _log.error(f'Error getting metadata for workflow {workflow_id}: {e}')
+                    workflow_metadata, from_cache = {}, False
+                for subworkflow_id in find_subworkflow_ids(workflow_metadata):
+                    if subworkflow_id not in seen_workflow_ids:
+                        _log.debug(f'Found subworkflow id: {subworkflow_id}')
+                        seen_workflow_ids.add(subworkflow_id)
+                        pending[executor.submit(get_metadata, subworkflow_id)] = subworkflow_id
+                yield workflow_id, workflow_metadata, from_cache
+# end: def crawl_workflow_metadata(root_workflow_id, fetch_metadata, cache=None, max_workers=8)
+
 def do_list_submissions(args):
     """Lists workflow submissions in Terra"""
 
@@ -275,6 +418,9 @@ def do_list_submissions(args):
                             misc_utils.string_to_file_name(os.path.basename(f)))
 
     misc_utils.write_json_and_org(safe_fname(f'{args.tmp_dir}/submissions.json'), **{'result': list(z.json())})
+    rate_limiter = RateLimiter(max_per_s=args.max_requests_per_s)
+    cache = WorkflowMetadataCache(cache_dir=args.metadata_cache_dir or os.path.join(args.tmp_dir, 'workflow_metadata_cache'),
+                                  expand_subworkflows=args.expand_subworkflows)
     tot_time = 0
     for submission_idx, s in enumerate(sorted(list(z.json()), key=operator.itemgetter('submissionDate'), reverse=True)):
         _log.info(f'looking at submission from {s["submissionDate"]}')
@@ -291,7 +437,9 @@ def do_list_submissions(args):
         if args.method_config and method_configuration_name != args.method_config:
             _log.info(f'skipping submission since method config does not match {args.method_config=}')
             continue
-        y = fapi.get_submission(namespace=SEL_NAMESPACE, workspace=SEL_WORKSPACE, submission_id=submission_id).json()
+        y = fetch_with_retries(lambda: fapi.get_submission(namespace=SEL_NAMESPACE, workspace=SEL_WORKSPACE,
+                                                           submission_id=submission_id),
+                               what=f'submission {submission_id}', rate_limiter=rate_limiter).json()
         _log.info('got submission')
         misc_utils.write_json_and_org(safe_fname(f'{args.tmp_dir}/{method_configuration_name}.{submission_date}.{submission_idx}.'
                                                  f'{submission_id}'
@@ -302,27 +450,24 @@ def do_list_submissions(args):
         _log.info(f"getting workflow metadata for workflow id {y['workflows'][0]['workflowId']}")
         beg = time.time()
 
-        workflow_ids = [y['workflows'][0]['workflowId']]
-        while workflow_ids:
-            workflow_id = workflow_ids.pop()
+        def fetch_metadata(workflow_id):
             _log.info(f'PROCESSING WORKFLOW: {workflow_id}')
-
-            time.sleep(1)
-            zz_result = get_workflow_metadata_gz(namespace=SEL_NAMESPACE, workspace=SEL_WORKSPACE, submission_id=submission_id,
-                                                 workflow_id=workflow_id, expand_subworkflows=args.expand_subworkflows)
-            # #print('ZZ_RESULT: ', type(zz_result), dir(zz_result), zz_result)
-            # for f in dir(zz_result):
-            #     _log.debug(f'  {f} = {getattr(zz_result, f)}')
-            # #print('ZZ_RESULT.raw: ', type(zz_result.raw), dir(zz_result.raw), zz_result.raw)
-            # for f in dir(zz_result.raw):
-            #     _log.debug(f'  {f} = {getattr(zz_result.raw, f)}')
-            # _log.debug(f'converting workflow metadata to json')
+            zz_result = fetch_with_retries(lambda: get_workflow_metadata_gz(namespace=SEL_NAMESPACE, workspace=SEL_WORKSPACE,
+                                                                            submission_id=submission_id, workflow_id=workflow_id,
+                                                                            expand_subworkflows=args.expand_subworkflows),
+                                           what=f'workflow {workflow_id} metadata', rate_limiter=rate_limiter)
             try:
-                zz = zz_result.json()
+                return zz_result.json()
             except Exception as e:
                 _log.error(f'Error converting to json: {e}')
-                zz = {}
-            tot_time += (time.time() - beg)
+                return {}
+
+        n_workflows = n_from_cache = 0
+        for workflow_id, zz, from_cache in crawl_workflow_metadata(root_workflow_id=y['workflows'][0]['workflowId'],
+                                                                   fetch_metadata=fetch_metadata, cache=cache,
+                                                                   max_workers=args.max_concurrent_requests):
+            n_workflows += 1
+            n_from_cache += int(from_cache)
             _log.debug(f'saving workflow metadata')
             workflow_name = zz.get('workflowName', 'no_wf_name')
             misc_utils.write_json_and_org(safe_fname(f'{args.tmp_dir}/{method_configuration_name}.{submission_date}.{submission_idx}.'
@@ -332,22 +477,8 @@ def do_list_submissions(args):
                 misc_utils.dump_file(fname=safe_fname(f'{args.tmp_dir}/{method_configuration_name}.{submission_date}.{submission_idx}.'
                                                       f'{submission_id}.{workflow_id}.workflow.wdl'),
                                      value=zz['submittedFiles']['workflow'])
-
-            jsons = [zz]
-            while jsons:
-                js = jsons.pop()
-                #print('EXAMINING js: ', js)
-                if isinstance(js, list):
-                    jsons.extend(js)
-                elif isinstance(js, dict):
-                    if 'subWorkflowId' in js:
-                        _log.debug(f'Found subworkflow id: {js["subWorkflowId"]}')
-                        workflow_ids.append(js['subWorkflowId'])
-                    jsons.extend(list(js.values()))
-                else:
-                    if 'subWorkflowId' in str(js):
-                        raise RuntimeError(f'Missed subworkflowId in {js}')
-
+        tot_time += (time.time() - beg)
+        _log.info(f'got metadata of {n_workflows} workflows, {n_from_cache} of them from cache')
 
         #succ = [v["succeeded"] for v in zz['outputs']["run_sims_cosi2.replicaInfos"]]
         #print(f'Succeeded: {sum(succ)} of {len(succ)}')
@@ -396,7 +527,12 @@ def parse_args():
 
     @subcommand([argument('-s', '--submission-date', default=datetime.datetime.now().strftime('%Y-%m-%d'), help='submission date'),
                  argument('--expand-subworkflows', action='store_true'),
-                 argument('--method-config', help='only look at submissions where method config matches this')])
+                 argument('--method-config', help='only look at submissions where method config matches this'),
+                 argument('--max-concurrent-requests', type=int, default=8,
+                          help='max number of workflow metadata requests in flight at once'),
+                 argument('--max-requests-per-s', type=float, default=4.0, help='max rate of requests to the Terra API'),
+                 argument('--metadata-cache-dir',
+                          help='cache of metadata of finished workflows; defaults to workflow_metadata_cache under --tmp-dir')])
     def list_submissions(args):
         do_list_submissions(args)
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""Analyze workflow runs from the Cromwell workflow metadata saved by `terra_utils.py list_submissions`.
+
+Parses the saved *.mdata.json files into a table with one row per task call attempt (task name, shard, attempt,
+preemption, start/end times, requested cpu/memory, and selected inputs such as the number of hapsets), and writes
+summary tables of per-task wall time distributions, of time lost to preempted attempts, and of straggler shards
+(shards that ran much longer than other shards of the same scatter).  Metadata files are parsed incrementally, one
+call at a time, so that large files need not fit in memory.
+"""
+
+# * imports etc
+
+import argparse
+import glob
+import logging
+import os
+import os.path
+import re
+import sys
+
+import pandas as pd
+
+# our imports: the misc_utils shared with the pipeline scripts in the parent dir, rather than the older terra/ copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import misc_utils
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+# * Parsing metadata
+
+def iter_metadata(mdata_json, chunk_size=1 << 20):
+    """Parse a workflow metadata file incrementally.
+
+    Yields:
+      ('workflow', key, value) for each top-level key other than 'calls', and
+      ('call', call_name, call_attempt) for each call attempt in 'calls'
+    """
+    with misc_utils.open_or_gzopen(mdata_json, 'rt') as f:
+        scanner = misc_utils.JsonScanner(f, fname=mdata_json, chunk_size=chunk_size)
+        for key in scanner.iter_object_keys():
+            if key == 'calls':
+                for call_name in scanner.iter_object_keys():
+                    for call_attempt in scanner.iter_array():
+                        yield 'call', call_name, call_attempt
+            else:
+                yield 'workflow', key, scanner.value()
+
+def _parse_memory_gb(memory):
+    """Parse a Cromwell memory spec such as '3 GB' or '3.5 GiB' into GB"""
+    m = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', str(memory or ''), flags=re.IGNORECASE)
+    if not m:
+        return None
+    return float(m.group(1)) * {'': 1e-9, 'K': 1e-6, 'M': 1e-3, 'G': 1.0, 'T': 1e3}[m.group(2).upper()]
+
+# inputs of interest: name of the column in the calls table -> function computing it from a call's inputs
+CALL_INPUT_COLS = {
+    'n_hapsets': lambda inputs: len(inputs['hapsets']) if isinstance(inputs.get('hapsets'), list) else None,
+    'n_reps': lambda inputs: inputs.get('numRepsPerBlock'),
+}
+
+def metadata_to_call_rows(mdata_json):
+    """Return a list of dicts, one per task call attempt in the given workflow metadata file.
+
+    Calls of subworkflows are skipped, since the metadata of each subworkflow is saved in its own file.
+    """
+    workflow_info = {}
+    call_rows = []
+    for kind, key, value in iter_metadata(mdata_json):
+        if kind == 'workflow':
+            if key in ('id', 'workflowName', 'status'):
+                workflow_info[key] = value
+            continue
+        call_name, call = key, value
+        if 'subWorkflowId' in call or 'subWorkflowMetadata' in call:
+            continue
+        runtime_attrs = call.get('runtimeAttributes', {})
+        inputs = call.get('inputs', {})
+        call_row = dict(call=call_name,
+                        task=call_name.split('.')[-1],
+                        shard=call.get('shardIndex', -1),
+                        attempt=call.get('attempt', 1),
+                        execution_status=call.get('executionStatus'),
+                        preempted=call.get('executionStatus') in ('RetryableFailure', 'Preempted'),
+                        call_cached=bool(call.get('callCaching', {}).get('hit', False)),
+                        start=call.get('start'),
+                        end=call.get('end'),
+                        cpu=pd.to_numeric(runtime_attrs.get('cpu'), errors='coerce'),
+                        memory_gb=_parse_memory_gb(runtime_attrs.get('memory')),
+                        preemptible=runtime_attrs.get('preemptible'))
+        for col, get_col in CALL_INPUT_COLS.items():
+            call_row[col] = get_col(inputs)
+        call_rows.append(call_row)
+    for call_row in call_rows:
+        call_row.update(workflow_id=workflow_info.get('id'), workflow_name=workflow_info.get('workflowName'),
+                        workflow_status=workflow_info.get('status'), mdata_json=os.path.basename(mdata_json))
+    return call_rows
+# end: def metadata_to_call_rows(mdata_json)
+
+def load_calls(mdata_jsons):
+    """Construct the calls table from the given metadata files.  Call attempts seen in more than one file
+    (e.g. from repeated listings of a submission) are kept once, from the most recently modified file."""
+    call_rows = []
+    for mdata_json in sorted(mdata_jsons, key=os.path.getmtime):
+        try:
+            call_rows.extend(metadata_to_call_rows(mdata_json))
+        except ValueError as e:
+            _log.warning(f'Skipping unparseable metadata file {mdata_json}: {e}')
+    calls = pd.DataFrame(call_rows, columns=['workflow_name', 'workflow_id', 'workflow_status', 'call', 'task',
+                                             'shard', 'attempt', 'execution_status', 'preempted', 'call_cached',
+                                             'start', 'end', 'cpu', 'memory_gb', 'preemptible']
+                         + list(CALL_INPUT_COLS) + ['mdata_json'])
+    calls = calls.drop_duplicates(subset=['workflow_id', 'call', 'shard', 'attempt'], keep='last')
+    for col in ('start', 'end'):
+        calls[col] = pd.to_datetime(calls[col], utc=True)
+    calls['wall_s'] = (calls['end'] - calls['start']).dt.total_seconds()
+    calls['cpu_hours'] = calls['wall_s'] * calls['cpu'] / 3600
+    return calls.sort_values(['workflow_name', 'workflow_id', 'call', 'shard', 'attempt']).reset_index(drop=True)
+
+# * Summaries
+
+def summarize_task_times(calls):
+    """Per-task distribution of the wall times of call attempts that ran (were not call-cached)"""
+    ran = calls[~calls['call_cached'] & calls['wall_s'].notna()]
+    if ran.empty:
+        # groupby().describe() of no rows has no index levels to join on
+        return pd.DataFrame(columns=['count', 'mean', 'std', 'min', '50%', '90%', '99%', 'max',
+                                     'total_wall_s', 'total_cpu_hours'],
+                            index=pd.MultiIndex.from_tuples([], names=['workflow_name', 'task']))
+    return ran.groupby(['workflow_name', 'task'])['wall_s'] \
+        .describe(percentiles=[.5, .9, .99]) \
+        .join(ran.groupby(['workflow_name', 'task']).agg(total_wall_s=('wall_s', 'sum'),
+                                                         total_cpu_hours=('cpu_hours', 'sum'))) \
+        .sort_values('total_cpu_hours', ascending=False)
+
+def summarize_preemption(calls):
+    """Per-task time spent in preempted attempts, whose work was lost"""
+    by_task = calls.assign(preempted_wall_s=calls['wall_s'].where(calls['preempted'], 0.0),
+                           preempted_cpu_hours=calls['cpu_hours'].where(calls['preempted'], 0.0)) \
+        .groupby(['workflow_name', 'task'])
+    preemption = by_task.agg(n_attempts=('attempt', 'size'), n_preempted=('preempted', 'sum'),
+                             total_cpu_hours=('cpu_hours', 'sum'), preempted_wall_s=('preempted_wall_s', 'sum'),
+                             preempted_cpu_hours=('preempted_cpu_hours', 'sum'))
+    preemption['frac_cpu_hours_preempted'] = preemption['preempted_cpu_hours'] / preemption['total_cpu_hours']
+    return preemption.sort_values('preempted_cpu_hours', ascending=False)
+
+def find_stragglers(calls, min_shards, straggler_ratio):
+    """Find shards of scatters whose final attempt took at least `straggler_ratio` times the median wall time
+    of the final attempts of the scatter's shards"""
+    final_attempts = calls[(calls['shard'] >= 0) & ~calls['call_cached'] & calls['wall_s'].notna()] \
+        .sort_values('attempt').groupby(['workflow_id', 'call', 'shard']).tail(1)
+    scatter_cols = ['workflow_name', 'workflow_id', 'call']
+    scatter_stats = final_attempts.groupby(scatter_cols)['wall_s'].agg(n_shards='size', median_wall_s='median',
+                                                                         max_wall_s='max')
+    scatter_stats = scatter_stats[scatter_stats['n_shards'] >= min_shards]
+    stragglers = final_attempts.join(scatter_stats, on=scatter_cols, how='inner')
+    stragglers['ratio_to_median'] = stragglers['wall_s'] / stragglers['median_wall_s']
+    stragglers = stragglers[stragglers['ratio_to_median'] >= straggler_ratio]
+    return stragglers[scatter_cols + ['task', 'shard', 'attempt', 'wall_s', 'median_wall_s', 'ratio_to_median',
+                                      'n_shards', 'cpu', 'memory_gb'] + list(CALL_INPUT_COLS)] \
+        .sort_values('ratio_to_median', ascending=False)
+
+# * workflow_run_stats
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--mdata-jsons', nargs='+', default=[os.path.join('tmp', '*.mdata.json')],
+                        help='workflow metadata files saved by terra_utils.py list_submissions; glob patterns are expanded')
+    parser.add_argument('--workflow-names', nargs='+',
+                        help='only analyze workflows with these names (e.g. run_sims_cosi2 compute_normalization_stats)')
+    parser.add_argument('--min-shards', type=int, default=10,
+                        help='only look for stragglers in scatters with at least this many shards')
+    parser.add_argument('--straggler-ratio', type=float, default=2.0,
+                        help='a shard is a straggler if its wall time is at least this multiple of the median')
+    parser.add_argument('--out-prefix', required=True,
+                        help='write the calls table and summaries to files with this prefix')
+
+    return parser.parse_args()
+
+def workflow_run_stats(args):
+    """Build the calls table and the summaries"""
+    mdata_jsons = sorted(set(fname for pattern in args.mdata_jsons for fname in (glob.glob(pattern) or [pattern])))
+    misc_utils.chk(all(map(os.path.isfile, mdata_jsons)), f'missing metadata files: {[f for f in mdata_jsons if not os.path.isfile(f)]}')
+    _log.info(f'Parsing {len(mdata_jsons)} metadata files')
+    calls = load_calls(mdata_jsons)
+    if args.workflow_names:
+        calls = calls[calls['workflow_name'].isin(args.workflow_names)]
+    _log.info(f'{len(calls)} call attempts in {calls["workflow_id"].nunique()} workflows')
+
+    calls.to_csv(f'{args.out_prefix}.calls.tsv', sep='\t', index=False, na_rep='nan')
+    task_times = summarize_task_times(calls)
+    task_times.to_csv(f'{args.out_prefix}.task_times.tsv', sep='\t', na_rep='nan')
+    preemption = summarize_preemption(calls)
+    preemption.to_csv(f'{args.out_prefix}.preemption.tsv', sep='\t', na_rep='nan')
+    stragglers = find_stragglers(calls, min_shards=args.min_shards, straggler_ratio=args.straggler_ratio)
+    stragglers.to_csv(f'{args.out_prefix}.stragglers.tsv', sep='\t', index=False, na_rep='nan')
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        _log.info(f'Tasks by total cpu hours:\n{task_times.head(20)}')
+        _log.info(f'Preemption waste:\n{preemption.head(20)}')
+        _log.info(f'{len(stragglers)} straggler shards; worst:\n{stragglers.head(20)}')
+# end: def workflow_run_stats(args)
+
+if __name__=='__main__':
+    workflow_run_stats(parse_args())
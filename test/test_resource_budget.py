@@ -0,0 +1,206 @@
+"""Tests of misc_utils.get_resource_budget(), on fake cgroup and proc filesystems"""
+
+import os
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import misc_utils
+
+# * Utils
+
+GiB = 2 ** 30
+
+def _write(root, rel_path, contents):
+    fname = os.path.join(str(root), rel_path)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as out:
+        out.write(contents)
+
+def _make_dir(root, rel_path):
+    os.makedirs(os.path.join(str(root), rel_path), exist_ok=True)
+
+@pytest.fixture
+def roots(tmp_path):
+    """Return (cgroup_root, proc_root, proc_self_cgroup) under a temp dir"""
+    cgroup_root, proc_root = tmp_path / 'cgroup', tmp_path / 'proc'
+    cgroup_root.mkdir()
+    _write(proc_root, 'meminfo', f'MemTotal:       {64 * GiB // 1024} kB\nMemFree:        1024 kB\n')
+    return str(cgroup_root), str(proc_root), os.path.join(str(proc_root), 'self', 'cgroup')
+
+@pytest.fixture
+def eight_cpus(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+
+# * cgroup v2
+
+def _make_v2(cgroup_root, proc_root):
+    _write(proc_root, 'self/cgroup', '0::/kubepods/pod1/ctr1\n')
+    _write(cgroup_root, 'cgroup.controllers', 'cpu memory\n')
+    _make_dir(cgroup_root, 'kubepods/pod1/ctr1')
+
+def test_v2_dirs_innermost_first(roots):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    assert misc_utils._cgroup_dirs('cpu', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == \
+        [(2, os.path.join(cgroup_root, 'kubepods/pod1/ctr1')), (2, os.path.join(cgroup_root, 'kubepods/pod1')),
+         (2, os.path.join(cgroup_root, 'kubepods')), (2, cgroup_root)]
+
+def test_v2_nested_cpu_quota_and_no_mem_limit(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    _write(cgroup_root, 'kubepods/pod1/ctr1/cpu.max', 'max 100000\n')
+    _write(cgroup_root, 'kubepods/pod1/cpu.max', '250000 100000\n')
+    _write(cgroup_root, 'kubepods/cpu.max', '600000 100000\n')
+    _write(cgroup_root, 'kubepods/pod1/ctr1/memory.max', 'max\n')
+    _write(cgroup_root, 'kubepods/memory.max', 'max\n')
+
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == 2.5
+    assert misc_utils._cgroup_mem_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=2, mem_bytes=64 * GiB)
+
+def test_v2_mem_limit_of_enclosing_cgroup(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    _write(cgroup_root, 'kubepods/pod1/ctr1/memory.max', 'max\n')
+    _write(cgroup_root, 'kubepods/pod1/memory.max', f'{4 * GiB}\n')
+    _write(cgroup_root, 'kubepods/memory.max', f'{16 * GiB}\n')
+
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=4 * GiB)
+
+def test_v2_cpu_quota_below_one_cpu(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    _write(cgroup_root, 'kubepods/pod1/ctr1/cpu.max', '50000 100000\n')
+
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root).n_cpus == 1
+
+def test_v2_namespaced_root(roots, eight_cpus):
+    """Inside a container with a cgroup namespace, the process's cgroup is "/" and is mounted as the root"""
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _write(proc_root, 'self/cgroup', '0::/\n')
+    _write(cgroup_root, 'cgroup.controllers', 'cpu memory\n')
+    _write(cgroup_root, 'cpu.max', '300000 100000\n')
+    _write(cgroup_root, 'memory.max', f'{2 * GiB}\n')
+
+    assert misc_utils._cgroup_dirs('memory', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == \
+        [(2, cgroup_root)]
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=3, mem_bytes=2 * GiB)
+
+# * cgroup v1
+
+def _make_v1(cgroup_root, proc_root):
+    _write(proc_root, 'self/cgroup',
+           '12:memory:/docker/abc\n'
+           '11:cpu,cpuacct:/docker/abc\n'
+           '10:pids:/docker/abc\n'
+           '1:name=systemd:/docker/abc\n')
+    for controllers in ('memory', 'cpu,cpuacct', 'pids'):
+        _make_dir(cgroup_root, f'{controllers}/docker/abc')
+
+def test_v1_combined_cpu_dir(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v1(cgroup_root, proc_root)
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '400000\n')
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_period_us', '100000\n')
+    _write(cgroup_root, 'cpu,cpuacct/cpu.cfs_quota_us', '-1\n')
+    _write(cgroup_root, 'cpu,cpuacct/cpu.cfs_period_us', '100000\n')
+    _write(cgroup_root, 'memory/docker/abc/memory.limit_in_bytes', f'{8 * GiB}\n')
+
+    assert misc_utils._cgroup_dirs('cpu', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == \
+        [(1, os.path.join(cgroup_root, 'cpu,cpuacct/docker/abc')), (1, os.path.join(cgroup_root, 'cpu,cpuacct/docker')),
+         (1, os.path.join(cgroup_root, 'cpu,cpuacct'))]
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == 4
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=4, mem_bytes=8 * GiB)
+
+def test_v1_cpu_dir_mounted_by_controller_name(roots, eight_cpus):
+    """Some hosts mount the combined cpu,cpuacct hierarchy at cpu (e.g. with cpu,cpuacct a symlink to it)"""
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _write(proc_root, 'self/cgroup', '11:cpu,cpuacct:/docker/abc\n')
+    _write(cgroup_root, 'cpu/docker/abc/cpu.cfs_quota_us', '150000\n')
+    _write(cgroup_root, 'cpu/docker/abc/cpu.cfs_period_us', '100000\n')
+
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == 1.5
+
+def test_v1_no_limits(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v1(cgroup_root, proc_root)
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '-1\n')
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_period_us', '100000\n')
+    # v1 reports no memory limit as 2**63 rounded down to a page boundary
+    _write(cgroup_root, 'memory/docker/abc/memory.limit_in_bytes', f'{2 ** 63 - 4096}\n')
+
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+    assert misc_utils._cgroup_mem_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=64 * GiB)
+
+# * Hybrid v1/v2
+
+def test_hybrid_uses_unified_mount(roots, eight_cpus):
+    """On hybrid hosts, the v2 hierarchy is mounted at <cgroup_root>/unified, and holds no cpu or memory limits;
+    the limits come from the v1 hierarchies"""
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _write(proc_root, 'self/cgroup',
+           '11:cpu,cpuacct:/docker/abc\n'
+           '10:memory:/docker/abc\n'
+           '0::/docker/abc\n')
+    _write(cgroup_root, 'unified/cgroup.controllers', '\n')
+    _make_dir(cgroup_root, 'unified/docker/abc')
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '200000\n')
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_period_us', '100000\n')
+    _write(cgroup_root, 'memory/docker/abc/memory.limit_in_bytes', f'{3 * GiB}\n')
+
+    assert misc_utils._cgroup_dirs('memory', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == \
+        [(1, os.path.join(cgroup_root, 'memory/docker/abc')), (1, os.path.join(cgroup_root, 'memory/docker')),
+         (1, os.path.join(cgroup_root, 'memory')),
+         (2, os.path.join(cgroup_root, 'unified/docker/abc')), (2, os.path.join(cgroup_root, 'unified/docker')),
+         (2, os.path.join(cgroup_root, 'unified'))]
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=2, mem_bytes=3 * GiB)
+
+# * Missing or unreadable files
+
+def test_no_cgroup_files(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+
+    assert misc_utils._cgroup_dirs('cpu', cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) == []
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=64 * GiB)
+
+def test_no_proc_files(tmp_path, eight_cpus):
+    assert misc_utils.get_resource_budget(cgroup_root=str(tmp_path / 'cgroup'), proc_root=str(tmp_path / 'proc')) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=None)
+
+def test_cgroup_dirs_without_limit_files(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    _make_v1(cgroup_root, proc_root)
+
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+    assert misc_utils._cgroup_mem_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=64 * GiB)
+
+def test_v1_missing_cfs_period(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v1(cgroup_root, proc_root)
+    _write(cgroup_root, 'cpu,cpuacct/docker/abc/cpu.cfs_quota_us', '200000\n')
+
+    assert misc_utils._cgroup_cpu_limit(cgroup_root=cgroup_root, proc_self_cgroup=proc_self_cgroup) is None
+
+def test_malformed_limits(roots, eight_cpus):
+    cgroup_root, proc_root, proc_self_cgroup = roots
+    _make_v2(cgroup_root, proc_root)
+    _write(cgroup_root, 'kubepods/pod1/ctr1/cpu.max', 'garbage\n')
+    _write(cgroup_root, 'kubepods/pod1/ctr1/memory.max', 'lots\n')
+
+    assert misc_utils.get_resource_budget(cgroup_root=cgroup_root, proc_root=proc_root) == \
+        misc_utils.ResourceBudget(n_cpus=8, mem_bytes=64 * GiB)
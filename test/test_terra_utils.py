@@ -0,0 +1,338 @@
+"""Tests of the workflow metadata crawling in terra/terra_utils.py"""
+
+import collections
+import gzip
+import http.server
+import importlib
+import importlib.util
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+
+import pytest
+
+TERRA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'terra')
+
+# * Fixtures
+
+@pytest.fixture(scope='module')
+def terra_utils():
+    """Import terra_utils, with the terra/ copy of misc_utils it expects.  The code tested here does not call
+    the firecloud API, so where firecloud is not installed, an empty module stands in for it."""
+    with pytest.MonkeyPatch.context() as mp:
+        if importlib.util.find_spec('firecloud') is None:
+            firecloud = types.ModuleType('firecloud')
+            firecloud.api = types.ModuleType('firecloud.api')
+            mp.setitem(sys.modules, 'firecloud', firecloud)
+            mp.setitem(sys.modules, 'firecloud.api', firecloud.api)
+        mp.setenv('QUAY_CMS_TOKEN', os.environ.get('QUAY_CMS_TOKEN', 'test-token'))  # read at import time
+        mp.syspath_prepend(TERRA_DIR)
+        mp.delitem(sys.modules, 'misc_utils', raising=False)
+        mp.delitem(sys.modules, 'terra_utils', raising=False)
+        yield importlib.import_module('terra_utils')
+
+@pytest.fixture
+def fake_clock(terra_utils, monkeypatch):
+    """Replace time.monotonic() and time.sleep() with a clock that advances only when slept on"""
+    clock = types.SimpleNamespace(now=1000.0, sleeps=[])
+
+    def sleep(s):
+        clock.sleeps.append(s)
+        clock.now += s
+
+    monkeypatch.setattr(time, 'monotonic', lambda: clock.now)
+    monkeypatch.setattr(time, 'sleep', sleep)
+    return clock
+
+# * Fake Cromwell metadata
+
+def _call(**kw):
+    return [dict(kw)]
+
+# workflow id -> metadata.  sub2 is called from both the root and sub1; sub3 is called only from within the expanded
+# metadata of sub1 embedded in the root's metadata.
+WORKFLOWS = {
+    'root': dict(status='Succeeded', calls={
+        'wf.a': _call(subWorkflowId='sub1', subWorkflowMetadata=dict(calls={'sub1.c': _call(subWorkflowId='sub3')})),
+        'wf.b': [dict(subWorkflowId='sub2', shardIndex=0), dict(subWorkflowId='sub2', shardIndex=0, attempt=2)],
+        'wf.task': _call(jobId='1'),
+    }),
+    'sub1': dict(status='Running', calls={'sub1.b': _call(subWorkflowId='sub2'), 'sub1.c': _call(subWorkflowId='sub3')}),
+    'sub2': dict(status='Failed', calls={'sub2.task': _call(jobId='2')}),
+    'sub3': dict(status='Aborted', calls={}),
+}
+
+class FakeFetcher(object):
+    """Returns the metadata from WORKFLOWS, counting the fetches of each workflow"""
+
+    def __init__(self, workflows=WORKFLOWS, fail_ids=()):
+        self.workflows = workflows
+        self.fail_ids = set(fail_ids)
+        self.n_fetches = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, workflow_id):
+        with self.lock:
+            self.n_fetches[workflow_id] += 1
+        if workflow_id in self.fail_ids:
+            raise RuntimeError(f'cannot fetch {workflow_id}')
+        return self.workflows[workflow_id]
+
+def _crawl(terra_utils, fetch_metadata, cache=None, max_workers=4):
+    return {workflow_id: (workflow_metadata, from_cache)
+            for workflow_id, workflow_metadata, from_cache in
+            terra_utils.crawl_workflow_metadata(root_workflow_id='root', fetch_metadata=fetch_metadata, cache=cache,
+                                                max_workers=max_workers)}
+
+# * crawl_workflow_metadata
+
+def test_find_subworkflow_ids(terra_utils):
+    assert sorted(terra_utils.find_subworkflow_ids(WORKFLOWS['root'])) == ['sub1', 'sub2', 'sub2', 'sub3']
+    assert terra_utils.find_subworkflow_ids({}) == []
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_crawl_finds_all_subworkflows_once(terra_utils, max_workers):
+    fetch_metadata = FakeFetcher()
+    crawled = _crawl(terra_utils, fetch_metadata, max_workers=max_workers)
+    assert crawled == {workflow_id: (workflow_metadata, False) for workflow_id, workflow_metadata in WORKFLOWS.items()}
+    assert fetch_metadata.n_fetches == collections.Counter(WORKFLOWS.keys())
+
+def test_crawl_yields_each_workflow_once(terra_utils):
+    workflow_ids = [workflow_id for workflow_id, _, _ in
+                    terra_utils.crawl_workflow_metadata(root_workflow_id='root', fetch_metadata=FakeFetcher())]
+    assert sorted(workflow_ids) == sorted(WORKFLOWS)
+
+def test_crawl_continues_past_fetch_errors(terra_utils):
+    fetch_metadata = FakeFetcher(fail_ids=['sub1'])
+    crawled = _crawl(terra_utils, fetch_metadata)
+    # sub3 is still found, from the expanded metadata of sub1 in the root's metadata
+    assert crawled['sub1'] == ({}, False)
+    assert set(crawled) == set(WORKFLOWS)
+    assert fetch_metadata.n_fetches == collections.Counter(WORKFLOWS.keys())
+
+# * WorkflowMetadataCache
+
+def test_crawl_reuses_cache_only_for_terminal_statuses(terra_utils, tmp_path):
+    cache = terra_utils.WorkflowMetadataCache(str(tmp_path / 'cache'), expand_subworkflows=False)
+
+    first_fetch = FakeFetcher()
+    assert _crawl(terra_utils, first_fetch, cache=cache) == \
+        {workflow_id: (workflow_metadata, False) for workflow_id, workflow_metadata in WORKFLOWS.items()}
+
+    second_fetch = FakeFetcher()
+    crawled = _crawl(terra_utils, second_fetch, cache=cache)
+    assert crawled == {workflow_id: (workflow_metadata, workflow_id != 'sub1')
+                       for workflow_id, workflow_metadata in WORKFLOWS.items()}
+    # sub1 is still running, so was not cached
+    assert second_fetch.n_fetches == collections.Counter(['sub1'])
+
+def test_cache_stores_only_terminal_statuses(terra_utils, tmp_path):
+    cache = terra_utils.WorkflowMetadataCache(str(tmp_path), expand_subworkflows=True)
+    for status in terra_utils.TERMINAL_WORKFLOW_STATUSES:
+        cache.put(f'wf_{status}', dict(status=status))
+        assert cache.get(f'wf_{status}') == dict(status=status)
+    for status in ('Submitted', 'Running', 'Aborting', None):
+        cache.put(f'wf_{status}', dict(status=status))
+        assert cache.get(f'wf_{status}') is None
+    assert sorted(os.listdir(str(tmp_path))) == \
+        sorted(f'wf_{status}.expanded.mdata.json.gz' for status in terra_utils.TERMINAL_WORKFLOW_STATUSES)
+
+def test_cache_keeps_expanded_and_unexpanded_metadata_apart(terra_utils, tmp_path):
+    cache_expanded = terra_utils.WorkflowMetadataCache(str(tmp_path), expand_subworkflows=True)
+    cache_unexpanded = terra_utils.WorkflowMetadataCache(str(tmp_path), expand_subworkflows=False)
+    cache_expanded.put('wf', dict(status='Succeeded', expanded=True))
+    assert cache_unexpanded.get('wf') is None
+    assert cache_expanded.get('wf') == dict(status='Succeeded', expanded=True)
+
+def test_cache_ignores_unreadable_entries(terra_utils, tmp_path):
+    cache = terra_utils.WorkflowMetadataCache(str(tmp_path), expand_subworkflows=False)
+    with gzip.open(str(tmp_path / 'wf.mdata.json.gz'), 'wt') as out:
+        out.write('{"status": "Succ')
+    (tmp_path / 'wf2.mdata.json.gz').write_text('not gzipped')
+    assert cache.get('wf') is None
+    assert cache.get('wf2') is None
+
+# * fetch_with_retries
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def _fetcher(*outcomes):
+    """Return a fetch function returning (or, for exceptions, raising) the given outcomes in turn, and the list of
+    outcomes returned so far"""
+    outcomes, returned = list(outcomes), []
+
+    def fetch():
+        outcome = outcomes.pop(0)
+        returned.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+    return fetch, returned
+
+@pytest.mark.parametrize('transient_status', [429, 500, 502, 503])
+def test_fetch_retries_transient_errors(terra_utils, fake_clock, transient_status):
+    fetch, returned = _fetcher(transient_status, transient_status, 200)
+    response = terra_utils.fetch_with_retries(fetch, what='test', rate_limiter=terra_utils.RateLimiter(1000),
+                                              backoff_s=2.0)
+    assert response.status_code == 200
+    assert returned == [transient_status, transient_status, 200]
+    # exponential backoff, with jitter of +-50%, plus the rate limiter's short waits
+    backoff_sleeps = [s for s in fake_clock.sleeps if s > 0.5]
+    assert len(backoff_sleeps) == 2
+    assert 1.0 <= backoff_sleeps[0] <= 3.0
+    assert 2.0 <= backoff_sleeps[1] <= 6.0
+
+def test_fetch_retries_exceptions(terra_utils, fake_clock):
+    fetch, returned = _fetcher(ConnectionError('reset'), 200)
+    assert terra_utils.fetch_with_retries(fetch, what='test', rate_limiter=terra_utils.RateLimiter(1000)).status_code \
+        == 200
+    assert len(returned) == 2
+
+@pytest.mark.parametrize('status', [200, 204, 400, 401, 403, 404])
+def test_fetch_does_not_retry_other_statuses(terra_utils, fake_clock, status):
+    fetch, returned = _fetcher(status, 200)
+    assert terra_utils.fetch_with_retries(fetch, what='test', rate_limiter=terra_utils.RateLimiter(1000)).status_code \
+        == status
+    assert returned == [status]
+    assert fake_clock.sleeps == []
+
+def test_fetch_gives_up(terra_utils, fake_clock):
+    fetch, returned = _fetcher(*([503] * 10))
+    with pytest.raises(RuntimeError, match='giving up after 3 attempts: HTTP status 503'):
+        terra_utils.fetch_with_retries(fetch, what='test', rate_limiter=terra_utils.RateLimiter(1000),
+                                       max_attempts=3, backoff_s=100.0, max_backoff_s=10.0)
+    assert returned == [503] * 3
+    # no sleep after the last attempt, and backoff capped at max_backoff_s
+    backoff_sleeps = [s for s in fake_clock.sleeps if s > 0.5]
+    assert len(backoff_sleeps) == 2
+    assert all(5.0 <= s <= 15.0 for s in backoff_sleeps)
+
+# * RateLimiter
+
+def test_rate_limiter_spaces_events(terra_utils, fake_clock):
+    rate_limiter = terra_utils.RateLimiter(max_per_s=4)
+    event_times = []
+    for _ in range(5):
+        rate_limiter.wait()
+        event_times.append(fake_clock.now)
+    assert event_times == [1000.0, 1000.25, 1000.5, 1000.75, 1001.0]
+
+def test_rate_limiter_does_not_bank_idle_time(terra_utils, fake_clock):
+    rate_limiter = terra_utils.RateLimiter(max_per_s=2)
+    rate_limiter.wait()
+    fake_clock.now += 10.0
+    event_times = []
+    for _ in range(3):
+        rate_limiter.wait()
+        event_times.append(fake_clock.now)
+    assert event_times == [1010.0, 1010.5, 1011.0]
+
+def test_rate_limiter_across_threads(terra_utils):
+    rate_limiter = terra_utils.RateLimiter(max_per_s=100)
+    event_times, lock = [], threading.Lock()
+
+    def worker():
+        for _ in range(5):
+            rate_limiter.wait()
+            with lock:
+                event_times.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    event_times.sort()
+    assert len(event_times) == 20
+    assert event_times[-1] - event_times[0] >= 19 * 0.01 * 0.9
+
+def test_rate_limiter_rejects_bad_rate(terra_utils):
+    with pytest.raises(RuntimeError):
+        terra_utils.RateLimiter(max_per_s=0)
+
+# * Crawling a local fake API server
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serves GET /workflows/<workflow id> from the server's `workflows`, first answering with the error statuses
+    listed in the server's `errors` for that workflow"""
+
+    def do_GET(self):
+        workflow_id = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.n_requests[workflow_id] += 1
+            errors = self.server.errors.get(workflow_id, [])
+            status = errors.pop(0) if errors else (200 if workflow_id in self.server.workflows else 404)
+        body = json.dumps(self.server.workflows[workflow_id] if status == 200 else dict(status=status)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def fake_api_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    server.workflows, server.errors = WORKFLOWS, {}
+    server.n_requests, server.lock = collections.Counter(), threading.Lock()
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server_thread.join()
+
+def _http_get(url):
+    """GET a url, returning a response with the status_code and json() of a requests.Response"""
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            status_code, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status_code, body = e.code, e.read()
+    return types.SimpleNamespace(status_code=status_code, json=lambda: json.loads(body))
+
+def _api_fetcher(terra_utils, server, rate_limiter, max_attempts=5):
+    """Return a fetch_metadata function which gets workflow metadata from the fake API server, as
+    terra_utils.do_list_submissions() does from the Terra API"""
+    def fetch_metadata(workflow_id):
+        response = terra_utils.fetch_with_retries(
+            lambda: _http_get(f'http://127.0.0.1:{server.server_port}/workflows/{workflow_id}'),
+            what=f'workflow {workflow_id} metadata', rate_limiter=rate_limiter,
+            max_attempts=max_attempts, backoff_s=0.01, max_backoff_s=0.05)
+        return response.json() if response.status_code == 200 else {}
+    return fetch_metadata
+
+def test_crawl_api_server_retries_transient_errors(terra_utils, fake_api_server):
+    fake_api_server.errors = {'root': [429], 'sub1': [503, 500], 'sub3': [502, 429, 504]}
+    fetch_metadata = _api_fetcher(terra_utils, fake_api_server, rate_limiter=terra_utils.RateLimiter(1000))
+    assert _crawl(terra_utils, fetch_metadata) == \
+        {workflow_id: (workflow_metadata, False) for workflow_id, workflow_metadata in WORKFLOWS.items()}
+    assert fake_api_server.n_requests == collections.Counter(root=2, sub1=3, sub2=1, sub3=4)
+
+def test_crawl_api_server_does_not_retry_client_errors(terra_utils, fake_api_server):
+    fake_api_server.errors = {'sub1': [403, 503]}
+    fetch_metadata = _api_fetcher(terra_utils, fake_api_server, rate_limiter=terra_utils.RateLimiter(1000))
+    crawled = _crawl(terra_utils, fetch_metadata)
+    assert crawled['sub1'] == ({}, False)
+    assert fake_api_server.n_requests == collections.Counter(root=1, sub1=1, sub2=1, sub3=1)
+
+def test_crawl_api_server_gives_up_on_persistent_errors(terra_utils, fake_api_server):
+    fake_api_server.errors = {'sub2': [503] * 10}
+    fetch_metadata = _api_fetcher(terra_utils, fake_api_server, rate_limiter=terra_utils.RateLimiter(1000),
+                                  max_attempts=3)
+    crawled = _crawl(terra_utils, fetch_metadata)
+    assert crawled['sub2'] == ({}, False)
+    assert {workflow_id: workflow_metadata for workflow_id, (workflow_metadata, _) in crawled.items()
+            if workflow_id != 'sub2'} == {workflow_id: workflow_metadata for workflow_id, workflow_metadata
+                                          in WORKFLOWS.items() if workflow_id != 'sub2'}
+    assert fake_api_server.n_requests['sub2'] == 3
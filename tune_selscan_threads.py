@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Benchmarks how selscan runtime scales with the number of threads, for each selscan component, on a few
+representative hapsets, and writes the timings as a table that compute_cms2_components.py --selscan-threads-table
+uses to choose thread counts and the number of concurrent selscan invocations.
+
+The representative hapsets should span the range of variant counts and haplotype counts of the hapsets to be
+processed; each processed hapset is matched to the benchmarked hapset closest to it in size.
+
+Optionally, also writes the number of cpus to give each component computation task (--out-recommended-cpus):
+the median, over the benchmarked hapsets and components, of the largest thread count at which selscan still
+runs with at least --min-parallel-efficiency.
+"""
+
+# * imports etc
+
+import platform
+
+if not tuple(map(int, platform.python_version_tuple())) >= (3,8):
+    raise RuntimeError('Python >=3.8 required')
+
+import argparse
+import collections
+import csv
+import logging
+import os
+import os.path
+import statistics
+import tempfile
+import time
+
+import compute_cms2_components as ccc
+
+# * Utils
+
+_log = logging.getLogger(__name__)
+
+# * tune_selscan_threads
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--hapsets', nargs='+', required=True,
+                        help='representative hapset .tar.gz files; names starting with @ refer to files listing file names')
+    parser.add_argument('--sel-pop', help='pop for which to run selscan; defaults to the first pop of each hapset')
+    parser.add_argument('--alt-pop', help='alt pop for xpehh; defaults to the first other pop of each hapset')
+    parser.add_argument('--components', nargs='+', choices=ccc.SELSCAN_COMPONENTS, default=list(ccc.SELSCAN_COMPONENTS),
+                        help='selscan components to benchmark')
+    parser.add_argument('--thread-counts', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='thread counts to benchmark; counts above the available cpus are skipped')
+    parser.add_argument('--out-table', required=True, help='write the timings to this tsv file')
+    parser.add_argument('--out-recommended-cpus', help='write the recommended number of cpus per task to this file')
+    parser.add_argument('--min-parallel-efficiency', type=float, default=0.5,
+                        help='for --out-recommended-cpus, the min speedup per thread, relative to the fewest threads '
+                        'benchmarked, at which more threads are considered worth using')
+
+    return parser.parse_args()
+
+def recommend_cpus(wall_times, min_parallel_efficiency):
+    """Recommend the number of cpus per task, given a map from (hapset, component) to a map from thread count to
+    wall time"""
+    efficient_threads = []
+    for threads2wall_time in wall_times.values():
+        min_threads = min(threads2wall_time)
+        base_work = min_threads * threads2wall_time[min_threads]
+        efficient_threads.append(max(threads for threads, wall_time in threads2wall_time.items()
+                                     if base_work / (threads * wall_time) >= min_parallel_efficiency))
+    return int(statistics.median_low(efficient_threads))
+
+def tune_selscan_threads(args):
+    """Time selscan for each hapset, component and thread count"""
+    n_cpus = ccc.available_cpu_count()
+    thread_counts = sorted(set(t for t in args.thread_counts if t <= n_cpus))
+    ccc.chk(thread_counts, f'no thread counts at most {n_cpus=}')
+
+    wall_times = collections.defaultdict(dict)
+    with open(args.out_table, 'w') as out_table, tempfile.TemporaryDirectory() as tmp_dir:
+        table_writer = csv.writer(out_table, delimiter='\t', lineterminator='\n')
+        table_writer.writerow(['hapset', 'component', 'n_variants', 'n_haps', 'threads', 'wall_time_s'])
+        for hapset_num, hapset_tar_gz in enumerate(ccc.parse_file_list(args.hapsets)):
+            hapset_dir = os.path.join(tmp_dir, f'hapset{hapset_num:06}')
+            os.mkdir(hapset_dir)
+            ccc.execute(f'tar -zxf {hapset_tar_gz} -C {hapset_dir}/')
+            replicaInfo = ccc._json_loadf(ccc.find_one_file(f'{hapset_dir}/*.replicaInfo.json'))
+            pop_ids = [str(pop_id) for pop_id in replicaInfo['popIds']]
+            sel_pop = args.sel_pop or pop_ids[0]
+            alt_pop = args.alt_pop or [pop_id for pop_id in pop_ids if pop_id != sel_pop][0]
+            pop2tped = {str(pop_id): os.path.join(hapset_dir, tped)
+                        for pop_id, tped in zip(replicaInfo['popIds'], replicaInfo['tpedFiles'])}
+            n_variants = ccc.get_hapset_n_variants(replicaInfo)
+            ccc.chk(n_variants is not None, f'n_variants not recorded in replicaInfo of {hapset_tar_gz}')
+
+            for component in args.components:
+                n_haps = ccc.get_selscan_n_haps(replicaInfo['pop_sample_sizes'], sel_pop,
+                                                alt_pop if component == 'xpehh' else None)
+                for threads in thread_counts:
+                    beg_time = time.time()
+                    ccc.execute(ccc.selscan_cmd(tped=pop2tped[sel_pop], out='tune', component=component, threads=threads,
+                                                tped_ref=pop2tped[alt_pop] if component == 'xpehh' else None),
+                                cwd=hapset_dir)
+                    wall_time_s = time.time() - beg_time
+                    wall_times[(hapset_tar_gz, component)][threads] = wall_time_s
+                    _log.info(f'{hapset_tar_gz=} {component=} {n_variants=} {n_haps=} {threads=} {wall_time_s=}')
+                    table_writer.writerow([os.path.basename(hapset_tar_gz), component, n_variants, n_haps,
+                                           threads, f'{wall_time_s:.3f}'])
+            ccc.execute(f'rm -rf {hapset_dir}')
+
+    if args.out_recommended_cpus:
+        recommended_cpus = recommend_cpus(wall_times, min_parallel_efficiency=args.min_parallel_efficiency)
+        _log.info(f'{recommended_cpus=}')
+        ccc.dump_file(args.out_recommended_cpus, recommended_cpus)
+# end: def tune_selscan_threads(args)
+
+if __name__=='__main__':
+    tune_selscan_threads(parse_args())
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""Benchmarks the pipeline's Python stages end to end on synthetic hapsets, without cosi2, selscan or 1KG data.
+
+Synthetic hapsets are written by make_synthetic_hapsets.py, and the external tools the stages call (selscan, norm,
+iSAFE, bgzip, bcftools) are replaced by the stand-ins in bench_stubs/, so that the timings measure the pipeline's own
+code.  Each stage is run --n-runs times and its median wall time recorded.  Later stages consume the outputs of
+earlier ones, as in the workflow: component computation, then normalization and collation, then HDF5 collation.
+
+The timings, along with the git commit, host and benchmark configuration, are appended to a json history file
+(--history-json).  Each stage's median time is compared with the most recent earlier record for the same
+configuration in the baseline file (--baseline-json, by default the history file); the script exits with a non-zero
+status if any stage got slower by more than --regression-tolerance, or failed where the baseline succeeded.
+"""
+
+# * imports etc
+
+import argparse
+import collections
+import datetime
+import glob
+import json
+import logging
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+UTIL_DIR = os.path.dirname(os.path.realpath(__file__))
+STUBS_DIR = os.path.join(UTIL_DIR, 'bench_stubs')
+
+# our imports: misc_utils, from the dir of the scripts being benchmarked
+sys.path.insert(0, os.path.dirname(UTIL_DIR))
+from misc_utils import chk, _write_json
+
+def run_script(script, script_args, cwd, repo_dir):
+    """Run one of the pipeline's scripts in a fresh interpreter, with its output going to a log file in cwd"""
+    log_fname = os.path.join(cwd, os.path.basename(script) + '.log')
+    with open(log_fname, 'w') as log:
+        proc = subprocess.run([sys.executable, os.path.join(repo_dir, script)] + list(map(str, script_args)),
+                              cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        with open(log_fname) as log:
+            log_tail = log.read().strip().split('\n')[-1]
+        raise RuntimeError(f'{script} failed with exit code {proc.returncode}: {log_tail}')
+
+# * Setup
+
+def setup_hapsets(args, work_dir):
+    """Write the synthetic hapsets, and the inputs derived from them that the stages need.
+
+    Returns:
+      a namespace with one entry per hapset in `hapsets`, and the sel and alt pops
+    """
+    import numpy as np
+    import compute_cms2_components as ccc
+    import make_synthetic_hapsets
+
+    pop_sample_sizes = make_synthetic_hapsets.parse_pop_sample_sizes(args.pops, args.pop_sample_sizes)
+    sel_pop, alt_pops = args.pops[0], args.pops[1:]
+    hapsets_dir = os.path.join(work_dir, 'hapsets')
+    hapset_tar_gzs = make_synthetic_hapsets.make_synthetic_hapsets(
+        out_dir=hapsets_dir, n_hapsets=args.n_hapsets, n_variants=args.n_variants, pop_sample_sizes=pop_sample_sizes,
+        region_len_bp=args.region_len_bp, seed=args.seed, sel_pop=sel_pop)
+
+    hapsets = []
+    for hapset_tar_gz in hapset_tar_gzs:
+        hapset_id = os.path.basename(hapset_tar_gz)[:-len('.tar.gz')]
+        hapset_dir = os.path.join(hapsets_dir, hapset_id)
+        with open(os.path.join(hapset_dir, f'{hapset_id}.replicaInfo.json')) as f:
+            replicaInfo = json.load(f)
+        pop2tped = {pop: os.path.join(hapset_dir, tped) for pop, tped in replicaInfo['tpeds'].items()}
+        hapset = types.SimpleNamespace(hapset_id=hapset_id, tar_gz=hapset_tar_gz, dir=hapset_dir,
+                                       manifest_json=os.path.join(hapset_dir, f'{hapset_id}.replicaInfo.json'),
+                                       pop2tped=pop2tped)
+
+        # selscan iHS output, for the delihh stage
+        subprocess.check_call([os.path.join(STUBS_DIR, 'selscan'), '--ihs', '--ihs-detail', '--tped',
+                               pop2tped[sel_pop], '--out', os.path.join(hapset_dir, hapset_id)])
+        hapset.ihs_out = os.path.join(hapset_dir, f'{hapset_id}.ihs.out')
+
+        # a phased 1KG-style vcf of the hapset's haplotypes, pairing them into diploid samples, for the empirical
+        # hapset construction stage
+        pop_tped_data = [ccc.read_tped(pop2tped[pop]) for pop in args.pops]
+        pop_alleles = [tped_data.alleles for tped_data in pop_tped_data]
+        phys_pos = np.array(pop_tped_data[0].phys_pos, dtype=np.int64)
+        chk(all(alleles.shape[1] % 2 == 0 for alleles in pop_alleles), 'pop sample sizes must be even')
+        # in the vcf, allele 0 (the ref allele) is ancestral, while in tpeds 1 is ancestral
+        gts = 1 - np.concatenate(pop_alleles, axis=1)
+        hapset.vcf_lines = []
+        for pos, pos_gts in zip(phys_pos.tolist(), gts):
+            derived_freq = pos_gts.mean()
+            sample_data = '\t'.join(f'{a}|{b}' for a, b in zip(pos_gts[0::2].tolist(), pos_gts[1::2].tolist()))
+            hapset.vcf_lines.append(f'1\t{pos}\t.\tA\tG\t100\tPASS\tAA=A|||;AF={derived_freq:.4f};VT=SNP\tGT\t'
+                                    f'{sample_data}\n')
+        hapset.n_vcf_samples = gts.shape[1] // 2
+        sample_bounds = np.cumsum([0] + [alleles.shape[1] // 2 for alleles in pop_alleles])
+        hapset.pop2vcfcols = {pop: list(range(9 + pop_beg, 9 + pop_end))
+                              for pop, pop_beg, pop_end in zip(args.pops, sample_bounds[:-1], sample_bounds[1:])}
+        hapsets.append(hapset)
+    # end: for hapset_tar_gz in hapset_tar_gzs
+
+    return types.SimpleNamespace(hapsets=hapsets, sel_pop=sel_pop, alt_pops=alt_pops)
+# end: def setup_hapsets(args, work_dir)
+
+# * Stages
+
+# each stage is a function taking the benchmark context (a namespace holding the setup outputs and the outputs
+# of earlier stages), the dir in which to run, and the parsed args; it may return a dict of outputs to add to the
+# context for later stages
+
+def bench_calc_derFreq(ctx, run_dir, args):
+    import compute_cms2_components as ccc
+    for hapset in ctx.hapsets:
+        ccc.calc_derFreq(in_tped=hapset.pop2tped[ctx.sel_pop],
+                         out_derFreq_tsv=os.path.join(run_dir, f'{hapset.hapset_id}.derFreq.tsv'))
+
+def bench_calc_fst_and_delDAF(ctx, run_dir, args):
+    """Fst and delDAF, computed in-process since they replaced the freqs_stats tool"""
+    import compute_cms2_components as ccc
+    for hapset in ctx.hapsets:
+        sel_pop_tped_data = ccc.read_tped(hapset.pop2tped[ctx.sel_pop])
+        for alt_pop in ctx.alt_pops:
+            ccc.write_fst_and_delDAF(sel_pop_tped_data=sel_pop_tped_data,
+                                     alt_pop_tped_data=ccc.read_tped(hapset.pop2tped[alt_pop]),
+                                     out_fst_and_delDAF_tsv=os.path.join(run_dir, f'{hapset.hapset_id}__altpop_{alt_pop}'
+                                                                         '.fst_and_delDAF.tsv'))
+
+def bench_calc_delihh(ctx, run_dir, args):
+    import compute_cms2_components as ccc
+    for hapset in ctx.hapsets:
+        ccc.calc_delihh(readfilename=hapset.ihs_out, writefilename=os.path.join(run_dir, f'{hapset.hapset_id}.delihh.out'))
+
+def bench_hapset_to_vcf(ctx, run_dir, args):
+    import compute_cms2_components as ccc
+    for hapset in ctx.hapsets:
+        ccc.hapset_to_vcf(hapset_manifest_json_fname=hapset.manifest_json,
+                          out_vcf_basename=os.path.join(run_dir, f'{hapset.hapset_id}.{ctx.sel_pop}'), sel_pop=ctx.sel_pop)
+
+def bench_compute_cms2_components(ctx, run_dir, args):
+    """All components for the sel pop, by running compute_cms2_components.py on the hapset .tar.gz files"""
+    run_script('compute_cms2_components.py',
+               ['--hapsets'] + [hapset.tar_gz for hapset in ctx.hapsets] +
+               ['--sel-pops', ctx.sel_pop, '--pop-pairs'] + [f'{ctx.sel_pop},{alt_pop}' for alt_pop in ctx.alt_pops] +
+               ['--components', 'ihs', 'ihh12', 'nsl', 'delihh', 'derFreq', 'iSAFE', 'xpehh', 'fst', 'delDAF',
+                '--threads', '1'],
+               cwd=run_dir, repo_dir=args.repo_dir)
+    return dict(components_dir=run_dir)
+
+def bench_norm_and_collate_block(ctx, run_dir, args):
+    """Normalization and collation of the component scores computed by the compute_cms2_components stage"""
+    chk(getattr(ctx, 'components_dir', None), 'needs the outputs of the compute_cms2_components stage')
+    norm_bins = {}
+    for component in ('ihs', 'nsl', 'ihh12', 'delihh') + tuple(f'xpehh_{alt_pop}' for alt_pop in ctx.alt_pops):
+        norm_bins[component] = os.path.join(run_dir, f'{component}.norm_bins')
+        open(norm_bins[component], 'w').close()
+
+    def out_prefix(hapset_num, hapset, alt_pop=None):
+        return os.path.join(ctx.components_dir, f'hapset{hapset_num:06}.{os.path.basename(hapset.tar_gz)}'
+                            f'__selpop_{ctx.sel_pop}' + (f'__altpop_{alt_pop}' if alt_pop else ''))
+    hapsets = list(enumerate(ctx.hapsets))
+    inps = dict(replica_info=[os.path.join(ctx.components_dir, f'hapset{hapset_num:06}.{hapset.hapset_id}.replicaInfo.json')
+                              for hapset_num, hapset in hapsets],
+                sel_pop=ctx.sel_pop,
+                ihs_out=[out_prefix(*h) + '.ihs.out' for h in hapsets],
+                nsl_out=[out_prefix(*h) + '.nsl.out' for h in hapsets],
+                ihh12_out=[out_prefix(*h) + '.ihh12.out' for h in hapsets],
+                delihh_out=[out_prefix(*h) + '.delihh.out' for h in hapsets],
+                derFreq_out=[out_prefix(*h) + '.derFreq.tsv' for h in hapsets],
+                iSAFE_out=[os.path.join(ctx.components_dir,
+                                        f'hapset{hapset_num:06}.{hapset.hapset_id}.replicaInfo.{ctx.sel_pop}.iSAFE.out')
+                           for hapset_num, hapset in hapsets],
+                xpehh_out=[[out_prefix(*h, alt_pop) + '.xpehh.out' for h in hapsets] for alt_pop in ctx.alt_pops],
+                fst_and_delDAF_out=[[out_prefix(*h, alt_pop) + '.fst_and_delDAF.tsv' for h in hapsets]
+                                    for alt_pop in ctx.alt_pops],
+                norm_bins_ihs=norm_bins['ihs'], norm_bins_nsl=norm_bins['nsl'], norm_bins_ihh12=norm_bins['ihh12'],
+                norm_bins_delihh=norm_bins['delihh'],
+                norm_bins_xpehh=[norm_bins[f'xpehh_{alt_pop}'] for alt_pop in ctx.alt_pops],
+                component_computation_params=dict(n_bins_ihs=20, n_bins_nsl=20, n_bins_delihh=20))
+    _write_json(os.path.join(run_dir, 'inputs.json'), inps)
+    run_script('norm_and_collate_block.py', ['--input-json', 'inputs.json'], cwd=run_dir, repo_dir=args.repo_dir)
+    return dict(normed_dir=run_dir)
+
+def bench_collate_stats_and_metadata_for_sel_sims_block(ctx, run_dir, args):
+    """HDF5 collation of the normalized and collated scores from the norm_and_collate_block stage"""
+    chk(getattr(ctx, 'normed_dir', None), 'needs the outputs of the norm_and_collate_block stage')
+    normed_and_collated = sorted(glob.glob(os.path.join(ctx.normed_dir, '*.normed_and_collated.tsv')))
+    _write_json(os.path.join(run_dir, 'inputs.json'),
+                dict(sel_normed_and_collated=normed_and_collated,
+                     replica_infos=[f[:-len('.tsv')] + '.replicaInfo.json' for f in normed_and_collated]))
+    run_script('collate_stats_and_metadata_for_sel_sims_block.py',
+               ['--input-json', 'inputs.json', '--hapsets-component-stats-h5-fname', 'component_stats.h5',
+                '--hapsets-metadata-tsv-gz-fname', 'metadata.tsv.gz'], cwd=run_dir, repo_dir=args.repo_dir)
+
+def bench_construct_empirical_hapsets(ctx, run_dir, args):
+    """Construction of empirical hapset tpeds from phased vcf lines, as done by fetch_empirical_hapsets.py"""
+    import numpy as np
+    import fetch_empirical_hapsets as feh
+    for hapset in ctx.hapsets:
+        stats = collections.Counter()
+        used_samples = np.arange(hapset.n_vcf_samples)
+        writer = feh.EmpiricalHapsetWriter(region_key=f'1:1-{args.region_len_bp}', region_sel_pop=ctx.sel_pop,
+                                           pops_to_include=list(hapset.pop2vcfcols), pop2vcfcols=hapset.pop2vcfcols,
+                                           pop2samples={pop: [f'{pop}_{col}' for col in cols]
+                                                        for pop, cols in hapset.pop2vcfcols.items()},
+                                           genmap=lambda chrom, pos, pop: pos * 1e-6, stats=stats, tmp_dir=run_dir,
+                                           out_fnames_prefix=hapset.hapset_id)
+        for vcf_line_num, vcf_line in enumerate(hapset.vcf_lines):
+            decoded = feh.decode_vcf_line(vcf_line, n_samples=hapset.n_vcf_samples, used_samples=used_samples,
+                                          stats=stats)
+            if decoded is not None:
+                chrom, pos, anc_gts = decoded
+                writer.add_variant(chrom=chrom, pos=pos, vcf_line_num=vcf_line_num, anc_gts=anc_gts)
+        writer.finish()
+
+# stages, in the order in which they are run
+STAGES = collections.OrderedDict([
+    ('calc_derFreq', bench_calc_derFreq),
+    ('calc_fst_and_delDAF', bench_calc_fst_and_delDAF),
+    ('calc_delihh', bench_calc_delihh),
+    ('hapset_to_vcf', bench_hapset_to_vcf),
+    ('compute_cms2_components', bench_compute_cms2_components),
+    ('norm_and_collate_block', bench_norm_and_collate_block),
+    ('collate_stats_and_metadata_for_sel_sims_block', bench_collate_stats_and_metadata_for_sel_sims_block),
+    ('construct_empirical_hapsets', bench_construct_empirical_hapsets),
+])
+
+def run_stages(ctx, args, work_dir):
+    """Run each selected stage args.n_runs times, and return a map from stage name to its timings"""
+    stages_results = collections.OrderedDict()
+    for stage_name, stage_fn in STAGES.items():
+        if args.stages and stage_name not in args.stages:
+            continue
+        times_s = []
+        stage_result = dict(status='ok')
+        for run_num in range(args.n_runs):
+            run_dir = os.path.join(work_dir, stage_name, f'run{run_num}')
+            os.makedirs(run_dir)
+            beg_time = time.perf_counter()
+            try:
+                stage_outputs = stage_fn(ctx, run_dir, args)
+            except Exception as e:
+                _log.warning(f'{stage_name}: failed: {e}')
+                stage_result = dict(status='failed', error=str(e))
+                break
+            times_s.append(time.perf_counter() - beg_time)
+            if run_num == args.n_runs - 1:
+                vars(ctx).update(stage_outputs or {})
+        if times_s and stage_result['status'] == 'ok':
+            stage_result.update(median_s=statistics.median(times_s), times_s=times_s)
+            _log.info(f'{stage_name}: median {stage_result["median_s"]:.3f}s over {len(times_s)} runs')
+        stages_results[stage_name] = stage_result
+    return stages_results
+# end: def run_stages(ctx, args, work_dir)
+
+# * History and regressions
+
+def load_history(history_json):
+    """Load a list of benchmark records from a history file; a missing file is an empty history"""
+    if not history_json or not os.path.isfile(history_json):
+        return []
+    with open(history_json) as f:
+        return json.load(f)
+
+def find_baseline(history, config):
+    """Return the most recent record in `history` with the given benchmark config, or None"""
+    return next((record for record in reversed(history) if record['config'] == config), None)
+
+def find_regressions(record, baseline, tolerance, min_regression_s):
+    """Compare a record's stage timings to a baseline record's.
+
+    Returns:
+      list of messages, one for each stage that got slower by more than `tolerance` (a fraction of the baseline time)
+      and by more than `min_regression_s`, or that failed where the baseline succeeded
+    """
+    regressions = []
+    for stage_name, stage_result in record['stages'].items():
+        baseline_result = baseline['stages'].get(stage_name)
+        if not baseline_result or baseline_result['status'] != 'ok':
+            continue
+        if stage_result['status'] != 'ok':
+            regressions.append(f'{stage_name}: failed, but succeeded in baseline')
+            continue
+        base_s, cur_s = baseline_result['median_s'], stage_result['median_s']
+        if cur_s > base_s * (1 + tolerance) and cur_s - base_s > min_regression_s:
+            regressions.append(f'{stage_name}: {cur_s:.3f}s vs {base_s:.3f}s in baseline ({cur_s/base_s - 1:+.0%})')
+    return regressions
+
+def get_git_commit(repo_dir):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# * benchmark_pipeline
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--repo-dir', default=os.path.dirname(UTIL_DIR), help='directory containing the scripts')
+    parser.add_argument('--work-dir', help='dir in which to write the hapsets and stage outputs, which are then kept; '
+                        'by default a temp dir is used and removed')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='stages to run; defaults to all stages')
+    parser.add_argument('--n-runs', type=int, default=3, help='run each stage this many times, and use the median time')
+
+    parser.add_argument('--n-hapsets', type=int, default=2, help='number of synthetic hapsets')
+    parser.add_argument('--n-variants', type=int, default=5000, help='number of variants in each synthetic hapset')
+    parser.add_argument('--pops', nargs='+', default=['1', '2', '3', '4'],
+                        help='pop ids; the first is the sel pop, and the rest are the alt pops')
+    parser.add_argument('--pop-sample-sizes', type=int, nargs='+', default=[120],
+                        help='number of haplotypes in each pop, or one number for all pops')
+    parser.add_argument('--region-len-bp', type=int, default=1500000, help='length of each synthetic hapset region')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic hapsets')
+
+    parser.add_argument('--history-json', help='append the timings to this json file')
+    parser.add_argument('--baseline-json', help='history file in which to find the baseline for flagging regressions; '
+                        'defaults to --history-json')
+    parser.add_argument('--regression-tolerance', type=float, default=0.25,
+                        help='flag a stage as regressed if it is slower than baseline by more than this fraction')
+    parser.add_argument('--min-regression-s', type=float, default=0.05,
+                        help='do not flag slowdowns smaller than this many seconds, which are likely noise')
+
+    return parser.parse_args()
+
+def benchmark_pipeline(args):
+    """Time the pipeline stages on synthetic hapsets, record the timings, and flag regressions"""
+    sys.path[:0] = [args.repo_dir, UTIL_DIR]
+    # the stages, and the scripts they run, find the stub tools first
+    os.environ['PATH'] = STUBS_DIR + os.pathsep + os.environ['PATH']
+    config = dict(n_hapsets=args.n_hapsets, n_variants=args.n_variants, pops=args.pops,
+                  pop_sample_sizes=args.pop_sample_sizes, region_len_bp=args.region_len_bp, seed=args.seed)
+
+    work_dir = os.path.realpath(args.work_dir or tempfile.mkdtemp(prefix='benchmark_pipeline.'))
+    try:
+        beg_time = time.perf_counter()
+        ctx = setup_hapsets(args, work_dir)
+        _log.info(f'Wrote synthetic hapsets and stage inputs in {time.perf_counter() - beg_time:.1f}s: {config=}')
+        stages_results = run_stages(ctx, args, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    record = dict(timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+                  git_commit=get_git_commit(args.repo_dir), host=platform.node(),
+                  python_version=platform.python_version(), n_cpus=os.cpu_count(),
+                  config=config, stages=stages_results)
+
+    regressions = []
+    baseline = find_baseline(load_history(args.baseline_json or args.history_json), config)
+    if baseline:
+        regressions = find_regressions(record, baseline, tolerance=args.regression_tolerance,
+                                       min_regression_s=args.min_regression_s)
+        _log.info(f'Compared with baseline from {baseline["timestamp"]} (commit {baseline["git_commit"]}): '
+                  f'{len(regressions)} regressions')
+    else:
+        _log.info('No baseline with the same benchmark config; not checking for regressions')
+
+    if args.history_json:
+        _write_json(args.history_json, load_history(args.history_json) + [record])
+
+    for regression in regressions:
+        _log.error(f'REGRESSION: {regression}')
+    if regressions:
+        sys.exit(1)
+# end: def benchmark_pipeline(args)
+
+if __name__=='__main__':
+    benchmark_pipeline(parse_args())
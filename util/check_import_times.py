@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Checks that importing each pipeline script stays within its startup-time budget.
+
+Many pipeline tasks are short-lived, so the time a script takes to start (mostly, to import its modules) is paid
+on each of thousands of small shards.  This runs `python -X importtime` on each script's module, in a fresh
+interpreter, and reports the cumulative import time against the script's budget.  Heavy modules should be loaded
+with misc_utils.lazy_import(), or imported in the functions that use them.
+
+Exits with a non-zero status if any script exceeds its budget or fails to import.  Scripts whose third-party
+dependencies are not installed are reported as skipped.
+"""
+
+# * imports etc
+
+import argparse
+import logging
+import os
+import os.path
+import re
+import statistics
+import subprocess
+import sys
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+# * Budgets
+
+# budget, in milliseconds, for the cumulative time to import each script's module (run from the repo root).
+# Import times vary by tens of percent from run to run, so each budget allows about twice the median time measured
+# when the budget was set; a module over budget has gained a heavy import, rather than been measured on a slow run.
+IMPORT_TIME_BUDGETS_MS = {
+    'misc_utils': 100,
+    'runcosi': 125,
+    'get_pops_info': 50,
+    'compute_cms2_components': 125,
+    'norm_bins': 100,
+    'pack_hapset_blocks': 100,
+    'norm_and_collate': 125,
+    'norm_and_collate_block': 125,
+    'collate_stats_and_metadata_for_all_sel_sims': 125,
+    'collate_stats_and_metadata_for_sel_sims_block': 125,
+    'compute_intervals_stats': 175,
+    'construct_neutral_regions_list': 150,
+    'construct_pops_info_for_1KG': 150,
+    'extract_hapset_component_scores': 125,
+    'fetch_empirical_hapsets': 175,
+    'fetch_neutral_regions_nre': 1000,
+}
+
+# * check_import_times
+
+def measure_import_time_ms(module, repo_dir, python=sys.executable):
+    """Return the cumulative time, in milliseconds, to import `module` in a fresh interpreter, as reported
+    by `python -X importtime`.  Raises ModuleNotFoundError if a third-party module it imports is not installed."""
+    proc = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=repo_dir,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        error = proc.stderr.strip().split('\n')[-1]
+        m = re.match(r"ModuleNotFoundError: No module named '([^'.]+)", error)
+        if m and not os.path.isfile(os.path.join(repo_dir, f'{m.group(1)}.py')):
+            raise ModuleNotFoundError(f'{module} needs {m.group(1)}, which is not installed', name=m.group(1))
+        raise RuntimeError(f'Error importing {module}: {error}')
+    for line in proc.stderr.split('\n'):
+        # lines are of the form "import time:  self_us |  cumulative_us | module", with nested imports indented
+        if line.startswith('import time:') and line.split('|')[-1].rstrip() == f' {module}':
+            return int(line.split('|')[1]) / 1000.0
+    raise RuntimeError(f'Import time of {module} not reported')
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--modules', nargs='+', choices=sorted(IMPORT_TIME_BUDGETS_MS),
+                        help='modules to check; defaults to all modules with a budget')
+    parser.add_argument('--repo-dir', default=os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                        help='directory containing the scripts')
+    parser.add_argument('--n-runs', type=int, default=3,
+                        help='import each module this many times, and use the median time')
+    parser.add_argument('--python', default=sys.executable, help='python interpreter to use')
+
+    return parser.parse_args()
+
+def check_import_times(args):
+    """Measure each module's import time, and compare to its budget"""
+    over_budget, skipped = [], []
+    for module in (args.modules or IMPORT_TIME_BUDGETS_MS):
+        budget_ms = IMPORT_TIME_BUDGETS_MS[module]
+        try:
+            import_time_ms = statistics.median(measure_import_time_ms(module, repo_dir=args.repo_dir,
+                                                                      python=args.python)
+                                               for _ in range(args.n_runs))
+        except ModuleNotFoundError as e:
+            _log.warning(f'Skipping {module}: {e}')
+            skipped.append(module)
+            continue
+        except RuntimeError as e:
+            _log.warning(str(e))
+            over_budget.append(module)
+            continue
+        ok = import_time_ms <= budget_ms
+        _log.info(f'{module}: {import_time_ms:.1f}ms (budget {budget_ms}ms){"" if ok else " OVER BUDGET"}')
+        if not ok:
+            over_budget.append(module)
+
+    if skipped:
+        _log.warning(f'Modules skipped because of missing third-party dependencies: {skipped}')
+    if over_budget:
+        _log.error(f'Modules over their import time budget, or failing to import: {over_budget}')
+        sys.exit(1)
+# end: def check_import_times(args)
+
+if __name__=='__main__':
+    check_import_times(parse_args())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""Writes synthetic hapsets, in the format produced by runcosi.py, for benchmarking and testing without cosi2.
+
+Each hapset is a .tar.gz holding one tped per pop and a replicaInfo json.  Derived allele frequencies are drawn from
+a neutral (1/x) frequency spectrum and perturbed independently in each pop, so that the hapsets have realistic
+numbers of rare and common variants and some differentiation between pops; there is no linkage structure.
+"""
+
+# * imports etc
+
+import argparse
+import json
+import logging
+import os
+import os.path
+import subprocess
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+# * make_synthetic_hapsets
+
+def draw_derived_freqs(n_variants, n_haps, rng):
+    """Draw derived allele frequencies of polymorphic variants from a neutral frequency spectrum, under which
+    a variant has k derived alleles among n_haps with probability proportional to 1/k"""
+    ks = np.arange(1, n_haps)
+    return rng.choice(ks, size=n_variants, p=(1.0 / ks) / np.sum(1.0 / ks)) / n_haps
+
+def write_tped(tped_fname, phys_pos, alleles):
+    """Write a tped in the format written by cosi2: chrom, snp id, genetic pos (cM), physical pos (bp), and then
+    the alleles, with 1 for ancestral and 0 for derived"""
+    n_haps = alleles.shape[1]
+    # each allele is written as a space and a digit, so a row of alleles is a fixed-width run of bytes
+    allele_bytes = np.full((alleles.shape[0], 2 * n_haps), ord(' '), dtype=np.uint8)
+    allele_bytes[:, 1::2] = alleles + ord('0')
+    with open(tped_fname, 'wb') as tped:
+        for snp_num, (pos, row_bytes) in enumerate(zip(phys_pos.tolist(), allele_bytes)):
+            tped.write(f'1 {snp_num} {pos * 1e-6:.6f} {pos}'.encode('ascii') + row_bytes.tobytes() + b'\n')
+
+def make_synthetic_hapset(out_dir, hapset_id, n_variants, pop_sample_sizes, region_len_bp, rng, sel_pop=None,
+                          pop_freq_sd=0.05):
+    """Write one synthetic hapset.
+
+    Args:
+      out_dir: dir in which to write the hapset .tar.gz
+      hapset_id: hapset id, used as the prefix of the hapset's file names
+      n_variants: number of variants, all polymorphic across the pops
+      pop_sample_sizes: map from pop id to the number of haplotypes sampled from that pop
+      region_len_bp: length of the simulated region
+      rng: numpy random Generator
+      sel_pop: pop recorded in the replicaInfo as the pop under selection, or None for a neutral hapset
+      pop_freq_sd: standard deviation of the per-pop perturbation of each variant's derived allele frequency
+
+    Returns:
+      path to the hapset .tar.gz
+    """
+    pop_ids = list(pop_sample_sizes)
+    n_haps = sum(pop_sample_sizes.values())
+    phys_pos = np.sort(rng.choice(np.arange(1, region_len_bp), size=n_variants, replace=False))
+    freqs = draw_derived_freqs(n_variants, n_haps, rng)
+
+    pop_alleles = {}
+    for pop_id in pop_ids:
+        pop_freqs = np.clip(freqs + rng.normal(0.0, pop_freq_sd, size=n_variants), 0.0, 1.0)
+        # 1 is ancestral and 0 is derived
+        pop_alleles[pop_id] = (rng.random((n_variants, pop_sample_sizes[pop_id])) >= pop_freqs[:, None]).astype(np.uint8)
+    # make every variant polymorphic across the pops, as in simulated hapsets
+    all_alleles = np.concatenate(list(pop_alleles.values()), axis=1)
+    pop_alleles[pop_ids[0]][np.all(all_alleles == 1, axis=1), 0] = 0
+    pop_alleles[pop_ids[0]][np.all(all_alleles == 0, axis=1), 0] = 1
+
+    hapset_dir = os.path.join(out_dir, hapset_id)
+    os.makedirs(hapset_dir, exist_ok=True)
+    tpedFiles = [f'{hapset_id}_0_{pop_id}.tped' for pop_id in pop_ids]
+    for pop_id, tpedFile in zip(pop_ids, tpedFiles):
+        write_tped(os.path.join(hapset_dir, tpedFile), phys_pos, pop_alleles[pop_id])
+
+    no_sweep = dict(selPop=0, selGen=0.0, selBegPop=0, selBegGen=0.0, selCoeff=0.0, selFreq=0.0)
+    sweepInfo = no_sweep if sel_pop is None else dict(no_sweep, selPop=str(sel_pop), selBegPop=str(sel_pop),
+                                                      selGen=500.0, selBegGen=500.0, selCoeff=0.02, selFreq=0.5)
+    replicaInfo = dict(region_offset=0, region_beg=0, region_end=region_len_bp, simulated=True, popIds=pop_ids,
+                       pop_sample_sizes=pop_sample_sizes, n_variants=n_variants, succeeded=True,
+                       replicaId=dict(blockNum=0, replicaNumInBlock=0, replicaNumGlobal=0, replicaNumGlobalOutOf=1,
+                                      randomSeed=0),
+                       modelInfo=dict(modelId='synthetic', modelIdParts=['synthetic'], popIds=pop_ids,
+                                      popNames=pop_ids, sweepInfo=sweepInfo))
+    replicaInfoJsonFile = f'{hapset_id}.replicaInfo.json'
+    with open(os.path.join(hapset_dir, replicaInfoJsonFile), 'w') as out:
+        json.dump(dict(hapset_id=hapset_id, replicaInfo=replicaInfo, region_offset=0, region_beg=0,
+                       region_end=region_len_bp, pop_sample_sizes=pop_sample_sizes, simulated=True,
+                       popIds=pop_ids, popNames=pop_ids, tpedFiles=tpedFiles, tpeds=dict(zip(pop_ids, tpedFiles))),
+                  out, indent=4)
+
+    hapset_tar_gz = os.path.join(out_dir, f'{hapset_id}.tar.gz')
+    subprocess.check_call(['tar', 'czf', hapset_tar_gz, '-C', hapset_dir] + tpedFiles + [replicaInfoJsonFile])
+    _log.info(f'Wrote synthetic hapset {hapset_tar_gz}: {n_variants=} {pop_sample_sizes=}')
+    return hapset_tar_gz
+# end: def make_synthetic_hapset(...)
+
+def make_synthetic_hapsets(out_dir, n_hapsets, n_variants, pop_sample_sizes, region_len_bp, seed=1, sel_pop=None):
+    """Write `n_hapsets` synthetic hapsets to out_dir, and return the paths to their .tar.gz files"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    return [make_synthetic_hapset(out_dir=out_dir, hapset_id=f'synthetic_hapset_{hapset_num:04}', n_variants=n_variants,
+                                  pop_sample_sizes=pop_sample_sizes, region_len_bp=region_len_bp, rng=rng,
+                                  sel_pop=sel_pop)
+            for hapset_num in range(n_hapsets)]
+
+def parse_pop_sample_sizes(pops, sample_sizes):
+    """Map each pop to its sample size, given either one sample size per pop or one for all pops"""
+    if len(sample_sizes) == 1:
+        sample_sizes = sample_sizes * len(pops)
+    if len(sample_sizes) != len(pops):
+        raise RuntimeError(f'Error: need one sample size per pop, or one for all pops: {pops=} {sample_sizes=}')
+    return dict(zip(pops, sample_sizes))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--out-dir', required=True, help='dir in which to write the hapset .tar.gz files')
+    parser.add_argument('--n-hapsets', type=int, default=1, help='number of hapsets to write')
+    parser.add_argument('--n-variants', type=int, default=5000, help='number of variants in each hapset')
+    parser.add_argument('--pops', nargs='+', default=['1', '2', '3', '4'], help='pop ids')
+    parser.add_argument('--pop-sample-sizes', type=int, nargs='+', default=[120],
+                        help='number of haplotypes in each pop, or one number for all pops')
+    parser.add_argument('--region-len-bp', type=int, default=1500000, help='length of the region')
+    parser.add_argument('--sel-pop', help='record this pop as the pop under selection')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+    return parser.parse_args()
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = parse_args()
+    make_synthetic_hapsets(out_dir=args.out_dir, n_hapsets=args.n_hapsets, n_variants=args.n_variants,
+                           pop_sample_sizes=parse_pop_sample_sizes(args.pops, args.pop_sample_sizes),
+                           region_len_bp=args.region_len_bp, seed=args.seed, sel_pop=args.sel_pop)